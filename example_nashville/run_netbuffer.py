@@ -10,30 +10,33 @@ from activitysim.core.config import setting
 
 from activitysim.core import pipeline
 
-handle_standard_args()
+# worker processes (see num_processes in buffer_zones.yaml) import this
+# module, so only run the models from the main process
+if __name__ == '__main__':
 
-# comment out the line below to default base seed to 0 random seed
-# so that run results are reproducible
-# pipeline.set_rn_generator_base_seed(seed=None)
+    handle_standard_args()
 
-tracing.config_logger()
+    # comment out the line below to default base seed to 0 random seed
+    # so that run results are reproducible
+    # pipeline.set_rn_generator_base_seed(seed=None)
 
-t0 = print_elapsed_time()
+    tracing.config_logger()
 
-MODELS = setting('models')
+    t0 = print_elapsed_time()
 
+    MODELS = setting('models')
 
-# If you provide a resume_after argument to pipeline.run
-# the pipeline manager will attempt to load checkpointed tables from the checkpoint store
-# and resume pipeline processing on the next submodel step after the specified checkpoint
-resume_after = setting('resume_after', None)
+    # If you provide a resume_after argument to pipeline.run
+    # the pipeline manager will attempt to load checkpointed tables from the checkpoint store
+    # and resume pipeline processing on the next submodel step after the specified checkpoint
+    resume_after = setting('resume_after', None)
 
-if resume_after:
-    print("resume_after", resume_after)
+    if resume_after:
+        print("resume_after", resume_after)
 
-pipeline.run(models=MODELS, resume_after=resume_after)
+    pipeline.run(models=MODELS, resume_after=resume_after)
 
-# tables will no longer be available after pipeline is closed
-pipeline.close_pipeline()
+    # tables will no longer be available after pipeline is closed
+    pipeline.close_pipeline()
 
-t0 = print_elapsed_time("all models", t0)
+    t0 = print_elapsed_time("all models", t0)
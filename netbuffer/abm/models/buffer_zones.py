@@ -7,6 +7,11 @@ import numpy as np
 import pandana as pdna
 
 from netbuffer.core import buffer
+from netbuffer.core import ranges
+from netbuffer.core.network import network_file_path, snap_zones, snapping_store_path
+from netbuffer.core.result_cache import ResultCache
+from netbuffer.core.writers import read_binary_table
+from netbuffer.abm.models.write_daysim_files import SEP
 from activitysim.core import tracing
 from activitysim.core import config
 from activitysim.core import inject
@@ -17,8 +22,13 @@ logger = logging.getLogger(__name__)
 
 @inject.injectable()
 def buffer_zones_spec(buffer_zones_settings):
+    """
+    The buffer spec compiled into a BufferPlan once, when it is loaded.
+    Workers, rebuffering and the result cache run subsets of this plan
+    without compiling it again.
+    """
     spec_path = config.config_file_path(buffer_zones_settings['buffer_zones_spec'])
-    return buffer.read_buffer_spec(spec_path)
+    return buffer.compile_buffer_spec(buffer.read_buffer_spec(spec_path), 'zones_df')
 
 
 @inject.injectable()
@@ -47,6 +57,28 @@ def buffer_zones(settings, buffer_zones_spec,
 
     - buffer_zones_spec: expressions file
     - pois: Point of Interest file
+    - num_processes: optional, number of processes to buffer independent spec rows with
+    - chunk_size: optional, number of zone network nodes buffered at a time
+    - cache_pois: optional, keep snapped POIs in the snapping store next to the
+      saved network (see network.snapping_store_path), implied by the
+      'cache_snapping' setting
+    - result_cache: optional, True or a directory, keep the results of each target
+      in a cache directory (by default next to the saved network) and reuse them
+      while the target's expression, inputs and the network are unchanged
+    - result_cache_size: optional, size bound of the result cache in MB
+    - previous_results: optional, buffered zones output of an earlier run to update
+      incrementally instead of buffering every zone, see below
+
+    With previous_results, only the targets that read changed zone data are
+    recomputed, and only for the zones within range of a changed zone, see
+    buffer.rebuffer_variables. The changes are found by comparing the zone
+    data with previous_results unless they are listed:
+
+    - previous_results_delimiter: optional, 'space' (default), 'comma' or 'tab'
+    - changed_zones: optional, ids of the zones whose data changed
+    - changed_columns: optional, zone data columns that changed
+    - rebuffer_radius: optional, largest distance of any network query in the
+      spec, defaults to max_dist
 
     The CONSTANTS hash is made availabe to the expressions parser.
 
@@ -61,13 +93,22 @@ def buffer_zones(settings, buffer_zones_spec,
 
     constants = config.get_model_constants(buffer_zones_settings)
 
+    prune_options = settings.get('prune_network')
+    if isinstance(prune_options, dict) and prune_options.get('contract_chains'):
+        columns = buffer.spec_input_columns(buffer_zones_spec, 'intersections_df')
+        if columns is None or 'nodes2' in columns:
+            raise RuntimeError("buffer_zones_spec reads nodes2 intersections, which "
+                               "prune_network's contract_chains removes")
+
     zones_df = zones_with_network_nodes(zone_data, network, settings)
-    poi_df = read_pois_table(buffer_zones_settings, network, constants)
+    poi_store = snapping_store_path(settings, buffer_zones_settings.get('cache_pois'))
+    poi_df = read_pois_table(buffer_zones_settings, network, constants, poi_store)
     intersections_df = get_intersections(network)
 
     locals_d = {
         'network': network,
         'node_id': 'net_node_id',
+        'node_idx': 'net_node_idx',
         'zones_df': zones_df,
         'intersections_df': intersections_df,
         'poi_df': poi_df,
@@ -86,9 +127,31 @@ def buffer_zones(settings, buffer_zones_spec,
     else:
         trace_zone_rows = None
 
-    results, trace_results, trace_assigned_locals \
-        = buffer.buffer_variables(buffer_zones_spec, 'zones_df',
-                                  locals_d, trace_rows=trace_zone_rows)
+    result_cache = None
+    if buffer_zones_settings.get('result_cache'):
+        result_cache = open_result_cache(buffer_zones_settings, settings)
+
+    if buffer_zones_settings.get('previous_results'):
+        previous = read_previous_results(buffer_zones_settings, zones_df)
+        results = buffer.rebuffer_variables(
+            buffer_zones_spec, 'zones_df', locals_d, previous,
+            changed_rows=buffer_zones_settings.get('changed_zones'),
+            changed_columns=buffer_zones_settings.get('changed_columns'),
+            radius=buffer_zones_settings.get('rebuffer_radius'),
+            chunk_size=buffer_zones_settings.get('chunk_size'),
+            poi_store=poi_store)
+        trace_results = trace_assigned_locals = None
+        if trace_zones:
+            logger.info('trace_zones are not traced when rebuffering previous_results')
+            trace_zones = None
+    else:
+        results, trace_results, trace_assigned_locals \
+            = buffer.buffer_variables(buffer_zones_spec, 'zones_df',
+                                      locals_d, trace_rows=trace_zone_rows,
+                                      num_processes=buffer_zones_settings.get('num_processes'),
+                                      chunk_size=buffer_zones_settings.get('chunk_size'),
+                                      poi_store=poi_store,
+                                      result_cache=result_cache)
     results.fillna(0, inplace=True)
     add_results_to_zones(results, zones_df, zone_data)
 
@@ -102,19 +165,58 @@ def zones_with_network_nodes(zone_data, network, settings):
 
     # attach the node_id of the nearest network node to each zone
     if 'net_node_id' not in zones_df.columns:
-        zones_df['net_node_id'] = \
-            network.get_node_ids(zones_df[settings['zones_lon']],
-                                 zones_df[settings['zones_lat']])
+        zones_df['net_node_id'] = snap_zones(zones_df, network, settings)['net_node_id']
         inject.add_column('zone_data', 'net_node_id', zones_df['net_node_id'])
 
+    # and its compact position in the network, used to index results to
+    # zones, which is only kept for this step
+    zones_df['net_node_idx'] = ranges.node_positions(network, zones_df['net_node_id'])
+
     return zones_df
 
 
-def read_pois_table(buffer_zones_settings, network, constants):
+def open_result_cache(buffer_zones_settings, settings):
+    """
+    The ResultCache of the result_cache setting, a directory or True for a
+    directory next to the saved network, bounded by result_cache_size MB.
+    """
+    path = buffer_zones_settings['result_cache']
+    if path is True:
+        path = os.path.splitext(network_file_path(settings))[0] + '_results'
+
+    max_size = buffer_zones_settings.get('result_cache_size')
+    if max_size is not None:
+        max_size = int(max_size * 1024 * 1024)
+
+    logger.info('Using result cache %s' % path)
+    return ResultCache(path, max_size=max_size)
+
+
+def read_previous_results(buffer_zones_settings, zones_df):
+    """
+    Read the buffered zones output of an earlier run, a delimited text
+    file or a binary file written by write_daysim_files, indexed like
+    zones_df. It must have every spec target. Without a net_node_id column
+    (write_daysim_files doesn't write one), zones that move to another
+    network node are not found unless they are in changed_zones.
+    """
+    path = config.data_file_path(buffer_zones_settings['previous_results'])
+    if os.path.exists(path + '.json'):
+        previous = read_binary_table(path)
+    else:
+        delimiter = buffer_zones_settings.get('previous_results_delimiter', 'space')
+        previous = pd.read_csv(path, sep=SEP[delimiter])
+
+    return previous.set_index(zones_df.index.name or previous.columns[0])
+
+
+def read_pois_table(buffer_zones_settings, network, constants, poi_store=None):
     poi_fname = config.data_file_path(buffer_zones_settings['pois'])
     poi_df = pd.read_csv(poi_fname, index_col=False)
-    poi_df['net_node_id'] = network.get_node_ids(poi_df[constants['pois-x']].values,
-                                                 poi_df[constants['pois-y']].values)
+    snapped = buffer.snap_points(network, poi_df[constants['pois-x']], poi_df[constants['pois-y']],
+                                 store=poi_store, prefix='poi_table')
+    poi_df['net_node_id'] = snapped['node_id'].values
+    poi_df['net_node_idx'] = ranges.node_positions(network, poi_df['net_node_id'])
 
     return poi_df
 
@@ -131,6 +233,8 @@ def get_intersections(network):
     intersections_df = intersections_df.rename(columns={'net_node_id': 'edge_count'})
     intersections_df.reset_index(0, inplace=True)
     intersections_df = intersections_df.rename(columns={'index': 'net_node_id'})
+    intersections_df['net_node_idx'] = ranges.node_positions(network,
+                                                             intersections_df['net_node_id'])
 
     # add a column for each way count
     intersections_df['nodes1'] = np.where(intersections_df['edge_count'] == 1, 1, 0)
@@ -4,9 +4,10 @@ import os
 import pandana as pdna
 import pandas as pd
 import numpy as np
-import pyproj
 
 from netbuffer.core import buffer
+from netbuffer.core import ranges
+from netbuffer.core.network import snap_zones
 from activitysim.core import tracing
 from activitysim.core import config
 from activitysim.core import inject
@@ -14,6 +15,11 @@ from activitysim.core import pipeline
 
 logger = logging.getLogger(__name__)
 
+NEARBY_ZONES_KEY = 'nearby_zones'
+
+# rows of the nearby zones store read at a time
+STORE_CHUNK_SIZE = 1000000
+
 
 @inject.step()
 def nearby_zones(zone_data, network, settings):
@@ -23,38 +29,101 @@ def nearby_zones(zone_data, network, settings):
     which zones are included in the calculation.
 
     Saves a 'nearby_zones' table to the pipeline with
-    from/to/total_dist columns.
+    from/to/total_dist columns. Network nodes are kept as their int32
+    positions in the network, a_node_idx and b_node_idx, and written as
+    node ids by write_daysim_files.
+
+    Pairs are found with range queries from the network nodes zones are
+    attached to, so memory scales with the number of zone pairs rather
+    than with every network node times the most zones near any node.
+
+    Optional settings:
+
+        - nearby_zones_chunk_size: number of origin nodes processed at a time
+        - nearby_zones_store: output HDF5 file to stream the table to, block
+          by block, instead of saving it to the pipeline
     """
     logger.debug('Running nearby_zones')
 
     # get nearest network node and distance
     zones = get_nearest_network_nodes(zone_data, network, settings)
 
-    # for each network node, count zones within buffer
-    logger.debug('counting zones within buffer')
-    network.set(zones['net_node_id'], name='zone')
-    zones_for_each_net_node = network.aggregate(settings['max_dist'], type='count', name='zone')
-    nearby_zone_count = list(zones_for_each_net_node.loc[zones['net_node_id']].astype(int))
+    # for each zone network node, get the zones within the buffer and their distances
+    logger.debug('finding zone pairs')
+    blocks = ranges.iter_zone_pairs(network, zones['net_node_id'], settings['max_dist'],
+                                    chunk_size=settings.get('nearby_zones_chunk_size'))
 
-    # for each network node, get the zones within the buffer and their distances
-    logger.debug('getting nearest pois')
-    max_num_pois = int(max(nearby_zone_count))
-    network.set_pois(category='zone',
-                     maxdist=settings['max_dist']+1,
-                     maxitems=max_num_pois+1,
-                     x_col=zones[settings['zones_lon']],
-                     y_col=zones[settings['zones_lat']])
+    lookup = ZoneLookup(zones)
+
+    store_path = nearby_zones_store_path()
+    if store_path is None:
+        node_pairs = pd.concat([zone_pairs_block(*block) for block in blocks],
+                               ignore_index=True)
+        pipeline.replace_table('nearby_zones',
+                               build_zone_pairs_df(node_pairs, zones, settings, lookup))
+        return
+
+    # stream blocks of origin nodes to an appendable table on disk
+    logger.info('writing nearby zones to %s' % store_path)
+    num_rows = 0
+    with pd.HDFStore(store_path, mode='w') as store:
+        for block in blocks:
+            zone_pairs = build_zone_pairs_df(zone_pairs_block(*block), zones, settings, lookup)
+            if not zone_pairs.empty:
+                store.append(NEARBY_ZONES_KEY, zone_pairs, index=False)
+                num_rows += len(zone_pairs)
+    logger.info('wrote %s nearby zone pairs' % num_rows)
+
+
+def nearby_zones_store_path():
+    """
+    Output path of the on-disk nearby zones table set by the optional
+    'nearby_zones_store' setting, or None to keep the table in the pipeline.
+    """
+
+    store_fname = config.setting('nearby_zones_store')
+    return config.output_file_path(store_fname) if store_fname else None
+
+
+def iter_nearby_zones(chunk_size=None):
+    """
+    Generate the nearby_zones table in blocks.
+
+    From the nearby zones store if there is one, in blocks of about
+    chunk_size rows that always hold every pair of their origin nodes,
+    otherwise the whole pipeline table as one block.
+
+    Parameters
+    ----------
+    chunk_size : int, optional
+        rows to read at a time, defaults to STORE_CHUNK_SIZE
+
+    Yields
+    ------
+    nearby_zones : pandas.DataFrame
+    """
 
-    all_net_nodes = network.nearest_pois(settings['max_dist'], 'zone',
-                                         num_pois=max_num_pois,
-                                         include_poi_ids=True)
+    store_path = nearby_zones_store_path()
+    if store_path is None:
+        yield pipeline.get_table('nearby_zones')
+        return
 
-    # keep only zone snap nodes
-    nodes_to_keep = zones['net_node_id'].value_counts().index
-    near_zones = all_net_nodes.loc[all_net_nodes.index.isin(nodes_to_keep)]
-    zone_pairs = build_zone_pairs_df(near_zones, max_num_pois, zones, settings)
+    with pd.HDFStore(store_path, mode='r') as store:
+        if NEARBY_ZONES_KEY not in store:
+            return
 
-    pipeline.replace_table('nearby_zones', zone_pairs)
+        # rows are sorted by origin node, hold back the last node of each
+        # chunk until the next chunk, which may have more of its pairs
+        carry = None
+        for chunk in store.select(NEARBY_ZONES_KEY, chunksize=chunk_size or STORE_CHUNK_SIZE):
+            if carry is not None:
+                chunk = pd.concat([carry, chunk])
+            last = (chunk.a_node_idx == chunk.a_node_idx.iat[-1]).values
+            carry = chunk[last]
+            if not last.all():
+                yield chunk[~last]
+        if carry is not None:
+            yield carry
 
 
 def get_nearest_network_nodes(zone_data, network, settings):
@@ -62,69 +131,144 @@ def get_nearest_network_nodes(zone_data, network, settings):
     Updates zone_data table with network data.
 
     Adds the nearest net_node_id for each zone and calculates the
-    distance from the zone centroid to the network node.
+    distance from the zone centroid to the network node. The returned
+    zones also have the node's position in the network, net_node_idx,
+    which is not saved to zone_data.
     """
     logger.debug('saving network info to zones_df')
     zones = zone_data.to_frame()
-    zones['net_node_id'] = network.get_node_ids(zones[settings['zones_lon']],
-                                                zones[settings['zones_lat']])
-    zones['net_node_x'] = list(network.nodes_df.loc[zones['net_node_id']].x)
-    zones['net_node_y'] = list(network.nodes_df.loc[zones['net_node_id']].y)
+    snapped = snap_zones(zones, network, settings)
+    zones['net_node_id'] = snapped['net_node_id']
+    zones['net_node_idx'] = ranges.node_positions(network, zones['net_node_id'])
+    zones['net_node_x'] = network.nodes_df.x.values[zones['net_node_idx']]
+    zones['net_node_y'] = network.nodes_df.y.values[zones['net_node_idx']]
+    zones['net_node_dist'] = snapped['net_node_dist']
 
-    # Use pyproj's latlong projection
-    geod = pyproj.Geod(ellps='WGS84')
-    lon1 = np.asarray(zones[settings['zones_lon']])
-    lat1 = np.asarray(zones[settings['zones_lat']])
-    lon2 = np.asarray(zones['net_node_x'])
-    lat2 = np.asarray(zones['net_node_y'])
-    _, _, net_node_dist = geod.inv(lon1, lat1, lon2, lat2)
+    inject.add_table('zone_data', zones.drop(columns='net_node_idx'), replace=True)
 
-    units = settings.get('distance_units', 'meters')
-    assert units in ['meters', 'miles'], "'distance_units' setting must be 'meters' or 'miles'"
+    return zones
 
-    zones['net_node_dist'] = net_node_dist / 1609.34 if units == 'miles' else net_node_dist
 
-    inject.add_table('zone_data', zones, replace=True)
+def zone_pairs_block(a_node_idx, b_zone_id, node_to_node_dist):
+    return pd.DataFrame({'a_node_idx': a_node_idx,
+                         'b_zone_id': b_zone_id,
+                         'node_to_node_dist': node_to_node_dist})
 
-    return zones
 
+class ZoneLookup(object):
+    """
+    Finds zones by network node and by zone id. The lookups are built once
+    per zones table and used for every block of zone pairs.
 
-def build_zone_pairs_df(near_zones, max_num_pois, zones, settings):
+    Parameters
+    ----------
+    zones : pandas.DataFrame
+        zones with a net_node_idx column
     """
-    Pandana's `nearest_pois` returns a DataFrame with
-        index: node_id
-        column[i]: distance from index node to ith closest poi (zone)
-        column[i*2]: zone id for ith closest poi
+
+    def __init__(self, zones):
+        # zone positions sorted by network node
+        self.node_order = np.argsort(zones.net_node_idx.values, kind='stable')
+        self.sorted_nodes = zones.net_node_idx.values[self.node_order]
+
+        index = zones.index.values
+        self.id_lookup = None
+        if np.issubdtype(index.dtype, np.integer) and len(index) and \
+                index.min() >= 0 and index.max() < 8 * len(index) + 1000000:
+            # integer ids that are dense enough to look up directly
+            self.id_lookup = np.full(index.max() + 1, -1, dtype=np.int64)
+            self.id_lookup[index] = np.arange(len(index))
+        else:
+            self.id_order = np.argsort(index, kind='stable')
+            self.sorted_ids = index[self.id_order]
+
+    def zones_at_nodes(self, nodes):
+        """
+        Find every zone attached to each of a set of network nodes.
+
+        Parameters
+        ----------
+        nodes : numpy.ndarray
+            network node positions to look up, fastest when equal nodes
+            are adjacent
+
+        Returns
+        -------
+        rows : numpy.ndarray of int
+            position in nodes, repeated for each zone at that node
+        zone_pos : numpy.ndarray of int
+            position in zones of each zone
+        """
+
+        # look up each run of equal nodes once
+        starts = np.flatnonzero(np.r_[True, nodes[1:] != nodes[:-1]])
+        run_lengths = np.diff(np.r_[starts, len(nodes)])
+        first = np.searchsorted(self.sorted_nodes, nodes[starts], side='left')
+        counts = np.searchsorted(self.sorted_nodes, nodes[starts], side='right') - first
+
+        counts = np.repeat(counts, run_lengths)
+        first = np.repeat(first, run_lengths)
+
+        rows = np.repeat(np.arange(len(nodes)), counts)
+        offsets = np.repeat(first - (np.cumsum(counts) - counts), counts)
+        zone_pos = self.node_order[offsets + np.arange(len(rows))]
+
+        return rows, zone_pos
+
+    def zone_positions(self, zone_ids):
+        """
+        Position in zones of each of zone_ids, which must all be zones.
+        """
+
+        if self.id_lookup is not None:
+            return self.id_lookup[zone_ids]
+
+        return self.id_order[np.searchsorted(self.sorted_ids, zone_ids)]
+
+
+def build_zone_pairs_df(zone_pairs, zones, settings, lookup=None):
+    """
+    Add zone ids, connector distances and total distances to the
+    network node to zone pairs found by ranges.iter_zone_pairs:
+        a_node_idx: origin network node position
+        b_zone_id: destination zone id
+        node_to_node_dist: network distance between the zones' nodes
+
+    Each pair is expanded to every zone attached to its origin node.
+    lookup is the ZoneLookup of zones, built if not given.
     """
     logger.debug('building zone pairs distance table')
-    dists_cols = near_zones.columns[:max_num_pois]
-    zones_cols = near_zones.columns[max_num_pois:max_num_pois*2]
-    dists_df = near_zones[dists_cols].copy()
-    zones_df = near_zones[zones_cols].copy()
 
-    zone_pairs = pd.DataFrame()
-    zone_pairs['a_node_id'] = np.repeat(near_zones.index, max_num_pois)
-    zone_pairs['b_zone_id'] = zones_df.values.reshape(len(near_zones.index) * max_num_pois)
-    zone_pairs['node_to_node_dist'] = dists_df.values.reshape(len(near_zones.index) * max_num_pois)
+    if lookup is None:
+        lookup = ZoneLookup(zones)
 
-    # drop rows with dist==max_dist and with no to_zone
-    zone_pairs = zone_pairs[zone_pairs.node_to_node_dist != settings['max_dist']].dropna()
-    zone_pairs['b_zone_id'] = zone_pairs['b_zone_id'].astype('int')
+    a_node_idx = zone_pairs.a_node_idx.values
+    b_zone_id = zone_pairs.b_zone_id.values
+    node_to_node_dist = zone_pairs.node_to_node_dist.values
 
-    # add zone/node ids
-    zone_pairs['a_zone_id'] = zone_pairs['a_node_id'].map(dict(zip(zones.net_node_id, zones.index)))
-    zone_pairs['b_node_id'] = zone_pairs['b_zone_id'].map(zones.net_node_id)
+    # drop rows with dist==max_dist
+    keep = node_to_node_dist != settings['max_dist']
+    a_node_idx, b_zone_id, node_to_node_dist = \
+        a_node_idx[keep], b_zone_id[keep], node_to_node_dist[keep]
 
-    # add connector distances
-    zone_pairs['a_connector_dist'] = zone_pairs['a_zone_id'].map(zones.net_node_dist)
-    zone_pairs['b_connector_dist'] = zone_pairs['b_zone_id'].map(zones.net_node_dist)
+    rows, a_zone_pos = lookup.zones_at_nodes(a_node_idx)
+    b_zone_pos = lookup.zone_positions(b_zone_id)[rows]
+    connector_dist = zones.net_node_dist.values
 
     # calculate total zone-to-zone distance and reduce set
-    zone_pairs['total_dist'] = \
-        zone_pairs['a_connector_dist'] + \
-        zone_pairs['node_to_node_dist'] + \
-        zone_pairs['b_connector_dist']
+    total_dist = connector_dist[a_zone_pos] + node_to_node_dist[rows] + connector_dist[b_zone_pos]
+    keep = total_dist < settings['max_dist']
+    rows, a_zone_pos, b_zone_pos = rows[keep], a_zone_pos[keep], b_zone_pos[keep]
 
-    zone_pairs = zone_pairs.loc[zone_pairs['total_dist'] < settings['max_dist']]
+    zone_pairs = pd.DataFrame({
+        'a_node_idx': a_node_idx[rows],
+        'b_zone_id': b_zone_id[rows],
+        'node_to_node_dist': node_to_node_dist[rows],
+        'a_zone_id': zones.index.values[a_zone_pos],
+        'b_node_idx': zones.net_node_idx.values[b_zone_pos],
+        'a_connector_dist': connector_dist[a_zone_pos],
+        'b_connector_dist': connector_dist[b_zone_pos],
+        'total_dist': total_dist[keep],
+    })
 
     return zone_pairs
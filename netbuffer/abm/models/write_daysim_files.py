@@ -1,4 +1,7 @@
+import functools
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 import numpy as np
@@ -7,6 +10,10 @@ from activitysim.core import config
 from activitysim.core import inject
 from activitysim.core import pipeline
 
+from netbuffer.abm.models.nearby_zones import iter_nearby_zones, nearby_zones_store_path
+from netbuffer.core import ranges
+from netbuffer.core.writers import open_writer
+
 logger = logging.getLogger(__name__)
 
 SEP = {
@@ -15,6 +22,9 @@ SEP = {
     'comma': ','
 }
 
+# pipeline tables and the nearby zones store are read by one thread at a time
+read_lock = threading.Lock()
+
 
 @inject.step()
 def write_daysim_files():
@@ -25,12 +35,17 @@ def write_daysim_files():
 
     nearby_zones:
       - outfile: filename
+      - format: 'csv' (default), 'text', 'binary', 'parquet' or 'feather'
+      - compression: optional, 'gzip' or 'zstd'
       - delimiter: 'comma', 'space', or 'tab'
       - header: bool, whether to include column headers
       - cols: list of columns from nearby zones to include.
 
     Nearby zones column options are 'from', 'to', 'distance',
-    'net_node_dist', 'net_node_dist_to_zone', 'total_dist'.
+    'net_node_dist', 'net_node_dist_to_zone', 'total_dist'. The
+    a_node_id and b_node_id network node ids are looked up from the
+    a_node_idx and b_node_idx node positions of the table as it is
+    written.
 
     buffered_zones:
       - outfile: filename
@@ -39,6 +54,16 @@ def write_daysim_files():
       - cols: list of columns to include from buffered zones.
 
     Buffered zone column names must match the input zones table.
+
+    The csv format is written by pandas, text is the same delimited text
+    formatted with numpy, much faster for large integer tables, binary is
+    raw little-endian records described by a .json file next to them, and
+    parquet and feather require pyarrow. The network_files outputs take
+    the same format and compression settings. See netbuffer.core.writers.
+
+    With write_threads set above 1, the nearby zones, buffered zones and
+    network files are written at the same time, and text files are
+    formatted and compressed by that many threads each.
     """
     daysim_settings = config.read_model_settings('daysim_files.yaml')
 
@@ -46,103 +71,260 @@ def write_daysim_files():
     buffer_zones_settings = daysim_settings.get('buffered_zones')
     network_file_settings = daysim_settings.get('network_files')
 
+    threads = daysim_settings.get('write_threads', 1)
+
+    tasks = []
     if nearby_zones_settings:
-        write_pipeline_table(nearby_zones_settings, 'nearby_zones')
+        tasks.append(functools.partial(
+            write_pipeline_table, nearby_zones_settings, 'nearby_zones', threads))
 
     if buffer_zones_settings:
-        write_pipeline_table(buffer_zones_settings, 'zone_data')
+        tasks.append(functools.partial(
+            write_pipeline_table, buffer_zones_settings, 'zone_data', threads))
 
     if network_file_settings:
-        write_network_files(network_file_settings)
+        tasks.append(functools.partial(write_network_files, network_file_settings, threads))
+
+    if threads > 1 and len(tasks) > 1:
+        with ThreadPoolExecutor(len(tasks)) as pool:
+            for future in [pool.submit(task) for task in tasks]:
+                future.result()
+    else:
+        for task in tasks:
+            task()
 
 
-def write_pipeline_table(file_settings, pipeline_table):
+def locked_blocks(blocks):
+    """
+    Generate blocks, reading each while holding read_lock so files written
+    at the same time take turns reading the pipeline and HDF5 stores.
+    """
+    blocks = iter(blocks)
+    while True:
+        with read_lock:
+            block = next(blocks, None)
+        if block is None:
+            return
+        yield block
+
+
+def write_pipeline_table(file_settings, pipeline_table, threads=1):
     """
     Writes output files according to user settings.
 
+    The nearby_zones table is written block by block when it was streamed
+    to disk, see nearby_zones.iter_nearby_zones.
+
     Parameters
     ----------
     file_settings : dict
         cols : pipeline_table columns to include in output
+        format : str, output format, see netbuffer.core.writers.WRITERS
         delimiter : str, either 'comma', 'space', or 'tab'
         col_types : dict, col/type mapping (python or numpy dtypes)
         outfile : output file name
         header : bool, whether to include header row in output
+        compression : str, optional, 'gzip' or 'zstd'
+    threads : int
+        formatting threads of text formats
     """
-    df = pipeline.get_table(pipeline_table)
-    drop_index = df.index.name is None
-    df.reset_index(drop=drop_index, inplace=True)
-    expected_cols = file_settings.get('cols', [])
+    if pipeline_table == 'nearby_zones':
+        blocks = iter_nearby_zones()
+    else:
+        blocks = [pipeline.get_table(pipeline_table)]
 
-    for col in list(expected_cols):
-        if col not in df:
-            logger.warn('%s table is missing %s column' % (pipeline_table, col))
-            expected_cols.remove(col)
+    expected_cols = file_settings.get('cols', [])
 
+    # nearby zones keep node positions, written as node ids
+    node_ids = None
+    if pipeline_table == 'nearby_zones' and \
+            {'a_node_id', 'b_node_id'}.intersection(expected_cols):
+        with read_lock:
+            node_ids = inject.get_injectable('network').node_ids.values
     col_types = file_settings.get('col_types')
-    df_to_write = df[expected_cols].astype(col_types)
-
-    outfile = file_settings.get('outfile')
     header = file_settings.get('header', True)
     delimiter = file_settings.get('delimiter', 'comma')
 
-    df_to_write.to_csv(config.output_file_path(outfile),
-                       sep=SEP[delimiter],
+    with file_writer(file_settings, header, delimiter, threads) as writer:
+        for i, df in enumerate(locked_blocks(blocks)):
+            drop_index = df.index.name is None
+            df = df.reset_index(drop=drop_index)
+            if node_ids is not None:
+                df['a_node_id'] = node_ids[df['a_node_idx'].values]
+                df['b_node_id'] = node_ids[df['b_node_idx'].values]
+
+            if i == 0:
+                for col in list(expected_cols):
+                    if col not in df:
+                        logger.warn('%s table is missing %s column' % (pipeline_table, col))
+                        expected_cols.remove(col)
+
+            writer.write(df[expected_cols].astype(col_types))
+
+
+def file_writer(file_settings, header=True, delimiter='space', threads=1):
+    """
+    Open a writer for an output file.
+
+    Parameters
+    ----------
+    file_settings : dict
+        outfile : output file name
+        format : str, optional, 'csv' by default
+        compression, compression_level : optional
+    header : bool
+    delimiter : str, default delimiter if not in file_settings
+    threads : int
+        formatting threads of text formats
+
+    Returns
+    -------
+    netbuffer.core.writers.TableWriter
+    """
+    format = file_settings.get('format', 'csv')
+    options = {'threads': threads} if format in ('csv', 'text') else {}
+    return open_writer(config.output_file_path(file_settings.get('outfile')),
+                       format=format,
+                       delimiter=SEP[file_settings.get('delimiter', delimiter)],
                        header=header,
-                       index=False)
+                       compression=file_settings.get('compression'),
+                       compression_level=file_settings.get('compression_level'),
+                       **options)
 
 
-def write_network_files(network_file_settings):
+def write_network_files(network_file_settings, threads=1):
     ztn_settings = network_file_settings.get('zone_to_node')
     nd_settings = network_file_settings.get('node_distances')
     ni_settings = network_file_settings.get('node_indices')
 
-    nearby_zones_df = pipeline.get_table('nearby_zones')
-    zone_nodes = pipeline.get_table('zone_data')['net_node_id']  # zone id to OSM node mapping
+    with read_lock:
+        zone_nodes = pipeline.get_table('zone_data')['net_node_id']  # zone id to OSM node mapping
+        network = inject.get_injectable('network')
+    streaming = nearby_zones_store_path() is not None
+
+    # output id of each network node position
+    node_ids = network.node_ids.values
 
     # The OSM node ids can get very big. Provide a way to remap
     # them to smaller values in the output files.
     if network_file_settings.get('remap_osm_ids', False):
         unique_nodes = zone_nodes.unique()
-        remap = dict(zip(unique_nodes, np.arange(1, len(unique_nodes) + 1)))
-        zone_nodes = zone_nodes.map(remap)
-        nearby_zones_df['a_node_id'] = nearby_zones_df['a_node_id'].map(remap)
-        nearby_zones_df['b_node_id'] = nearby_zones_df['b_node_id'].map(remap)
+        if streaming:
+            # keep the blocks of the nearby zones store, which are in node id order, sorted
+            unique_nodes = np.sort(unique_nodes)
+        node_ids = np.zeros(len(node_ids), dtype=np.int64)
+        node_ids[ranges.node_positions(network, unique_nodes)] = \
+            np.arange(1, len(unique_nodes) + 1)
+        zone_nodes = pd.Series(node_ids[ranges.node_positions(network, zone_nodes)],
+                               index=zone_nodes.index, name=zone_nodes.name)
 
     if ztn_settings:
-        zone_nodes.to_csv(config.output_file_path(ztn_settings.get('outfile')),
-                          sep=SEP[ztn_settings.get('delimiter', 'space')],
-                          header=False,
-                          index=True)
+        with file_writer(ztn_settings, header=False, threads=threads) as writer:
+            writer.write(zone_nodes.reset_index())
 
-    if nd_settings:
-        nodes = pd.DataFrame()
+    if not nd_settings:
+        return
 
-        nodes['onode'] = nearby_zones_df.a_node_id
-        nodes['dnode'] = nearby_zones_df.b_node_id
+    nd_writer = file_writer(nd_settings, threads=threads)
+    ni_writer = file_writer(ni_settings, threads=threads) if ni_settings else None
+    try:
+        write_node_distances(node_ids, nd_writer, ni_writer)
+    finally:
+        nd_writer.close()
+        if ni_writer:
+            ni_writer.close()
 
-        units = config.setting('distance_units', default='miles')
-        conversion = 5280 if units == 'miles' else 3.28084
 
-        nodes['feet'] = nearby_zones_df.node_to_node_dist * conversion
-        nodes = nodes.drop_duplicates(ignore_index=True).sort_values(by=['onode', 'dnode'])
-        nodes = nodes[nodes['onode'] != nodes['dnode']]
+def pair_keys(onode, dnode):
+    """
+    Integer keys that sort node pairs by origin and then destination node.
+    """
+    omin, dmin = int(onode.min()), int(dnode.min())
+    span = int(dnode.max()) - dmin + 1
+    if (int(onode.max()) - omin + 1) * span < 2 ** 63:
+        return (onode.astype(np.int64) - omin) * span + (dnode.astype(np.int64) - dmin)
 
-        nodes.astype('int64').to_csv(config.output_file_path(nd_settings.get('outfile')),
-                                     sep=SEP[nd_settings.get('delimiter', 'space')],
-                                     header=True,
-                                     index=False)
+    # too far apart, as OSM ids can be, so number the nodes in order first
+    nodes, codes = np.unique(np.concatenate([onode, dnode]), return_inverse=True)
+    return codes[:len(onode)].astype(np.int64) * len(nodes) + codes[len(onode):]
 
-        if not ni_settings:
-            return
 
-        nodes['seq'] = np.arange(1, nodes.shape[0] + 1)
-        index_df = pd.DataFrame(index=nodes['onode'].unique())
-        index_df['firstrec'] = nodes.groupby('onode').first()['seq']
-        index_df['lastrec'] = nodes.groupby('onode').last()['seq']
-        index_df.index.name = 'node_Id'
-        index_df.fillna(0).astype('int64').to_csv(
-            config.output_file_path(ni_settings.get('outfile')),
-            sep=SEP[ni_settings.get('delimiter', 'space')],
-            header=True,
-            index=True)
+def node_distance_csr(onode, dnode, feet):
+    """
+    Sort node pairs by origin node into a compressed sparse row layout,
+    dropping duplicate pairs and pairs of a node with itself.
+
+    Parameters
+    ----------
+    onode, dnode, feet : numpy.ndarray
+
+    Returns
+    -------
+    origins : numpy.ndarray
+        distinct origin nodes, in order
+    offsets : numpy.ndarray of int64
+        the pairs of origins[i] are rows offsets[i] to offsets[i + 1] - 1
+    onode, dnode, feet : numpy.ndarray
+        pairs sorted by origin and destination node
+    """
+    if len(onode) == 0:
+        return onode, np.zeros(1, dtype=np.int64), onode, dnode, feet
+
+    # sorting a single integer key per pair is much faster than lexsort
+    keys = pair_keys(onode, dnode)
+    order = np.argsort(keys)
+    key, dist = keys[order], feet[order]
+    same_pair = key[1:] == key[:-1]
+    if (dist[1:] != dist[:-1])[same_pair].any():
+        # a pair with different distances, which have to be in order too
+        order = np.argsort(feet)
+        order = order[np.argsort(keys[order], kind='stable')]
+        key, dist = keys[order], feet[order]
+        same_pair = key[1:] == key[:-1]
+
+    # duplicates are next to each other, and only the rows kept are gathered
+    keep = np.r_[True, ~same_pair | (dist[1:] != dist[:-1])]
+    order = order[keep]
+    onode, dnode, feet = onode[order], dnode[order], dist[keep]
+
+    keep = onode != dnode
+    onode, dnode, feet = onode[keep], dnode[keep], feet[keep]
+
+    starts = np.flatnonzero(np.r_[True, onode[1:] != onode[:-1]]) if len(onode) else \
+        np.empty(0, dtype=np.int64)
+    offsets = np.append(starts, len(onode)).astype(np.int64)
+
+    return onode[starts], offsets, onode, dnode, feet
+
+
+def write_node_distances(node_ids, nd_writer, ni_writer):
+    """
+    Write the node to node distances of nearby_zones, and the range of
+    records of each origin node if ni_writer is given. node_ids is the
+    output id of each network node position.
+
+    Both come from the same sorted pairs: NodeIndex records are the
+    offsets of each origin node's pairs in NodeDistances.
+    """
+    units = config.setting('distance_units', default='miles')
+    conversion = 5280 if units == 'miles' else 3.28084
+
+    # every pair of an origin node is in the same block, so blocks can be
+    # deduplicated, sorted and indexed on their own
+    num_records = 0
+    for nearby_zones_df in locked_blocks(iter_nearby_zones()):
+        onode = node_ids[nearby_zones_df['a_node_idx'].values]
+        dnode = node_ids[nearby_zones_df['b_node_idx'].values]
+
+        origins, offsets, onode, dnode, feet = node_distance_csr(
+            onode, dnode, nearby_zones_df['node_to_node_dist'].values * conversion)
+
+        nd_writer.write(pd.DataFrame({'onode': onode.astype('int64'),
+                                      'dnode': dnode.astype('int64'),
+                                      'feet': feet.astype('int64')}))
+
+        if ni_writer:
+            ni_writer.write(pd.DataFrame({'node_Id': origins.astype('int64'),
+                                          'firstrec': num_records + offsets[:-1] + 1,
+                                          'lastrec': num_records + offsets[1:]}))
+        num_records += len(onode)
@@ -0,0 +1,107 @@
+import os.path
+
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pandana as pdna
+import pytest
+
+from netbuffer.core import ranges
+
+try:
+    from netbuffer.abm.models import nearby_zones
+except ImportError as err:
+    # the abm models need a full activitysim install
+    pytest.skip('netbuffer.abm unavailable: %s' % err, allow_module_level=True)
+
+
+MAX_DIST = 3000
+
+
+@pytest.fixture(scope='module')
+def network():
+    net_name = os.path.join(os.path.dirname(__file__), '..', '..', 'core', 'tests', 'data',
+                            'test_net.h5')
+    return pdna.Network.from_hdf5(net_name)
+
+
+def shared_node_zones(network, zone_ids):
+    # three zones at each of a set of network nodes, at different distances
+    rng = np.random.RandomState(0)
+    node_ids = rng.choice(network.node_ids.values, len(zone_ids) // 3, replace=False)
+    return pd.DataFrame({'net_node_id': np.repeat(node_ids, 3),
+                         'net_node_idx': ranges.node_positions(network, np.repeat(node_ids, 3)),
+                         'net_node_dist': rng.uniform(0, 300, len(zone_ids))},
+                        index=pd.Index(zone_ids, name='zone_id'))
+
+
+def merged_zone_pairs(node_pairs, zones):
+    """
+    The zone pairs table built with pandas merges.
+    """
+    a = zones[['net_node_idx', 'net_node_dist']].reset_index().rename(
+        columns={'zone_id': 'a_zone_id', 'net_node_idx': 'a_node_idx',
+                 'net_node_dist': 'a_connector_dist'})
+    b = zones[['net_node_idx', 'net_node_dist']].reset_index().rename(
+        columns={'zone_id': 'b_zone_id', 'net_node_idx': 'b_node_idx',
+                 'net_node_dist': 'b_connector_dist'})
+
+    pairs = node_pairs[node_pairs.node_to_node_dist != MAX_DIST]
+    pairs = pairs.merge(a, on='a_node_idx').merge(b, on='b_zone_id')
+    pairs['total_dist'] = pairs.a_connector_dist + pairs.node_to_node_dist + \
+        pairs.b_connector_dist
+    return pairs[pairs.total_dist < MAX_DIST]
+
+
+def sort_pairs(df):
+    columns = ['a_node_idx', 'b_zone_id', 'node_to_node_dist', 'a_zone_id', 'b_node_idx',
+               'a_connector_dist', 'b_connector_dist', 'total_dist']
+    return df[columns].sort_values(['a_zone_id', 'b_zone_id']).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('zone_ids', [np.arange(1, 91), np.arange(90) * 10 ** 12 + 7])
+def test_build_zone_pairs_df(network, zone_ids):
+
+    zones = shared_node_zones(network, zone_ids)
+    node_pairs = pd.concat([nearby_zones.zone_pairs_block(*block) for block in
+                            ranges.iter_zone_pairs(network, zones.net_node_id, MAX_DIST)],
+                           ignore_index=True)
+
+    zone_pairs = nearby_zones.build_zone_pairs_df(node_pairs, zones, {'max_dist': MAX_DIST})
+
+    # every origin node pair is expanded to all three zones at the node
+    expected = merged_zone_pairs(node_pairs, zones)
+    assert len(expected) > len(zones)
+    assert (expected.groupby('a_node_idx').a_zone_id.nunique() == 3).all()
+    pd.testing.assert_frame_equal(sort_pairs(zone_pairs), sort_pairs(expected))
+
+    # nodes are kept as their positions in the network
+    assert zone_pairs.a_node_idx.dtype == zone_pairs.b_node_idx.dtype == np.int32
+    npt.assert_array_equal(network.node_ids.values[zone_pairs.b_node_idx],
+                           zones.net_node_id.loc[zone_pairs.b_zone_id])
+
+
+def test_iter_nearby_zones(network, tmpdir, monkeypatch):
+
+    zones = shared_node_zones(network, np.arange(1, 91))
+    store_path = str(tmpdir.join('nearby_zones.h5'))
+    monkeypatch.setattr(nearby_zones, 'nearby_zones_store_path', lambda: store_path)
+
+    # streamed to the store as the nearby_zones step does, a few origin nodes at a time
+    blocks = []
+    with pd.HDFStore(store_path, mode='w') as store:
+        for block in ranges.iter_zone_pairs(network, zones.net_node_id, MAX_DIST, chunk_size=4):
+            zone_pairs = nearby_zones.build_zone_pairs_df(
+                nearby_zones.zone_pairs_block(*block), zones, {'max_dist': MAX_DIST})
+            store.append(nearby_zones.NEARBY_ZONES_KEY, zone_pairs, index=False)
+            blocks.append(zone_pairs)
+    expected = pd.concat(blocks, ignore_index=True)
+
+    # read back in chunks smaller than the pairs of most origin nodes
+    chunks = list(nearby_zones.iter_nearby_zones(chunk_size=7))
+    assert len(chunks) > 1
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), expected)
+
+    # every pair of an origin node is in the same chunk
+    origins = [chunk.a_node_idx.unique() for chunk in chunks]
+    assert len(np.concatenate(origins)) == expected.a_node_idx.nunique()
@@ -0,0 +1,76 @@
+import os.path
+
+import numpy as np
+import pandas as pd
+import pandana as pdna
+import pytest
+
+from netbuffer.core import ranges
+
+try:
+    from netbuffer.abm.models import write_daysim_files
+except ImportError as err:
+    # the abm models need a full activitysim install. This directory is not a
+    # package, so importing netbuffer.abm happens here rather than on collection
+    pytest.skip('netbuffer.abm unavailable: %s' % err, allow_module_level=True)
+
+
+@pytest.fixture(scope='module')
+def node_pairs():
+    net_name = os.path.join(os.path.dirname(__file__), '..', '..', 'core', 'tests', 'data',
+                            'test_net.h5')
+    network = pdna.Network.from_hdf5(net_name)
+    origins = network.node_ids.values[::4]
+    origin_pos, dest_pos, dist = [np.concatenate(arrays) for arrays in zip(
+        *ranges.iter_range_pairs(network, 3000, origins, chunk_size=50))]
+    pairs = pd.DataFrame({'onode': origins[origin_pos],
+                          'dnode': network.node_ids.values[dest_pos],
+                          'feet': dist})
+
+    # some pairs repeat, as pairs of neighbouring zones on the same nodes do
+    pairs = pd.concat([pairs, pairs.sample(frac=0.2, random_state=0)], ignore_index=True)
+    return pairs.sample(frac=1, random_state=1).reset_index(drop=True)
+
+
+def groupby_node_distances(nodes, num_records=0):
+    """
+    NodeDistances and NodeIndex as they were built before the CSR layout.
+    """
+    nodes = nodes.drop_duplicates(ignore_index=True).sort_values(by=['onode', 'dnode'])
+    nodes = nodes[nodes['onode'] != nodes['dnode']]
+
+    nodes['seq'] = np.arange(num_records + 1, num_records + nodes.shape[0] + 1)
+    index_df = pd.DataFrame(index=nodes['onode'].unique())
+    index_df['firstrec'] = nodes.groupby('onode').first()['seq']
+    index_df['lastrec'] = nodes.groupby('onode').last()['seq']
+    index_df.index.name = 'node_Id'
+
+    return nodes.drop(columns='seq'), index_df.reset_index()
+
+
+def test_node_distance_csr(node_pairs):
+
+    expected_nd, expected_ni = groupby_node_distances(node_pairs)
+    assert len(expected_nd) < len(node_pairs)
+
+    origins, offsets, onode, dnode, feet = write_daysim_files.node_distance_csr(
+        node_pairs.onode.values, node_pairs.dnode.values, node_pairs.feet.values)
+
+    np.testing.assert_array_equal(onode, expected_nd.onode.values)
+    np.testing.assert_array_equal(dnode, expected_nd.dnode.values)
+    np.testing.assert_array_equal(feet, expected_nd.feet.values)
+    np.testing.assert_array_equal(origins, expected_ni.node_Id.values)
+    np.testing.assert_array_equal(offsets[:-1] + 1, expected_ni.firstrec.values)
+    np.testing.assert_array_equal(offsets[1:], expected_ni.lastrec.values)
+
+
+def test_pair_keys():
+
+    # ids too far apart for offsets, as OSM ids can be
+    onode = np.array([2 ** 62, 5, 5, 2 ** 62], dtype=np.int64)
+    dnode = np.array([-2 ** 62, 7, 2 ** 62, 3], dtype=np.int64)
+    keys = write_daysim_files.pair_keys(onode, dnode)
+    assert list(np.argsort(keys)) == [1, 2, 0, 3]
+
+    keys = write_daysim_files.pair_keys(np.array([3, 1, 3]), np.array([1, 9, 0]))
+    assert list(np.argsort(keys)) == [1, 2, 0]
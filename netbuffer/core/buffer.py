@@ -1,11 +1,17 @@
-
-
+import ast
+import hashlib
+import inspect
 import logging
+import marshal
+import multiprocessing
 import os
+import weakref
 
 import numpy as np
 import pandas as pd
+import pandana as pdna
 
+from netbuffer.core import ranges
 
 logger = logging.getLogger(__name__)
 
@@ -104,6 +110,1293 @@ def read_buffer_spec(fname,
     return cfg
 
 
+def data_fingerprint(*objs, index=False):
+    """
+    Compute a content hash for a set of pandas objects or arrays.
+
+    Used to tell whether the data registered under a network variable
+    name has actually changed between calls.
+
+    Parameters
+    ----------
+    objs : pandas.Series, pandas.DataFrame or array-like
+    index : bool, optional
+        include the index of pandas objects in the hash
+
+    Returns
+    -------
+    fingerprint : str
+        hex digest of the hashed values
+    """
+
+    h = hashlib.sha1()
+    for obj in objs:
+        if obj is None:
+            h.update(b'None')
+            continue
+        if not isinstance(obj, (pd.Series, pd.DataFrame)):
+            obj = pd.Series(np.asanyarray(obj))
+        h.update(pd.util.hash_pandas_object(obj, index=index).values.tobytes())
+    return h.hexdigest()
+
+
+# network fingerprints by network, hashing a network's edges is not free
+network_fingerprints = weakref.WeakKeyDictionary()
+
+
+def network_fingerprint(network):
+    """
+    Content hash of a Pandana network's nodes and edges, computed once per
+    network object. Edge labels are left out, they play no part in routing.
+    """
+
+    if network not in network_fingerprints:
+        network_fingerprints[network] = \
+            data_fingerprint(network.nodes_df.index, network.nodes_df, network.edges_df)
+    return network_fingerprints[network]
+
+
+def stored_frame(store_path, key, compute):
+    """
+    DataFrame kept under `key` in an HDF5 store, computed and saved there
+    the first time it is asked for.
+
+    Parameters
+    ----------
+    store_path : str
+        path of the HDF5 file, created if it does not exist
+    key : str
+    compute : callable
+        returns the pandas.DataFrame to store
+
+    Returns
+    -------
+    df : pandas.DataFrame
+    """
+
+    with pd.HDFStore(store_path) as store:
+        if '/' + key in store.keys():
+            return store[key]
+
+    df = compute()
+
+    logger.info("saving %s rows to %s in %s" % (len(df), key, store_path))
+    with pd.HDFStore(store_path) as store:
+        store[key] = df
+
+    return df
+
+
+def snap_points(network, x_col, y_col, store=None, prefix='points', fingerprint=None):
+    """
+    Nearest network node of each point and the distance to it, as
+    pandana.Network.get_node_ids finds them.
+
+    Parameters
+    ----------
+    network : pandana.Network
+    x_col, y_col : pandas.Series
+        point coordinates
+    store : str, optional
+        HDF5 file in which to keep the snapped points, so later calls for
+        the same points on the same network skip the nearest node search
+    prefix : str, optional
+        store key prefix, the key is completed by the network and point
+        fingerprints
+    fingerprint : str, optional
+        data_fingerprint of x_col and y_col with their index, if known
+
+    Returns
+    -------
+    nodes : pandas.DataFrame
+        node_id and distance columns, indexed like x_col
+    """
+
+    def snap():
+        xys = pd.DataFrame({'x': x_col, 'y': y_col})
+        distances, indexes = network.kdtree.query(xys.values.astype(np.float64))
+        return pd.DataFrame({'node_id': network.nodes_df.index[indexes[:, 0]],
+                             'distance': distances[:, 0]}, index=xys.index)
+
+    if store is None:
+        return snap()
+
+    if fingerprint is None:
+        fingerprint = data_fingerprint(x_col, y_col, index=True)
+    key = '%s_%s_%s' % (prefix, network_fingerprint(network)[:16], fingerprint[:16])
+
+    return stored_frame(store, key, snap)
+
+
+def initialize_pois(network, category, maxdist, maxitems, node_ids):
+    """
+    Same as pandana.Network.set_pois, for POIs already snapped to node_ids.
+
+    Parameters
+    ----------
+    network : pandana.Network
+    category : str
+    maxdist : float
+    maxitems : int
+    node_ids : pandas.Series
+        network node id of each POI, indexed by POI
+    """
+
+    if category not in network.poi_category_names:
+        network.poi_category_names.append(category)
+    network.max_pois = maxitems
+    network.poi_category_indexes[category] = node_ids.index
+
+    node_idx = network._node_indexes(node_ids)
+    network.net.initialize_category(maxdist, maxitems, category.encode('utf-8'),
+                                    node_idx.values.astype(np.int64))
+
+
+# pandana accepts a few aliases for aggregation types
+AGGREGATION_ALIASES = {
+    'ave': 'mean',
+    'avg': 'mean',
+    'average': 'mean',
+    'stddev': 'std',
+    'med': 'median',
+}
+
+
+class CachedNetwork(object):
+    """
+    Wrap a Pandana network to memoize aggregate queries and add
+    distance band (ring) aggregation.
+
+    Aggregate results are keyed on ('aggregate', variable name, variable
+    data version, distance, type, decay, impedance), and bands and
+    nearest_pois results on similar tuples starting with 'bands' and
+    'pois' (see query_key). The data version of a variable is the
+    fingerprint of the node ids and values last passed to `set` under that
+    name, so setting new data for a name invalidates its cached results
+    while re-setting identical data does not.
+
+    Variables are only registered with the wrapped network (which
+    re-sorts and sums them to nodes) when a Pandana aggregate needs them,
+    and not again while the same data stays loaded under their name.
+
+    All other attributes are delegated to the wrapped network so the
+    object can be used in spec expressions in place of the network.
+
+    Parameters
+    ----------
+    network : pandana.Network
+    origins : array-like of node ids, optional
+        nodes at which band sums and batchable aggregates are computed,
+        defaults to every node in the network (in which case aggregates
+        are left to Pandana)
+    chunk_size : int, optional
+        number of origins whose range queries are held in memory at once,
+        see ranges.iter_range_pairs
+    poi_store : str, optional
+        path of an HDF5 file in which to keep the network nodes POIs snap
+        to, so later runs on the same network skip snapping them
+    """
+
+    def __init__(self, network, origins=None, chunk_size=None, poi_store=None):
+        self.network = network
+        # a single index shared by every batched result, so zone lookups
+        # into them can be reused
+        self.origins = None if origins is None else pd.Index(origins)
+        self.chunk_size = chunk_size
+        self.poi_store = poi_store
+        self.pois = {}
+        self.poi_loaded = {}
+        self.poi_sets = 0
+        self.poi_loads = 0
+        self.versions = {}
+        self.variables = {}
+        self.loaded = {}
+        self.cache = {}
+        self.sets = 0
+        self.loads = 0
+        self.hits = 0
+        self.misses = 0
+        self.batched = 0
+
+    def __getattr__(self, name):
+        return getattr(self.network, name)
+
+    def set(self, node_ids, variable=None, name='tmp'):
+        version = data_fingerprint(node_ids, variable)
+        if self.versions.get(name) != version:
+            # new data for this name, drop results computed on the old data,
+            # but not those of a POI category sharing the name
+            self.cache = {k: v for k, v in self.cache.items()
+                          if k[0] not in ['aggregate', 'bands'] or k[1] != name or
+                          k[2] == version}
+            self.versions[name] = version
+            self.variables[name] = (node_ids, variable)
+        self.sets += 1
+
+    def load(self, name):
+        """
+        Register the data last `set` under name with the wrapped network,
+        unless it is already loaded.
+        """
+
+        version = self.versions[name]
+        if self.loaded.get(name) != version:
+            node_ids, variable = self.variables[name]
+            self.network.set(node_ids, variable=variable, name=name)
+            self.loaded[name] = version
+            self.loads += 1
+
+    def set_pois(self, category=None, maxdist=None, maxitems=None, x_col=None, y_col=None,
+                 mapping_distance=None):
+        """
+        Same as pandana.Network.set_pois, except that a category is only
+        registered with the wrapped network when a Pandana nearest_pois
+        query needs it, and not again while its parameters and POI
+        locations stay the same.
+        """
+
+        key = (maxdist, maxitems, mapping_distance, data_fingerprint(x_col, y_col, index=True))
+        if self.pois.get(category, (None, None))[0] != key:
+            self.pois[category] = (key, dict(maxdist=maxdist, maxitems=maxitems,
+                                             x_col=x_col, y_col=y_col,
+                                             mapping_distance=mapping_distance))
+        self.poi_sets += 1
+
+    def load_pois(self, category):
+        """
+        Register a POI category last `set_pois` with the wrapped network,
+        unless it is already loaded.
+        """
+
+        key, params = self.pois[category]
+        if self.poi_loaded.get(category) != key:
+            if self.poi_store is None:
+                self.network.set_pois(category=category, **params)
+            else:
+                initialize_pois(self.network, category, params['maxdist'], params['maxitems'],
+                                self.poi_nodes(category))
+            self.poi_loaded[category] = key
+            self.poi_loads += 1
+
+    def poi_nodes(self, category):
+        """
+        Network node id of each POI of a category, indexed by POI.
+        """
+
+        key, params = self.pois[category]
+        if self.poi_store is None:
+            return self.network.get_node_ids(params['x_col'], params['y_col'],
+                                             mapping_distance=params['mapping_distance'])
+
+        nodes = self.snap_pois(params['x_col'], params['y_col'], key[3])
+        if params['mapping_distance'] is not None:
+            nodes = nodes[nodes.distance <= params['mapping_distance']]
+        return nodes.node_id
+
+    def snap_pois(self, x_col, y_col, fingerprint):
+        """
+        Nearest network node of each POI and its distance, from poi_store
+        if these POIs were snapped to this network before.
+        """
+
+        return snap_points(self.network, x_col, y_col, store=self.poi_store,
+                           prefix='pois', fingerprint=fingerprint)
+
+    def query_key(self, method, params, version=None):
+        """
+        Cache key for an aggregate or bands query on a variable version
+        (defaults to the data currently set under the query's name), or
+        for a nearest_pois query on the current POIs of its category.
+
+        Keys start with the kind of query, 'aggregate', 'bands' or 'pois',
+        then the variable name or POI category, so variables and POI
+        categories may share names.
+        """
+
+        if method == 'nearest_pois':
+            version = self.pois.get(params['category'], (None, None))[0]
+            return ('pois', params['category'], version, float(params['distance']),
+                    params['num_pois'], params['max_distance'], params['imp_name'],
+                    params['include_poi_ids'])
+
+        if version is None:
+            version = self.versions.get(params['name'])
+
+        if method == 'bands':
+            edges, weights = ranges.band_weights(params['edges'], params['weights'])
+            return ('bands', params['name'], version,
+                    tuple(edges), tuple(weights), params['imp_name'])
+
+        type = AGGREGATION_ALIASES.get(params['type'].lower(), params['type'].lower())
+        return ('aggregate', params['name'], version, float(params['distance']),
+                type, params['decay'], params['imp_name'])
+
+    def batchable(self, method, params):
+        """
+        Whether a query can be computed from range queries by `prefetch`:
+        bands and decayed sums, counts and means, evaluated only at the
+        origin nodes.
+        """
+
+        if self.origins is None:
+            return False
+        if method == 'bands':
+            return True
+        if method == 'nearest_pois':
+            return params['category'] in self.pois and params['num_pois'] == 1 and \
+                not params['include_poi_ids']
+        return self.query_key(method, params)[4] in ['sum', 'count', 'mean'] and \
+            params['decay'] in ['flat', 'linear', 'exp']
+
+    def prefetch(self, queries):
+        """
+        Compute a batch of aggregate and bands queries in a single pass.
+
+        The reachable nodes of each origin are found once, and queries that
+        share a radius and weights are summed together as columns of one
+        multi-column accumulation. Results go into the cache, keyed on the
+        version of the data they were computed from, so later calls after
+        `set` with the same data are cache hits.
+
+        Parameters
+        ----------
+        queries : list of (method, params, version, node_ids, variable)
+            method is 'aggregate' or 'bands' and params the full set of
+            arguments to that method. version is the fingerprint of node_ids
+            and variable, the data the query's name will be set to.
+        """
+
+        columns = {}
+        totals = []
+        groups = {}
+        pending = {}
+        for method, params, version, node_ids, variable in queries:
+            key = self.query_key(method, params, version)
+            if not self.batchable(method, params) or key in self.cache or key in pending:
+                continue
+
+            # each query is a sum of values or item counts (or the ratio of
+            # both for a mean) over the nodes within range of each origin
+            if method == 'bands':
+                edges, weights = ranges.band_weights(params['edges'], params['weights'])
+                terms = [((params['imp_name'], 'bands', tuple(edges), tuple(weights)), 'sum')]
+            else:
+                radius = float(params['distance'])
+                terms = []
+                if key[4] in ['sum', 'mean']:
+                    terms.append(((params['imp_name'], radius, params['decay']), 'sum'))
+                if key[4] in ['count', 'mean']:
+                    terms.append(((params['imp_name'], radius, 'flat'), 'count'))
+
+            pending[key] = []
+            for group, kind in terms:
+                if (version, kind) not in columns:
+                    columns[(version, kind)] = len(totals)
+                    values = variable
+                    if kind == 'count' and variable is not None:
+                        # pandana drops items with missing values
+                        values = np.where(pd.isnull(variable), np.nan, 1.0)
+                    totals.append(ranges.node_totals(self.network, node_ids, values))
+
+                if group not in groups:
+                    if group[1] == 'bands':
+                        edges = np.array(group[2])
+                        groups[group] = (edges[-1],
+                                         ranges.ring_weights(edges, np.array(group[3])), [])
+                    else:
+                        groups[group] = (group[1], ranges.decay_weights(group[1], group[2]), [])
+
+                column = columns[(version, kind)]
+                if column not in groups[group][2]:
+                    groups[group][2].append(column)
+                pending[key].append((group, column))
+
+        if not groups:
+            return
+
+        totals = np.column_stack(totals)
+        origins = self.origins
+        sums = {}
+        for imp_name in set(group[0] for group in groups):
+            batch = [(group, query) for group, query in groups.items() if group[0] == imp_name]
+            results = ranges.range_sums(self.network, totals, [query for _, query in batch],
+                                        origins, imp_name, self.chunk_size)
+            for (group, (_, _, group_columns)), values in zip(batch, results):
+                for column, value in zip(group_columns, values.T):
+                    sums[(group, column)] = value
+
+        for key, terms in pending.items():
+            values = [sums[term] for term in terms]
+            if len(values) == 2:
+                # mean of the items within range, 0 where there are none
+                values = [np.divide(values[0], values[1], out=np.zeros(len(origins)),
+                                    where=values[1] > 0)]
+            self.cache[key] = pd.Series(values[0], index=origins)
+            self.batched += 1
+
+    def prefetch_pois(self, queries):
+        """
+        Find the nearest POI of several categories in a single pass.
+
+        The reachable nodes of each origin are found once, up to the
+        largest distance of all queries, and searched for the POI nodes of
+        every category at the same time.
+
+        Parameters
+        ----------
+        queries : list of dict
+            full set of nearest_pois arguments of each query
+        """
+
+        queries = [params for params in queries if self.batchable('nearest_pois', params) and
+                   self.query_key('nearest_pois', params) not in self.cache]
+        if not queries:
+            return
+
+        origins = self.origins
+        for imp_name in set(params['imp_name'] for params in queries):
+            batch = [params for params in queries if params['imp_name'] == imp_name]
+            categories = sorted(set(params['category'] for params in batch))
+            labels = ranges.node_labels(self.network,
+                                        [self.poi_nodes(category) for category in categories])
+            nearest = ranges.nearest_distances(self.network, labels,
+                                               max(params['distance'] for params in batch),
+                                               origins, imp_name, self.chunk_size)
+
+            for params in batch:
+                distances = nearest[:, categories.index(params['category'])].copy()
+                max_distance = params['max_distance']
+                if max_distance is None:
+                    max_distance = params['distance']
+                distances[distances > ranges.as_impedance(params['distance'])] = max_distance
+                self.cache[self.query_key('nearest_pois', params)] = \
+                    pd.DataFrame({1: distances}, index=origins)
+                self.batched += 1
+
+    def nearest_pois(self, distance, category, num_pois=1, max_distance=None, imp_name=None,
+                     include_poi_ids=False):
+        params = dict(distance=distance, category=category, num_pois=num_pois,
+                      max_distance=max_distance, imp_name=imp_name,
+                      include_poi_ids=include_poi_ids)
+        key = self.query_key('nearest_pois', params)
+        if key in self.cache:
+            self.hits += 1
+        else:
+            self.misses += 1
+            if self.batchable('nearest_pois', params):
+                self.prefetch_pois([params])
+            else:
+                if category in self.pois:
+                    self.load_pois(category)
+                self.cache[key] = self.network.nearest_pois(
+                    distance, category, num_pois=num_pois, max_distance=max_distance,
+                    imp_name=imp_name, include_poi_ids=include_poi_ids)
+
+        return self.result(key)
+
+    def aggregate(self, distance, type='sum', decay='linear', imp_name=None, name='tmp'):
+        params = dict(distance=distance, type=type, decay=decay, imp_name=imp_name, name=name)
+        key = self.query_key('aggregate', params)
+        if key in self.cache:
+            self.hits += 1
+        else:
+            self.misses += 1
+            if self.batchable('aggregate', params) and name in self.variables:
+                # only compute the origins, chunk by chunk
+                self.prefetch([('aggregate', params, self.versions[name])
+                               + self.variables[name]])
+            else:
+                if name in self.versions:
+                    self.load(name)
+                ranges.run_deferred_precompute(self.network)
+                self.cache[key] = self.network.aggregate(distance, type=key[4], decay=decay,
+                                                         imp_name=imp_name, name=name)
+
+        return self.result(key)
+
+    def bands(self, name='tmp', edges=None, weights=None, imp_name=None):
+        """
+        Weighted sum of a variable over distance bands around every node.
+
+        Equivalent to summing flat `aggregate` differences between
+        consecutive edges times each band's weight, e.g.::
+
+            network.bands(name='hh_p', edges=[0.5, 1], weights=[1, 0.5])
+
+        is ``aggregate(0.5) * 1 + (aggregate(1) - aggregate(0.5)) * 0.5``,
+        but all bands are computed from one range query per node.
+
+        Parameters
+        ----------
+        name : str
+            variable name previously registered with `set`
+        edges : list of float
+            increasing outer distance of each band
+        weights : list of float or callable, optional
+            weight of each band, or a function of the band edges
+        imp_name : str, optional
+
+        Returns
+        -------
+        sums : pandas.Series
+            indexed by origin node id
+        """
+
+        assert name in self.variables, "A variable with that name has not yet been set"
+
+        params = dict(name=name, edges=edges, weights=weights, imp_name=imp_name)
+        key = self.query_key('bands', params)
+        if key in self.cache:
+            self.hits += 1
+        else:
+            self.misses += 1
+            totals = ranges.node_totals(self.network, *self.variables[name])
+            self.cache[key] = ranges.band_sums(self.network, totals, edges, weights,
+                                               origins=self.origins, imp_name=imp_name,
+                                               chunk_size=self.chunk_size)
+
+        return self.result(key)
+
+    def result(self, key):
+        """
+        Copy of a cached result, callers may rename or modify it. The copy
+        keeps the result's index object, the network's node ids or the
+        origins, so the zones' positions in it are only found once.
+        """
+
+        return copy_value(self.cache[key])
+
+    def log_stats(self):
+        logger.info("aggregate cache: %s hits, %s misses, %s batched"
+                    % (self.hits, self.misses, self.batched))
+        logger.info("network.set: %s calls, %s skipped"
+                    % (self.sets, self.sets - self.loads))
+        logger.info("network.set_pois: %s calls, %s skipped"
+                    % (self.poi_sets, self.poi_sets - self.poi_loads))
+
+
+def network_calls(tree, methods=('aggregate', 'bands')):
+    """
+    Find the network.aggregate and network.bands calls in an expression.
+
+    Parameters
+    ----------
+    tree : ast.Expression
+        parsed expression
+    methods : sequence of str, optional
+        network methods to look for
+
+    Returns
+    -------
+    calls : list of ast.Call
+    """
+
+    return [node for node in ast.walk(tree)
+            if isinstance(node, ast.Call) and
+            isinstance(node.func, ast.Attribute) and
+            node.func.attr in methods and
+            isinstance(node.func.value, ast.Name) and node.func.value.id == 'network']
+
+
+def bind_network_call(call, locals_dict):
+    """
+    Evaluate the arguments of a network call found by network_calls.
+
+    Parameters
+    ----------
+    call : ast.Call
+    locals_dict : dict
+        environment to evaluate the arguments in
+
+    Returns
+    -------
+    method : str
+        'aggregate', 'bands' or 'nearest_pois'
+    params : dict
+        every argument of the CachedNetwork method, including defaults
+    """
+
+    def evaluate(node):
+        return eval(compile(ast.Expression(body=node), '<spec>', 'eval'), globals(), locals_dict)
+
+    method = call.func.attr
+    args = [evaluate(arg) for arg in call.args]
+    kwargs = {keyword.arg: evaluate(keyword.value) for keyword in call.keywords}
+
+    bound = inspect.signature(getattr(CachedNetwork, method)).bind(None, *args, **kwargs)
+    bound.apply_defaults()
+    params = dict(bound.arguments)
+    del params['self']
+
+    return method, params
+
+
+def needs_prefetch(network, calls, locals_dict):
+    """
+    Whether any of a row's network calls could be batched but is not cached.
+    """
+
+    for call in calls:
+        try:
+            method, params = bind_network_call(call, locals_dict)
+        except Exception:
+            continue
+        if network.batchable(method, params) and \
+                network.query_key(method, params) not in network.cache:
+            return True
+
+    return False
+
+
+def prefetch_network_calls(network, spec_rows, locals_dict):
+    """
+    Batch the aggregate and bands queries of spec rows into one pass.
+
+    Only rows whose variable is already a column of their target_df are
+    batched, with the data currently in that column. Rows that change the
+    column before they run just miss the cache and are computed on their own.
+
+    Parameters
+    ----------
+    network : CachedNetwork
+    spec_rows : list of (variable, target_df, calls)
+        calls are the network_calls of each row expression
+    locals_dict : dict
+        environment to evaluate call arguments in
+    """
+
+    queries = []
+    for var, target_df, calls in spec_rows:
+        df = locals_dict.get(target_df)
+        if not calls or not isinstance(df, pd.DataFrame) or var not in df.columns:
+            continue
+
+        node_ids = df[locals_dict['node_id']]
+        version = data_fingerprint(node_ids, df[var])
+        for call in calls:
+            try:
+                method, params = bind_network_call(call, locals_dict)
+            except Exception:
+                # arguments that depend on targets not assigned yet
+                continue
+            if params['name'] == var:
+                queries.append((method, params, version, node_ids, df[var]))
+
+    network.prefetch(queries)
+
+
+def prefetch_nearest_pois(network, spec_rows, locals_dict):
+    """
+    Find the nearest POIs of nearest_pois spec rows in one pass.
+
+    Registers the POI category of each row, the records of target_df with a
+    value of 1 in the row's variable column, with the data currently in that
+    column, and batches the rows' nearest_pois queries.
+
+    Parameters
+    ----------
+    network : CachedNetwork
+    spec_rows : list of (variable, target_df, calls)
+        calls are the nearest_pois network_calls of each row expression
+    locals_dict : dict
+        environment to evaluate call arguments in
+    """
+
+    queries = []
+    for var, target_df, calls in spec_rows:
+        df = locals_dict.get(target_df)
+        if not calls or not isinstance(df, pd.DataFrame) or var not in df.columns:
+            continue
+
+        temp_df = df[df[var] == 1]
+        if temp_df.empty:
+            continue
+        network.set_pois(category=var,
+                         maxdist=locals_dict['max_dist'],
+                         maxitems=locals_dict['max_pois'],
+                         x_col=temp_df[locals_dict['poi_x']],
+                         y_col=temp_df[locals_dict['poi_y']])
+
+        for call in calls:
+            try:
+                method, params = bind_network_call(call, locals_dict)
+            except Exception:
+                continue
+            if params['category'] == var:
+                queries.append(params)
+
+    network.prefetch_pois(queries)
+
+
+def is_local(target):
+    return target.startswith('_') and target.isupper()
+
+
+def is_temp(target):
+    return target.startswith('_')
+
+
+def constant_string(node):
+    """
+    Value of a string literal ast node, or None for any other node.
+    """
+
+    # subscripts are wrapped in an Index node before python 3.9
+    if type(node).__name__ == 'Index':
+        node = node.value
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if type(node).__name__ == 'Str':
+        return node.s
+    return None
+
+
+def called_methods(tree):
+    """
+    Names of the methods called in an expression, e.g. 'aggregate' for
+    network.aggregate(...)
+    """
+
+    return set(node.func.attr for node in ast.walk(tree)
+               if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute))
+
+
+def expression_reads(tree):
+    """
+    Find what an expression reads from its environment.
+
+    Parameters
+    ----------
+    tree : ast.Expression
+        parsed expression
+
+    Returns
+    -------
+    reads : set
+        (df, column) tuples for subscripts like zones_df['hh_p'] and names
+        for everything else, including dataframes used other than through
+        a string subscript (which count as reading every column).
+    """
+
+    reads = set()
+    subscripted = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name):
+            column = constant_string(node.slice)
+            if column is not None:
+                reads.add((node.value.id, column))
+                subscripted.add(id(node.value))
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and id(node) not in subscripted and node.id != 'network':
+            reads.add(node.id)
+
+    return reads
+
+
+def conflicts(read, write):
+    """
+    Whether writing item `write` changes what reading item `read` returns.
+    """
+
+    return read == write or (isinstance(write, tuple) and read == write[0])
+
+
+class SpecNode(object):
+    """
+    A compiled buffer spec row.
+
+    kind is one of:
+
+        - 'local': uppercase temp (e.g. _LOCAL_SCALAR) assigned to locals
+        - 'aggregate': network aggregate or bands query indexed to zones
+        - 'nearest_poi': network nearest_pois query indexed to zones
+        - 'assign': pandas expression assigned to a target_df column
+
+    reads and writes are sets of names and (df, column) tuples, the
+    '<network>' and '<pois>' pseudo dataframes track network variables and
+    POI categories registered by a row. deps are the indices of the nodes
+    that must run before this one, inputs maps each read to the nodes whose
+    writes it sees, and readers are the nodes that see this node's writes.
+    """
+
+    def __init__(self, index, target, variable, target_df, expression, zone_df_name):
+        self.index = index
+        self.target = target
+        self.variable = variable
+        self.target_df = target_df
+        self.expression = expression
+
+        self.tree = ast.parse(expression, mode='eval')
+        self.code = compile(self.tree, '<%s>' % target, 'eval')
+        self.calls = network_calls(self.tree)
+        self.poi_calls = network_calls(self.tree, ['nearest_pois'])
+        self.reads = expression_reads(self.tree)
+
+        methods = called_methods(self.tree)
+        if is_local(target):
+            self.kind = 'local'
+            self.writes = {target}
+        elif 'aggregate' in methods or 'bands' in methods:
+            self.kind = 'aggregate'
+            self.reads |= {(target_df, variable)}
+            self.reads |= {('<network>', bind_name(call)) for call in self.calls
+                           if bind_name(call) not in [None, variable]}
+            self.writes = {target, (zone_df_name, target), ('<network>', variable)}
+        elif 'nearest_pois' in methods:
+            self.kind = 'nearest_poi'
+            self.reads |= {(target_df, variable)}
+            self.writes = {target, (zone_df_name, target), ('<pois>', variable)}
+        else:
+            self.kind = 'assign'
+            self.writes = {target, (target_df, target)}
+
+        self.reset_links()
+
+    def reset_links(self):
+        self.deps = set()
+        self.inputs = {}
+        self.readers = set()
+        self.duplicate_of = None
+        self.traceable = True
+
+    def unlinked(self, index):
+        """
+        Copy of the node at another position in a plan, sharing its
+        compiled expression but not its links to other nodes.
+        """
+
+        node = object.__new__(SpecNode)
+        node.__dict__.update(self.__dict__)
+        node.index = index
+        node.reset_links()
+        return node
+
+    def __getstate__(self):
+        # code objects don't pickle, but marshal, so plans sent to worker
+        # processes are not compiled again
+        state = self.__dict__.copy()
+        state['code'] = marshal.dumps(self.code)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.code = marshal.loads(state['code'])
+
+
+def bind_name(call):
+    """
+    The variable name a network call aggregates, if it is a literal.
+    """
+
+    for keyword in call.keywords:
+        if keyword.arg == 'name':
+            return constant_string(keyword.value)
+
+    if call.func.attr == 'aggregate' and len(call.args) > 4:
+        return constant_string(call.args[4])
+    if call.func.attr == 'bands' and call.args:
+        return constant_string(call.args[0])
+
+    return 'tmp'
+
+
+class BufferPlan(object):
+    """
+    A buffer spec compiled into a dependency graph of SpecNodes.
+
+    Rows are parsed and compiled once, linked by the targets, columns,
+    network variables and POI categories they read and write, and rows
+    that would recompute an identical value are marked as duplicates.
+    Any topological order of the nodes produces the same results as
+    running the spec in file order.
+
+    Parameters
+    ----------
+    spec : pandas.DataFrame
+        buffer spec as returned by read_buffer_spec
+    zone_df_name : str
+        name of the dataframe aggregate and nearest_poi results are indexed to
+    nodes : list of SpecNode, optional
+        already compiled nodes of the spec rows, see subset
+    """
+
+    def __init__(self, spec, zone_df_name='zones_df', nodes=None):
+        self.spec = spec
+        self.zone_df_name = zone_df_name
+
+        if nodes is not None:
+            self.nodes = [node.unlinked(i) for i, node in enumerate(nodes)]
+        else:
+            self.nodes = []
+            for row in zip(spec.target, spec.variable, spec.target_df, spec.expression):
+                try:
+                    self.nodes.append(SpecNode(len(self.nodes), *row, zone_df_name))
+                except SyntaxError as err:
+                    logger.error("buffer spec syntax error: %s = %s"
+                                 % (str(row[0]), str(row[3])))
+                    raise err
+
+        self.link()
+        self.find_duplicates()
+
+        # results can only be traced while they are indexed like the zone df,
+        # which is reset by aggregates and lost by assignments to other dfs
+        traceable = True
+        for node in self.nodes:
+            if node.kind == 'aggregate':
+                traceable = True
+            elif node.kind != 'local' and node.target_df != zone_df_name:
+                traceable = False
+            node.traceable = traceable
+
+    def subset(self, rows):
+        """
+        Plan of some of the spec rows, by position, relinking their
+        compiled nodes rather than compiling the rows again.
+        """
+
+        rows = list(rows)
+        return BufferPlan(self.spec.iloc[rows], self.zone_df_name,
+                          nodes=[self.nodes[i] for i in rows])
+
+    def link(self):
+        last_writer = {}
+        open_reads = {}
+        for node in self.nodes:
+            for read in node.reads:
+                writers = set(w for item, w in last_writer.items() if conflicts(read, item))
+                node.inputs[read] = writers
+                node.deps |= writers
+                for w in writers:
+                    self.nodes[w].readers.add(node.index)
+
+            for write in node.writes:
+                # write after read and write after write
+                for read, readers in open_reads.items():
+                    if conflicts(read, write):
+                        node.deps |= readers
+                if write in last_writer:
+                    node.deps.add(last_writer[write])
+
+            for read in node.reads:
+                open_reads.setdefault(read, set()).add(node.index)
+            for write in node.writes:
+                last_writer[write] = node.index
+                open_reads.pop(write, None)
+
+            node.deps.discard(node.index)
+
+    def find_duplicates(self):
+        canonical = {}
+        signatures = {}
+        for node in self.nodes:
+            inputs = tuple(sorted((str(read), tuple(sorted(canonical[w] for w in writers)))
+                                  for read, writers in node.inputs.items()))
+            signature = (node.kind, node.expression, str(node.variable),
+                         str(node.target_df), inputs)
+            if signature in signatures:
+                node.duplicate_of = signatures[signature]
+                canonical[node.index] = canonical[node.duplicate_of]
+            else:
+                signatures[signature] = node.index
+                canonical[node.index] = node.index
+
+    def live_nodes(self, keep_temps=False):
+        """
+        Indices of the nodes that need to run: every non temp target and
+        the temps (transitively) read by them. With keep_temps all nodes.
+        """
+
+        live = set()
+        for node in reversed(self.nodes):
+            if keep_temps or not is_temp(node.target) or node.readers & live:
+                live.add(node.index)
+        return live
+
+    def schedule(self, keep_temps=False):
+        """
+        Order the live nodes for execution.
+
+        Among the nodes whose dependencies have run, prefer the one that
+        frees the most temps (is the last pending reader of them), then
+        one that doesn't create a temp, then spec order. This keeps temps
+        alive for as short a time as possible.
+
+        Returns
+        -------
+        order : list of SpecNode
+        """
+
+        live = self.live_nodes(keep_temps)
+        pending_readers = {i: self.nodes[i].readers & live for i in live}
+
+        def frees(node):
+            return sum(1 for writers in node.inputs.values() for w in writers
+                       if is_temp(self.nodes[w].target) and pending_readers[w] == {node.index})
+
+        order = []
+        done = set()
+        while len(order) < len(live):
+            ready = [self.nodes[i] for i in sorted(live - done)
+                     if not (self.nodes[i].deps & live) - done]
+            node = max(ready, key=lambda n: (frees(n), not is_temp(n.target), -n.index))
+            order.append(node)
+            done.add(node.index)
+            for writers in node.inputs.values():
+                for w in writers:
+                    pending_readers[w].discard(node.index)
+
+        return order
+
+
+def independent_row_groups(plan):
+    """
+    Partition a plan into groups of spec rows that can run independently.
+
+    Locals that only depend on other locals (e.g. _BANDS = [0.5, 1]) are
+    cheap to recompute, so they are copied into every group that reads them
+    rather than joining those groups together.
+
+    Parameters
+    ----------
+    plan : BufferPlan
+
+    Returns
+    -------
+    groups : list of list of int
+        spec row positions of each group, in spec order
+    """
+
+    shared = set()
+    for node in plan.nodes:
+        if node.kind == 'local' and node.deps <= shared:
+            shared.add(node.index)
+
+    # union find over the dependencies between the other rows
+    parent = {node.index: node.index for node in plan.nodes if node.index not in shared}
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i in parent:
+        for d in plan.nodes[i].deps - shared:
+            parent[find(i)] = find(d)
+
+    components = {}
+    for i in sorted(parent):
+        components.setdefault(find(i), set()).add(i)
+
+    groups = []
+    for rows in components.values():
+        needed = set()
+        stack = [d for i in rows for d in plan.nodes[i].deps & shared]
+        while stack:
+            d = stack.pop()
+            if d not in needed:
+                needed.add(d)
+                stack.extend(plan.nodes[d].deps)
+        groups.append(sorted(rows | needed))
+
+    return sorted(groups)
+
+
+class NetworkArrays(object):
+    """
+    The arrays a Pandana network is built from, and its range tables, in a
+    form that can be sent to worker processes to rebuild the network there.
+
+    Range table arrays memory-mapped from .npy files are sent as their file
+    names (see ranges.RangeTable), so workers map the same files rather
+    than receiving copies.
+
+    Parameters
+    ----------
+    network : pandana.Network
+    """
+
+    def __init__(self, network):
+        self.nodes_df = network.nodes_df
+        self.edges_df = network.edges_df
+        self.impedance_names = network.impedance_names
+        self.twoway = network._twoway
+        self.range_tables = dict(ranges.range_tables.get(network, {}))
+        self.deferred_precompute = ranges.deferred_precomputes.get(network)
+
+    def build(self):
+        """
+        Rebuild the network, with the same range tables and deferred
+        precompute.
+
+        Returns
+        -------
+        network : pandana.Network
+        """
+
+        network = pdna.Network(self.nodes_df.x, self.nodes_df.y,
+                               self.edges_df['from'], self.edges_df['to'],
+                               self.edges_df[self.impedance_names], twoway=self.twoway)
+        for imp_num, table in self.range_tables.items():
+            ranges.precompute_ranges(network, table.radius,
+                                     imp_name=self.impedance_names[imp_num], table=table)
+        if self.deferred_precompute is not None:
+            ranges.defer_precompute(network, self.deferred_precompute)
+        return network
+
+
+# buffer_variables arguments of a process pool worker, see init_worker
+pool_args = None
+
+
+def init_worker(plan, zone_df_name, locals_dict, network_arrays, options):
+    """
+    Process pool initializer, rebuild the network in the worker.
+    """
+
+    global pool_args
+
+    if network_arrays is not None:
+        locals_dict = dict(locals_dict, network=network_arrays.build())
+    pool_args = (plan, zone_df_name, locals_dict, options)
+
+
+def buffer_rows(rows):
+    """
+    Process pool worker, run buffer_variables on a subset of spec rows.
+    """
+
+    plan, zone_df_name, locals_dict, options = pool_args
+    return buffer_variables(plan.subset(rows), zone_df_name, locals_dict, **options)
+
+
+def buffer_variables_parallel(plan, zone_df_name, locals_dict, trace_rows, num_processes,
+                              zone_rows=None):
+    """
+    Run independent groups of spec rows of a plan across a process pool.
+
+    Pandana's OpenMP runtime is not safe to fork once it has run queries,
+    so workers are started with the forkserver method where available and
+    spawn otherwise. Each worker is sent the plan, the dataframes and the
+    network's arrays once, and rebuilds the network and its range tables.
+    Groups are assigned to workers by their number of network queries and
+    results are combined in spec order, so they are identical to a serial
+    run.
+
+    Each worker batches the network queries of its own rows, so queries
+    at the same distance in rows that end up in different workers each
+    make their own pass over the zone nodes' reachable nodes. Parallel
+    runs pay off for specs whose groups are costly relative to rebuilding
+    the network.
+
+    Returns
+    -------
+    same as buffer_variables
+    """
+
+    groups = independent_row_groups(plan)
+
+    # balance the network queries, the expensive part, over the workers
+    def cost(rows):
+        return sum(1 for i in rows if plan.nodes[i].kind in ['aggregate', 'nearest_poi'])
+
+    num_processes = min(num_processes, len(groups))
+    bins = [[] for _ in range(num_processes)]
+    loads = [0] * num_processes
+    for rows in sorted(groups, key=lambda g: (-cost(g), g)):
+        b = loads.index(min(loads))
+        bins[b].extend(rows)
+        loads[b] += cost(rows) + 1
+    bins = [sorted(set(rows)) for rows in bins if rows]
+
+    logger.info("buffering %s independent groups of rows with %s processes"
+                % (len(groups), len(bins)))
+
+    network = locals_dict.get('network')
+    options = {'trace_rows': trace_rows, 'zone_rows': zone_rows}
+    if isinstance(network, CachedNetwork):
+        options.update(chunk_size=network.chunk_size, poi_store=network.poi_store)
+        network = network.network
+    initargs = (plan, zone_df_name,
+                {k: v for k, v in locals_dict.items() if k != 'network'},
+                None if network is None else NetworkArrays(network), options)
+
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    with context.Pool(len(bins), initializer=init_worker, initargs=initargs) as pool:
+        outputs = pool.map(buffer_rows, bins)
+
+    # spec position of the last row assigning each target
+    last = {}
+    for node in plan.nodes:
+        last[node.target] = node.index
+
+    variables = pd.concat([v for v, _, _ in outputs], axis=1)
+    variables = variables[sorted(variables.columns, key=lambda c: last[c])]
+
+    trace_results = trace_assigned_locals = None
+    if outputs[0][1] is not None:
+        first = {}
+        for node in reversed(plan.nodes):
+            first[node.target] = node.index
+        trace_results = pd.concat([t for _, t, _ in outputs], axis=1)
+        trace_results = trace_results[sorted(trace_results.columns, key=lambda c: first[c])]
+        trace_assigned_locals = {}
+        for _, _, assigned_locals in outputs:
+            trace_assigned_locals.update(assigned_locals)
+
+    return variables, trace_results, trace_assigned_locals
+
+
+def compile_buffer_spec(spec, zone_df_name='zones_df'):
+    """
+    Compile a buffer spec into a BufferPlan.
+
+    Parameters
+    ----------
+    spec : pandas.DataFrame
+        as returned by read_buffer_spec
+    zone_df_name : str, optional
+        name of the df in locals_dict to which buffer_variables indexes results
+
+    Returns
+    -------
+    plan : BufferPlan
+    """
+
+    return BufferPlan(spec, zone_df_name)
+
+
+def copy_value(x):
+    """
+    Copy of an expression result. Copies of pandas results keep their
+    index object, so lookups keyed on it still apply to them.
+    """
+
+    if isinstance(x, (pd.Series, pd.DataFrame)):
+        copy = x.copy()
+        copy.index = x.index
+        return copy
+
+    return x.copy() if hasattr(x, 'copy') else x
+
+
+def set_column(df, column, values):
+    """
+    Add or replace a dataframe column in place.
+
+    An existing column is removed first rather than overwritten, so the
+    data of the replaced column, which may be shared with a shallow copy,
+    is never written to.
+    """
+
+    if column in df.columns:
+        del df[column]
+    df[column] = values
+
+
 class NumpyLogger(object):
     def __init__(self, logger):
         self.logger = logger
@@ -117,13 +1410,28 @@ class NumpyLogger(object):
 
 def buffer_variables(buffer_expressions,
                      zone_df_name, locals_dict,
-                     df_alias=None, trace_rows=None):
+                     df_alias=None, trace_rows=None, num_processes=None, chunk_size=None,
+                     poi_store=None, zone_rows=None, result_cache=None):
     """
     Perform network accessibility calculations (using Pandana libary
     http://udst.github.io/pandana/) on point based data (e.g. zone
     centroids) using a set of expressions from a spec in the context of
     a given data table.
 
+    Besides Pandana's own methods, expressions can call
+    network.bands(name, edges, weights) for weighted distance band (ring)
+    sums, see CachedNetwork.bands. Bands and sum, count and mean aggregates
+    are only computed at the zone nodes, chunk_size nodes at a time, and
+    are batched: all pending queries of the remaining rows whose variables
+    are available are computed together in one pass over the zone nodes'
+    reachable nodes.
+
+    The spec is first compiled into a dependency graph (see BufferPlan):
+    temps that nothing reads are not computed (unless tracing), rows that
+    repeat an earlier computation reuse its result, and rows run in an
+    order that frees temp columns as early as possible. Results are the
+    same as running the rows in file order.
+
     Expressions are evaluated using Python's eval function.
     Python expressions have access to variables in locals_d.
     They also have access to previously assigned
@@ -157,7 +1465,7 @@ def buffer_variables(buffer_expressions,
 
     Parameters
     ----------
-    buffer_expressions : pandas.DataFrame of target assignment expressions
+    buffer_expressions : pandas.DataFrame of target assignment expressions or BufferPlan
         target: target column names
         variable: target variable to be buffered
         target_df: datafram that contains the variable to be buffered.
@@ -171,8 +1479,27 @@ def buffer_variables(buffer_expressions,
         intersections_df.
     locals_dict : Dict
         This is a dictionary of local variables that will be the environment
-        for an evaluation of "python" expression.
+        for an evaluation of "python" expression. If it names a `node_idx`
+        column of zone_df holding each zone's position in network.node_ids
+        (see ranges.node_positions), network results are indexed to the zones
+        by position rather than by node id.
     trace_rows: series or array of bools to use as mask to select target rows to trace
+    num_processes : int, optional
+        run independent groups of spec rows across this many worker processes,
+        see buffer_variables_parallel
+    chunk_size : int, optional
+        number of zone nodes whose network range queries are held in memory
+        at once, defaults to ranges.DEFAULT_CHUNK_SIZE
+    poi_store : str, optional
+        HDF5 file in which to keep snapped POIs across runs, see CachedNetwork
+    zone_rows : series or array of bools, optional
+        the zone_df rows network results are needed for, see
+        rebuffer_variables. Batched network queries are only computed at
+        their nodes, and network results of other rows are NaN.
+    result_cache : result_cache.ResultCache, optional
+        read the results of targets whose expression and inputs are
+        unchanged from this cache, and store the others in it, see
+        cached_buffer_variables. Not used when tracing or with zone_rows.
 
     Returns
     -------
@@ -185,12 +1512,6 @@ def buffer_variables(buffer_expressions,
 
     np_logger = NumpyLogger(logger)
 
-    def is_local(target):
-        return target.startswith('_') and target.isupper()
-
-    def is_temp(target):
-        return target.startswith('_')
-
     def to_series(x, target=None):
         if x is None or np.isscalar(x):
             if target:
@@ -213,114 +1534,251 @@ def buffer_variables(buffer_expressions,
 
     # avoid touching caller's passed-in locals_d parameter (they may be looping)
     locals_dict = locals_dict.copy() if locals_dict is not None else {}
+    # targets are assigned to dataframe columns in place, so work on shallow
+    # copies that share the caller's column data without changing their frames
+    for name, value in locals_dict.items():
+        if isinstance(value, pd.DataFrame):
+            locals_dict[name] = value.copy(deep=False)
     local_keys = list(locals_dict.keys())
 
-    le = []
-    traceable = True
+    # memoize identical aggregate queries for the duration of this run
+    if 'network' in locals_dict and not isinstance(locals_dict['network'], CachedNetwork):
+        # results are only ever read at the zone nodes
+        origins = None
+        if 'node_id' in locals_dict:
+            zone_nodes = locals_dict[zone_df_name][locals_dict['node_id']]
+            if zone_rows is not None:
+                zone_nodes = zone_nodes[np.asanyarray(zone_rows)]
+            origins = zone_nodes.unique()
+        locals_dict['network'] = CachedNetwork(locals_dict['network'], origins=origins,
+                                               chunk_size=chunk_size, poi_store=poi_store)
+
+    if not isinstance(buffer_expressions, BufferPlan):
+        buffer_expressions = compile_buffer_spec(buffer_expressions, zone_df_name)
+    plan = buffer_expressions
+
+    if result_cache is not None and trace_results is None and zone_rows is None:
+        return cached_buffer_variables(plan, zone_df_name, locals_dict, result_cache,
+                                       num_processes=num_processes, chunk_size=chunk_size,
+                                       poi_store=poi_store)
+
+    if num_processes and num_processes > 1:
+        return buffer_variables_parallel(plan, zone_df_name, locals_dict,
+                                         trace_rows, num_processes, zone_rows)
+
+    # temps are only computed if something reads them, unless they are traced
+    keep_temps = trace_results is not None
+    schedule = plan.schedule(keep_temps=keep_temps)
+    live = set(node.index for node in schedule)
+    logger.info("buffer plan: %s rows, %s unused temps skipped, %s duplicates"
+                % (len(plan.nodes), len(plan.nodes) - len(live),
+                   sum(1 for node in schedule if node.duplicate_of is not None)))
+    pending_readers = {node.index: node.readers & live for node in schedule}
+    pending_duplicates = {}
+    for node in schedule:
+        if node.duplicate_of in live:
+            pending_duplicates.setdefault(node.duplicate_of, set()).add(node.index)
+
+    raw_results = {}
+    results = {}
+    writers = {}
+    zone_positions = {}
+
+    def at_zone_nodes(values):
+        # network results are indexed by the network's node ids or by the
+        # batched origins, so the positions of the zones' nodes in each are
+        # found once and reused by every row. Results indexed by node ids
+        # are looked up by the zones' node_idx, without any hashing.
+        index = values.index
+        network = locals_dict['network']
+        if index is network.node_ids:
+            shared = 'node_ids'
+        elif index is getattr(network, 'origins', None):
+            shared = 'origins'
+        else:
+            shared = None
+
+        positions = zone_positions.get(shared)
+        if positions is None:
+            zones_df = locals_dict[zone_df_name]
+            if shared == 'node_ids' and 'node_idx' in locals_dict:
+                positions = zones_df[locals_dict['node_idx']].values
+            else:
+                positions = index.get_indexer(zones_df[locals_dict['node_id']])
+                if (positions < 0).any() and zone_rows is None:
+                    raise KeyError("zone nodes missing from network results")
+            if shared is not None:
+                zone_positions[shared] = positions
+
+        if zone_rows is None:
+            return values.values[positions]
+
+        # results are only computed at the nodes of zone_rows
+        found = positions >= 0
+        x = np.full(positions.shape + values.values.shape[1:], np.nan)
+        x[found] = values.values[positions[found]]
+        return x
+
+    def evaluate(node):
+        if node.duplicate_of in raw_results:
+            x = raw_results[node.duplicate_of]
+            duplicates = pending_duplicates[node.duplicate_of]
+            duplicates.discard(node.index)
+            if not duplicates:
+                del raw_results[node.duplicate_of]
+            return copy_value(x)
+
+        x = eval(node.code, globals(), locals_dict)
+        if pending_duplicates.get(node.index):
+            raw_results[node.index] = copy_value(x)
+        return x
+
+    def release(node):
+        # drop a temp's columns and locals once the last node reading them ran
+        for item in node.writes:
+            if writers.get(item) != node.index:
+                continue
+            del writers[item]
+            if isinstance(item, tuple):
+                df = locals_dict.get(item[0])
+                if isinstance(df, pd.DataFrame) and item[1] in df.columns:
+                    del df[item[1]]
+            else:
+                locals_dict.pop(item, None)
+
     # need to be able to identify which variables causes an error, which keeps
     # this from being expressed more parsimoniously
-    for e in zip(buffer_expressions.target, buffer_expressions.variable,
-                 buffer_expressions.target_df, buffer_expressions.expression):
-        target, var, target_df, expression = e
+    for i, node in enumerate(schedule):
+        target, var, target_df, expression = \
+            node.target, node.variable, node.target_df, node.expression
 
         if target in local_keys:
             logger.warn("buffer_variables target obscures local_d name '%s'" % str(target))
 
-        if is_local(target):
+        if node.kind == 'local':
 
-            x = eval(expression, globals(), locals_dict)
+            x = evaluate(node)
             locals_dict[target] = x
             if trace_assigned_locals is not None:
                 trace_assigned_locals[target] = x
-            continue
-
-        try:
 
-            # FIXME - log any numpy warnings/errors but don't raise
-            np_logger.target = str(target)
-            np_logger.expression = str(expression)
-            saved_handler = np.seterrcall(np_logger)
-            save_err = np.seterr(all='log')
-
-            network = locals_dict['network']
-            logger.debug("solving expression: %s" % target)
-
-            # aggregate query
-            if 'aggregate' in expression:
-                network.set(locals_dict[target_df][locals_dict['node_id']],
-                            variable=locals_dict[target_df][var], name=var)
-                values = to_series(eval(expression, globals(), locals_dict), target=target)
-                # index results to the zone_df:
-                locals_dict[zone_df_name][target] = \
-                    values.loc[locals_dict[zone_df_name][locals_dict['node_id']]].values
-                values = locals_dict[zone_df_name][target]
-                traceable = True
-
-            # nearest poi
-            elif 'nearest_pois' in expression:
-                # records we want to run nearest poi on should have a value of 1.
-                # Ex- Could have a table of transit stops,
-                # where each column is a type of transit stop, e.g. light rail, and a
-                # value of 1 in the light rail column
-                # means that that stop is a light rail stop.
-                temp_df = locals_dict[target_df][(locals_dict[target_df][var] == 1)]
-
-                if not temp_df.empty:
-                    network.set_pois(category=var,
-                                     maxdist=locals_dict['max_dist'],
-                                     maxitems=locals_dict['max_pois'],
-                                     x_col=temp_df[locals_dict['poi_x']],
-                                     y_col=temp_df[locals_dict['poi_y']])
-                    # poi queries return a df, no need to put through to_series function.
-                    values = eval(expression, globals(), locals_dict)
+        else:
+
+            try:
+
+                # FIXME - log any numpy warnings/errors but don't raise
+                np_logger.target = str(target)
+                np_logger.expression = str(expression)
+                saved_handler = np.seterrcall(np_logger)
+                save_err = np.seterr(all='log')
+
+                network = locals_dict['network']
+                logger.debug("solving expression: %s" % target)
+
+                # aggregate query
+                if node.kind == 'aggregate':
+                    network.set(locals_dict[target_df][locals_dict['node_id']],
+                                variable=locals_dict[target_df][var], name=var)
+                    if needs_prefetch(network, node.calls, locals_dict):
+                        prefetch_network_calls(network,
+                                               [(n.variable, n.target_df, n.calls)
+                                                for n in schedule[i:] if n.calls],
+                                               locals_dict)
+                    values = to_series(evaluate(node), target=target)
                     # index results to the zone_df:
-                    locals_dict[zone_df_name][target] = \
-                        values.loc[locals_dict[zone_df_name][locals_dict['node_id']]].values
+                    set_column(locals_dict[zone_df_name], target, at_zone_nodes(values))
+                    values = locals_dict[zone_df_name][target]
+
+                # nearest poi
+                elif node.kind == 'nearest_poi':
+                    # records we want to run nearest poi on should have a value of 1.
+                    # Ex- Could have a table of transit stops,
+                    # where each column is a type of transit stop, e.g. light rail, and a
+                    # value of 1 in the light rail column
+                    # means that that stop is a light rail stop.
+                    temp_df = locals_dict[target_df][(locals_dict[target_df][var] == 1)]
+
+                    if not temp_df.empty:
+                        if node.duplicate_of not in raw_results:
+                            network.set_pois(category=var,
+                                             maxdist=locals_dict['max_dist'],
+                                             maxitems=locals_dict['max_pois'],
+                                             x_col=temp_df[locals_dict['poi_x']],
+                                             y_col=temp_df[locals_dict['poi_y']])
+                            if needs_prefetch(network, node.poi_calls, locals_dict):
+                                prefetch_nearest_pois(network,
+                                                      [(n.variable, n.target_df, n.poi_calls)
+                                                       for n in schedule[i:] if n.poi_calls],
+                                                      locals_dict)
+                        # poi queries return a df, no need to put through to_series function.
+                        values = evaluate(node)
+                        # index results to the zone_df:
+                        set_column(locals_dict[zone_df_name], target, at_zone_nodes(values))
+                    else:
+                        set_column(locals_dict[zone_df_name], target, 999)
+
+                    values = locals_dict[zone_df_name][target]
+
+                # panda df assignment:
                 else:
-                    locals_dict[zone_df_name][target] = 999
-
-                values = locals_dict[zone_df_name][target]
-                # if assignment is to a df that is not the zone df, then cannot trace results
-                if target_df != zone_df_name:
-                    traceable = False
+                    result = evaluate(node)
+                    values = to_series(result, target=target)
+                    index = locals_dict[target_df].index
+                    if isinstance(result, pd.Series):
+                        # align series by label, they need not be in the df's order
+                        if not values.index.equals(index):
+                            missing = ~index.isin(values.index)
+                            if missing.any() or not values.index.is_unique:
+                                raise RuntimeError("%s values are not indexed like %s "
+                                                   "(%s rows missing, unique index: %s)"
+                                                   % (target, target_df, missing.sum(),
+                                                      values.index.is_unique))
+                            values = values.reindex(index)
+                    else:
+                        # must be the same df as in expression
+                        if len(values) != len(index):
+                            raise RuntimeError("%s values for %s rows of %s"
+                                               % (len(values), len(index), target_df))
+                        values.index = index
+                    # the target_df might need this column for a subsequent buffer operation
+                    set_column(locals_dict[target_df], target, values)
+
+                np.seterr(**save_err)
+                np.seterrcall(saved_handler)
+
+            except Exception as err:
+                logger.error("assign_variables error: %s: %s" % (type(err).__name__, str(err)))
+
+                logger.error("assign_variables expression: %s = %s"
+                             % (str(target), str(expression)))
+
+                # values = to_series(None, target=target)
+                raise err
+
+            if keep_temps or not is_temp(target):
+                results[node.index] = values
+
+            # update locals to allows us to ref previously assigned targets
+            locals_dict[target] = values
+
+        for item in node.writes:
+            writers[item] = node.index
+        if not keep_temps:
+            for w in {node.index}.union(*node.inputs.values()) & live:
+                pending_readers[w].discard(node.index)
+                if not pending_readers[w] and is_temp(plan.nodes[w].target):
+                    release(plan.nodes[w])
+
+    # results in spec order
+    le = [(plan.nodes[i].target, results[i]) for i in sorted(results)]
 
-            # panda df assignment:
-            else:
-                values = to_series(eval(expression, globals(), locals_dict), target=target)
-                values.index = locals_dict[target_df].index  # must be the same df as in expression
-                # the target_df might need this column for a subsequent buffer operation
-                # delete if exists:
-                if target in locals_dict[target_df].columns:
-                    locals_dict[target_df].drop(target, 1, inplace=True)
-                locals_dict[target_df] = locals_dict[target_df].merge(pd.DataFrame(
-                    values), how='left', left_index=True, right_index=True)
-                # if assignment is to a df that is not the zone df, then cannot trace results
-                if target_df != zone_df_name:
-                    traceable = False
-
-            np.seterr(**save_err)
-            np.seterrcall(saved_handler)
-
-        except Exception as err:
-            logger.error("assign_variables error: %s: %s" % (type(err).__name__, str(err)))
-
-            logger.error("assign_variables expression: %s = %s"
-                         % (str(target), str(expression)))
-
-            # values = to_series(None, target=target)
-            raise err
-
-        le.append((target, values))
-
-        if trace_results is not None:
-            # some calcs are not included in the final df so may not have the
-            # zones that being traced. These should have a value of 'None' in
-            # spec under the 'variable' column.
-            if traceable:
-                trace_results.append((target, values[trace_rows]))
-
-        # update locals to allows us to ref previously assigned targets
-        locals_dict[target] = values
+    if trace_results is not None:
+        # some calcs are not included in the final df so may not have the
+        # zones that being traced. These should have a value of 'None' in
+        # spec under the 'variable' column.
+        trace_results = [(target, values[trace_rows])
+                         for i, (target, values) in zip(sorted(results), le)
+                         if plan.nodes[i].traceable]
 
     # build a dataframe of eval results for non-temp targets
     # since we allow targets to be recycled, we want to only keep the last usage
@@ -335,6 +1793,9 @@ def buffer_variables(buffer_expressions,
             variables.insert(0, statement)
             seen.add(target_name)
 
+    if 'network' in locals_dict:
+        locals_dict['network'].log_stats()
+
     # DataFrame from list of tuples [<target_name>, <eval results>), ...]
     variables = pd.DataFrame.from_dict(dict(variables))
     if trace_results is not None:
@@ -345,3 +1806,450 @@ def buffer_variables(buffer_expressions,
         # add df columns to trace_results
         # trace_results = pd.concat([locals_dict[zone_df_name], trace_results], axis=1)
     return variables, trace_results, trace_assigned_locals
+
+
+# bumped when the results of a spec row no longer match earlier versions
+RESULT_CACHE_VERSION = 1
+
+
+def value_fingerprint(value):
+    """
+    Content hash of a value an expression reads from locals_dict, or None
+    if it can't be hashed reliably.
+    """
+
+    if isinstance(value, (pd.Series, pd.DataFrame, pd.Index, np.ndarray)):
+        return data_fingerprint(value, index=True)
+    if value is None or isinstance(value, (str, bytes, bool, int, float, np.generic)):
+        return '%s:%r' % (type(value).__name__, value)
+    if isinstance(value, (list, tuple)):
+        parts = [value_fingerprint(v) for v in value]
+        return None if None in parts else '%s:[%s]' % (type(value).__name__, ','.join(parts))
+    if isinstance(value, dict):
+        parts = [(value_fingerprint(k), value_fingerprint(v)) for k, v in value.items()]
+        if any(None in part for part in parts):
+            return None
+        return 'dict:{%s}' % ','.join(sorted('%s=%s' % part for part in parts))
+    if inspect.ismodule(value) or inspect.isroutine(value) or inspect.isclass(value):
+        return '%s:%s.%s' % (type(value).__name__, getattr(value, '__module__', ''),
+                             getattr(value, '__qualname__', value.__name__))
+    return None
+
+
+def context_reads(node, locals_dict, zone_df_name):
+    """
+    What a network query node reads besides its expression: the node ids
+    data and results are indexed by, and the POI coordinates and settings
+    of nearest_poi queries.
+    """
+
+    node_id = locals_dict.get('node_id')
+    if node.kind == 'aggregate':
+        return {(node.target_df, node_id), (zone_df_name, node_id)}
+    if node.kind == 'nearest_poi':
+        return {(node.target_df, locals_dict.get('poi_x')),
+                (node.target_df, locals_dict.get('poi_y')),
+                (zone_df_name, node_id), 'max_dist', 'max_pois'}
+    return set()
+
+
+def result_fingerprints(plan, locals_dict, zone_df_name):
+    """
+    Content hash of the result of each node of a plan, from its expression,
+    the fingerprints of the nodes whose writes it reads, the data it reads
+    from locals_dict and, for network queries, the network. Results with
+    the same fingerprint are the same, whatever else changed in the spec
+    or the data.
+
+    Nodes reading something that can't be hashed, e.g. a network variable
+    set outside the spec, or the result of such a node, have no
+    fingerprint.
+
+    Returns
+    -------
+    fingerprints : dict
+        hex digest or None by node index
+    """
+
+    external = {}
+    indexes = {}
+
+    def external_fingerprint(read):
+        if read not in external:
+            if isinstance(read, tuple):
+                df = locals_dict.get(read[0])
+                if read[0] == '<network>' or not isinstance(df, pd.DataFrame):
+                    external[read] = None
+                elif read[1] not in df.columns:
+                    external[read] = 'missing'
+                else:
+                    external[read] = data_fingerprint(df[read[1]])
+            elif read in locals_dict:
+                external[read] = value_fingerprint(locals_dict[read])
+            else:
+                # a builtin or global of this module, e.g. np
+                external[read] = 'global'
+        return external[read]
+
+    network = locals_dict.get('network')
+    if isinstance(network, CachedNetwork):
+        network = network.network
+
+    fingerprints = {}
+    for node in plan.nodes:
+        parts = [RESULT_CACHE_VERSION, node.kind, node.target, str(node.variable),
+                 str(node.target_df), node.expression]
+
+        inputs = dict(node.inputs)
+        for read in context_reads(node, locals_dict, zone_df_name):
+            inputs[read] = set(w for w in range(node.index)
+                               if any(conflicts(read, item) for item in plan.nodes[w].writes))
+        for read in sorted(inputs, key=str):
+            if inputs[read]:
+                part = [fingerprints[w] for w in sorted(inputs[read])]
+            else:
+                part = external_fingerprint(read)
+            parts += [str(read), part]
+
+        # results are indexed like the zone df, or the target df of assignments
+        result_df = node.target_df if node.kind == 'assign' else zone_df_name
+        if result_df not in indexes and isinstance(locals_dict.get(result_df), pd.DataFrame):
+            indexes[result_df] = data_fingerprint(locals_dict[result_df].index)
+        parts.append(indexes.get(result_df))
+        if node.kind in ['aggregate', 'nearest_poi']:
+            parts.append(network_fingerprint(network) if network is not None else None)
+
+        flat = [p for part in parts for p in (part if isinstance(part, list) else [part])]
+        if None in flat:
+            fingerprints[node.index] = None
+        else:
+            fingerprints[node.index] = hashlib.sha1(repr(flat).encode('utf-8')).hexdigest()
+
+    return fingerprints
+
+
+def cached_buffer_variables(plan, zone_df_name, locals_dict, result_cache, **kwargs):
+    """
+    buffer_variables, with the results of targets whose fingerprint (see
+    result_fingerprints) is in result_cache read from it. Only the spec
+    rows the other targets need are run, and their results are stored.
+
+    Parameters
+    ----------
+    plan : BufferPlan
+    zone_df_name : str
+    locals_dict : dict
+    result_cache : result_cache.ResultCache
+    **kwargs
+        buffer_variables options
+
+    Returns
+    -------
+    variables : pandas.DataFrame
+        same as buffer_variables
+    """
+
+    fingerprints = result_fingerprints(plan, locals_dict, zone_df_name)
+
+    # the node assigning the result of each target
+    last = {}
+    for node in plan.nodes:
+        if not is_temp(node.target):
+            last[node.target] = node.index
+    targets = sorted(last, key=last.get)
+
+    values = {}
+    for target in targets:
+        node = plan.nodes[last[target]]
+        if fingerprints[node.index] is None:
+            continue
+        cached = result_cache.get(fingerprints[node.index])
+        if cached is not None:
+            result_df = node.target_df if node.kind == 'assign' else zone_df_name
+            values[target] = pd.Series(cached, index=locals_dict[result_df].index, name=target)
+
+    missing = [target for target in targets if target not in values]
+    logger.info("result cache: %s of %s targets cached" % (len(values), len(targets)))
+
+    if missing:
+        # the spec rows the missing targets need
+        needed = set()
+        stack = [last[target] for target in missing]
+        while stack:
+            i = stack.pop()
+            if i not in needed:
+                needed.add(i)
+                stack.extend(plan.nodes[i].deps)
+
+        results, _, _ = buffer_variables(plan.subset(sorted(needed)), zone_df_name,
+                                         locals_dict, **kwargs)
+        for target in missing:
+            values[target] = results[target]
+            if fingerprints[last[target]] is not None:
+                result_cache.put(fingerprints[last[target]], results[target].values)
+
+    result_cache.log_stats()
+
+    return pd.DataFrame.from_dict({target: values[target] for target in targets}), None, None
+
+
+def spec_input_columns(plan, zone_df_name):
+    """
+    Columns of the zone df a plan reads before assigning them, or None if
+    it reads the whole df (e.g. through attribute access).
+    """
+
+    columns = set()
+    for node in plan.nodes:
+        for read, writers in node.inputs.items():
+            if read == zone_df_name:
+                return None
+            if isinstance(read, tuple) and read[0] == zone_df_name and not writers:
+                columns.add(read[1])
+
+    return columns
+
+
+def affected_nodes(plan, changed_columns, zone_df_name, node_id=None):
+    """
+    Find the nodes of a plan whose results can change when columns of the
+    zone df change, following the columns, targets and network variables
+    nodes read from each other.
+
+    Every network query reads the node_id column, to attach data to the
+    network and results to the zones.
+
+    Returns
+    -------
+    affected : dict
+        number of network queries on the longest path from a changed
+        column to each affected node, by node index
+    """
+
+    changed_columns = set(changed_columns)
+    affected = {}
+    for node in plan.nodes:
+        hops = None
+        if node_id in changed_columns and node.kind in ['aggregate', 'nearest_poi']:
+            hops = 0
+        for read, writers in node.inputs.items():
+            if read == zone_df_name or (isinstance(read, tuple) and read[0] == zone_df_name and
+                                        read[1] in changed_columns and not writers):
+                hops = max(hops or 0, 0)
+            for w in writers:
+                if w in affected:
+                    hops = max(hops or 0, affected[w])
+        if hops is not None:
+            affected[node.index] = hops + (node.kind in ['aggregate', 'nearest_poi'])
+
+    return affected
+
+
+def network_dependent(plan):
+    """
+    Indices of the nodes of a plan that are network queries or read
+    (transitively) the results of one.
+    """
+
+    dependent = set()
+    for node in plan.nodes:
+        if node.kind in ['aggregate', 'nearest_poi'] or \
+                any(writers & dependent for writers in node.inputs.values()):
+            dependent.add(node.index)
+
+    return dependent
+
+
+def zone_data_changes(previous, zones_df, columns=None):
+    """
+    Compare zone data with the zone data of an earlier run.
+
+    Parameters
+    ----------
+    previous : pandas.DataFrame
+        earlier zone data, e.g. the buffered zones output of the earlier run
+    zones_df : pandas.DataFrame
+    columns : collection of str, optional
+        zones_df columns to compare, defaults to every column
+
+    Returns
+    -------
+    changed_rows : pandas.Index
+        zones added, removed or with a changed value in any of the columns
+    changed_columns : list of str
+        columns with a changed value, or not in previous, every column if
+        zones were added or removed
+    """
+
+    if columns is None:
+        columns = zones_df.columns
+    columns = [c for c in zones_df.columns if c in columns]
+
+    shared = zones_df.index.intersection(previous.index)
+    changed_rows = zones_df.index.difference(previous.index).union(
+        previous.index.difference(zones_df.index))
+
+    changed_columns = []
+    for column in columns:
+        if column not in previous.columns:
+            changed_columns.append(column)
+            changed_rows = changed_rows.union(shared)
+            continue
+
+        new = zones_df.loc[shared, column].values
+        old = previous.loc[shared, column].values
+        differs = (new != old) & ~(pd.isnull(new) & pd.isnull(old))
+        if differs.any():
+            changed_columns.append(column)
+            changed_rows = changed_rows.union(shared[differs])
+
+    if len(shared) < max(len(zones_df.index), len(previous.index)):
+        changed_columns = columns
+
+    return changed_rows, changed_columns
+
+
+def rebuffer_variables(buffer_expressions, zone_df_name, locals_dict, previous,
+                       changed_rows=None, changed_columns=None, radius=None,
+                       chunk_size=None, poi_store=None):
+    """
+    Update the results of an earlier buffer_variables run after some zone
+    data changed, recomputing only what the change can reach.
+
+    Only the targets that read a changed column, directly or through other
+    targets and network variables, are recomputed, and their results
+    only updated at zones within `radius` of a changed zone for every
+    network query between the column and the target. Network queries
+    sum, count or find values within a radius, so the results of zones
+    further away can't change and are taken from previous, like the other
+    targets. Queries whose results are read by other queries are computed
+    far enough out for those to see every value they read.
+
+    Parameters
+    ----------
+    buffer_expressions : pandas.DataFrame or BufferPlan
+        as for buffer_variables
+    zone_df_name : str
+    locals_dict : dict
+        as for buffer_variables, with the new zone data
+    previous : pandas.DataFrame
+        results, and zone data, of the earlier run, indexed like zone_df.
+        Without a node_id column, zones are assumed to be at the same
+        network nodes as in the earlier run unless listed in changed_rows.
+    changed_rows : array-like, optional
+        ids of the zones added, removed or changed. Both changed_rows and
+        changed_columns default to the differences between previous and
+        zone_df in the columns the spec reads, see zone_data_changes.
+    changed_columns : list of str, optional
+        changed zone_df columns, every column if only changed_rows is given
+    radius : float, optional
+        largest distance of any network query, defaults to max_dist in
+        locals_dict
+    chunk_size : int, optional
+    poi_store : str, optional
+
+    Returns
+    -------
+    variables : pandas.DataFrame
+        same as buffer_variables
+    """
+
+    if not isinstance(buffer_expressions, BufferPlan):
+        buffer_expressions = compile_buffer_spec(buffer_expressions, zone_df_name)
+    plan = buffer_expressions
+    zones_df = locals_dict[zone_df_name]
+    node_id = locals_dict['node_id']
+
+    # the node assigning the result of each target
+    last = {}
+    for node in plan.nodes:
+        if not is_temp(node.target):
+            last[node.target] = node.index
+    targets = sorted(last, key=last.get)
+
+    missing = [target for target in targets if target not in previous.columns]
+    if missing:
+        raise RuntimeError("previous results have no %s columns" % ', '.join(missing))
+    variables = previous[targets].reindex(zones_df.index)
+
+    if changed_rows is None and changed_columns is None:
+        columns = spec_input_columns(plan, zone_df_name)
+        # buffered outputs need not keep the zone nodes, zones are then
+        # assumed not to have moved
+        if columns is not None and node_id in previous.columns:
+            columns.add(node_id)
+        changed_rows, changed_columns = zone_data_changes(previous, zones_df, columns)
+    if changed_columns is None:
+        changed_columns = zones_df.columns
+
+    affected = affected_nodes(plan, changed_columns, zone_df_name, node_id)
+    updated = [target for target in targets if last[target] in affected]
+    if not updated:
+        logger.info("rebuffer: no targets read the changed zone data")
+        return variables
+
+    # zones whose network results can change (patch_rows), and the zones
+    # network queries are computed at (zone_rows). A query reading another
+    # query's results reads them at zones up to radius further out, so with
+    # chained queries earlier ones are computed further out than results
+    # change: a query k links into the chain of hops is computed within
+    # (2 * hops - 1) * radius and correct within (2 * hops - k) * radius.
+    if changed_rows is None:
+        zone_rows = np.ones(len(zones_df), dtype=bool)
+        patch_rows = zone_rows
+    else:
+        changed_rows = pd.Index(changed_rows)
+        zone_rows = zones_df.index.isin(changed_rows) | ~zones_df.index.isin(previous.index)
+        patch_rows = zone_rows.copy()
+        hops = max(affected[last[target]] for target in updated)
+        removed = changed_rows.difference(zones_df.index)
+        if hops and len(removed) and node_id not in previous.columns:
+            logger.warn("rebuffer: nodes of removed zones are unknown, updating every zone")
+            zone_rows[:] = True
+            patch_rows[:] = True
+        elif hops:
+            network = locals_dict['network']
+            if isinstance(network, CachedNetwork):
+                network = network.network
+            nodes = [zones_df.loc[zones_df.index.intersection(changed_rows), node_id].values]
+            if node_id in previous.columns:
+                # a moved zone changes the results around its old node too
+                old_rows = previous.index.intersection(changed_rows)
+                nodes.append(previous.loc[old_rows, node_id].values)
+            nodes = np.concatenate(nodes)
+            radius = locals_dict['max_dist'] if radius is None else radius
+            origins = zones_df[node_id].unique()
+
+            near = ranges.nodes_reaching(network, nodes, hops * radius, origins=origins,
+                                         chunk_size=chunk_size)
+            patch_rows |= zones_df[node_id].isin(near).values
+            if hops > 1:
+                near = ranges.nodes_reaching(network, nodes, (2 * hops - 1) * radius,
+                                             origins=origins, chunk_size=chunk_size)
+            zone_rows |= zones_df[node_id].isin(near).values
+
+    # the spec rows the updated targets need
+    needed = set()
+    stack = [last[target] for target in updated]
+    while stack:
+        i = stack.pop()
+        if i not in needed:
+            needed.add(i)
+            stack.extend(plan.nodes[i].deps)
+
+    logger.info("rebuffer: updating %s of %s targets (%s spec rows) at %s of %s zones, "
+                "computed at %s" % (len(updated), len(targets), len(needed), patch_rows.sum(),
+                                    len(zone_rows), zone_rows.sum()))
+
+    results, _, _ = buffer_variables(plan.subset(sorted(needed)), zone_df_name, locals_dict,
+                                     chunk_size=chunk_size, poi_store=poi_store,
+                                     zone_rows=zone_rows)
+
+    dependent = network_dependent(plan)
+    for target in updated:
+        if last[target] in dependent:
+            variables.loc[patch_rows, target] = results[target].values[patch_rows]
+        else:
+            variables[target] = results[target].values
+
+    return variables
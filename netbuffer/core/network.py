@@ -1,15 +1,26 @@
 from activitysim.core import config
 from activitysim.core import inject
 
+import json
 import logging
 import sys
 import os
+import time
+import numpy as np
 import pandas as pd
 import pandana as pdna
 from pandana.loaders import osm
 
+from netbuffer.core import buffer
+from netbuffer.core import osm_extract
+from netbuffer.core import ranges
+
 logger = logging.getLogger(__name__)
 
+# Pandana's contraction hierarchy keeps edge impedances as whole thousandths,
+# rounded down
+IMPEDANCE_SCALE = 1000
+
 
 @inject.injectable(cache=True)
 def network(zone_data, settings):
@@ -17,7 +28,7 @@ def network(zone_data, settings):
     Injected Pandana Network object containing network
     node and edge data.
 
-    User can specify three 'network' options in settings.yaml:
+    User can specify four 'network' options in settings.yaml:
 
         - network: read
             uses an existing saved network HDF5 file specified by
@@ -29,6 +40,10 @@ def network(zone_data, settings):
             downloads a complete network from Open Street Maps using
             the 'max_dist' setting and the zone latitudes/longitudes
             found in the zone_data table.
+        - network: extract
+            builds the same walk network as download from a local OSM
+            PBF or XML extract specified by an additional 'osm_extract'
+            setting.
     """
 
     if settings['network'] == 'read':
@@ -37,20 +52,367 @@ def network(zone_data, settings):
     elif settings['network'] == 'download':
         network = get_osm_network(zone_data, settings)
 
+    elif settings['network'] == 'extract':
+        network = get_osm_extract_network(zone_data, settings)
+
     elif settings['network'] == 'build':
         network = build_network(settings)
 
     else:
         raise "Invalid 'network' setting %s" % settings['network']
 
-    network.precompute(settings.get('max_dist')+1)
+    if settings.get('prune_network'):
+        network = prune_network(network, zone_data, settings, points=poi_points())
+
+    precompute_network(network, settings)
 
     return network
 
 
+def poi_points():
+    """
+    Coordinates of the buffer_zones step's POIs, or None without a
+    buffer_zones.yaml 'pois' file, for prune_network to keep the nodes
+    they snap to.
+    """
+
+    buffer_zones_settings = config.read_model_settings('buffer_zones.yaml')
+    if not buffer_zones_settings or 'pois' not in buffer_zones_settings:
+        return None
+
+    constants = config.get_model_constants(buffer_zones_settings)
+    x, y = constants['pois-x'], constants['pois-y']
+    pois = pd.read_csv(config.data_file_path(buffer_zones_settings['pois']), usecols=[x, y])
+
+    return [(pois[x].values, pois[y].values)]
+
+
+def prune_network(network, zone_data, settings, points=None):
+    """
+    Shrink the network to the part buffering and nearby zones can use,
+    before it is precomputed, as set by the 'prune_network' setting:
+
+        - min_component_size: drop connected components with fewer nodes,
+          zones and points on them snap to the rest of the network instead
+        - contract_chains: replace chains of nodes joining exactly two
+          others by single edges, summing their impedances, so distances
+          between the remaining nodes are unchanged. Only for two-way
+          networks. The nodes zones and points snap to are kept, so they
+          snap to the same nodes after pruning, but the contracted nodes
+          no longer count as intersections with two edges (nodes2).
+
+    Edges of nodes further than the precompute distance (max_dist + 1)
+    from every zone's node, other than edges to closer nodes, are always
+    dropped. The far nodes themselves are kept, unconnected, so points
+    snapped later still snap to them and stay out of reach.
+
+    Parameters
+    ----------
+    network : pandana.Network
+    zone_data : orca table-like
+    settings : dict
+    points : list of (x, y) arrays, optional
+        coordinates of other points snapped to the pruned network, e.g.
+        POIs, whose nodes are kept like the zones' nodes
+
+    Returns
+    -------
+    network : pandana.Network
+        the pruned network
+    """
+
+    try:
+        from scipy.sparse.csgraph import connected_components, dijkstra
+        from sklearn.neighbors import KDTree
+    except ImportError:
+        raise ImportError("prune_network requires scipy and scikit-learn")
+
+    options = settings['prune_network']
+    if not isinstance(options, dict):
+        options = {}
+
+    t0 = time.time()
+    nodes, edges = network.nodes_df, network.edges_df
+    twoway = network._twoway
+    imp_names = network.impedance_names
+    a = ranges.node_positions(network, edges['from'].values)
+    b = ranges.node_positions(network, edges['to'].values)
+    weights = edges[imp_names].values.astype(np.float64)
+    keep_node = np.ones(len(nodes), dtype=bool)
+
+    min_size = options.get('min_component_size')
+    if min_size:
+        graph = edge_graph(a, b, np.ones(len(a)), len(nodes))
+        _, labels = connected_components(graph, directed=not twoway, connection='weak')
+        keep_node = np.bincount(labels)[labels] >= min_size
+        keep = keep_node[a] & keep_node[b]
+        a, b, weights = a[keep], b[keep], weights[keep]
+        logger.info('dropping %s nodes on components of fewer than %s nodes'
+                    % ((~keep_node).sum(), min_size))
+
+    # zones snap to the nearest remaining node
+    zones_df = zone_data.to_frame()
+    kept = np.flatnonzero(keep_node)
+    tree = KDTree(nodes[['x', 'y']].values[kept])
+    _, nearest = tree.query(
+        zones_df[[settings['zones_lon'], settings['zones_lat']]].values.astype(np.float64))
+    zone_nodes = np.unique(kept[nearest[:, 0]])
+
+    radius = settings.get('max_dist') + 1
+    graph = edge_graph(a, b, weights[:, 0], len(nodes))
+    dist = dijkstra(graph, directed=not twoway, indices=zone_nodes, limit=radius, min_only=True)
+    near = np.isfinite(dist)
+    keep = near[a] | near[b]
+    a, b, weights = a[keep], b[keep], weights[keep]
+    logger.info('dropping edges of %s nodes out of reach of every zone' % (keep_node & ~near).sum())
+
+    if options.get('contract_chains'):
+        if twoway:
+            protected = np.zeros(len(nodes), dtype=bool)
+            protected[zone_nodes] = True
+            for x, y in points or []:
+                _, nearest = tree.query(np.column_stack([x, y]).astype(np.float64))
+                protected[kept[nearest[:, 0]]] = True
+            a, b, weights, contracted = contract_chains(a, b, weights, protected)
+            keep_node[contracted] = False
+            logger.info('contracted %s chain nodes' % contracted.sum())
+        else:
+            logger.warn('contract_chains is only supported for two-way networks')
+
+    node_ids = nodes.index.values
+    pruned = pdna.Network(nodes['x'][keep_node],
+                          nodes['y'][keep_node],
+                          pd.Series(node_ids[a]),
+                          pd.Series(node_ids[b]),
+                          pd.DataFrame(weights, columns=imp_names),
+                          twoway=twoway)
+    log_stage('pruned network from %s nodes and %s edges to %s nodes and %s edges'
+              % (len(nodes), len(edges), len(pruned.nodes_df), len(pruned.edges_df)), t0)
+
+    return pruned
+
+
+def edge_graph(a, b, weights, n):
+    """
+    Sparse (n x n) matrix of the lowest weight edge from each node position
+    in `a` to the one in `b`, for scipy.sparse.csgraph. Zero weights are
+    made slightly positive so they are not taken for missing edges.
+    """
+
+    from scipy.sparse import csr_matrix
+
+    order = np.lexsort((weights, b, a))
+    a, b, weights = a[order], b[order], weights[order]
+    first = np.ones(len(a), dtype=bool)
+    first[1:] = (a[1:] != a[:-1]) | (b[1:] != b[:-1])
+
+    return csr_matrix((np.maximum(weights[first], 1e-9), (a[first], b[first])), shape=(n, n))
+
+
+def contract_chains(a, b, weights, protected):
+    """
+    Contract unprotected nodes with exactly two edges, to two different
+    nodes, into a single edge whose weights are the sums of theirs, as
+    Pandana rounds them (see IMPEDANCE_SCALE).
+
+    Each pass contracts the chain nodes whose random priority is lower
+    than their chain neighbors', which never touch each other, so chains
+    of any length shrink in a few passes.
+
+    Parameters
+    ----------
+    a, b : numpy.ndarray of int
+        two-way edge end node positions
+    weights : numpy.ndarray of float
+        (number of edges x number of impedances)
+    protected : numpy.ndarray of bool
+        nodes to keep, by position
+
+    Returns
+    -------
+    a, b, weights
+        the contracted edges
+    contracted : numpy.ndarray of bool
+        contracted nodes, by position
+    """
+
+    n = len(protected)
+    priority = np.random.RandomState(0).permutation(n)
+    contracted = np.zeros(n, dtype=bool)
+
+    while True:
+        degree = np.bincount(a, minlength=n) + np.bincount(b, minlength=n)
+        chain = (degree == 2) & ~protected
+
+        # the two edges of each chain node, and the nodes at their other ends
+        ends = np.concatenate([a, b])
+        mask = chain[ends]
+        edge = np.concatenate([np.arange(len(a))] * 2)[mask]
+        other = np.concatenate([b, a])[mask]
+        order = np.argsort(ends[mask], kind='stable')
+        node, edge, other = ends[mask][order][0::2], edge[order], other[order]
+        e1, e2, u, w = edge[0::2], edge[1::2], other[0::2], other[1::2]
+
+        selected = ((u != w) & (u != node) & (w != node) &
+                    (~chain[u] | (priority[node] < priority[u])) &
+                    (~chain[w] | (priority[node] < priority[w])))
+        if not selected.any():
+            break
+
+        node, e1, e2, u, w = node[selected], e1[selected], e2[selected], u[selected], w[selected]
+        keep = np.ones(len(a), dtype=bool)
+        keep[e1] = keep[e2] = False
+        a = np.concatenate([a[keep], u])
+        b = np.concatenate([b[keep], w])
+        # sum the edges as Pandana would have routed over them, with half a
+        # thousandth to spare so Pandana rounds the sum down to itself
+        joined = (np.floor(weights[e1] * IMPEDANCE_SCALE) +
+                  np.floor(weights[e2] * IMPEDANCE_SCALE) + 0.5) / IMPEDANCE_SCALE
+        weights = np.concatenate([weights[keep], joined])
+        contracted[node] = True
+
+    return a, b, weights, contracted
+
+
+def precompute_network(network, settings):
+    """
+    Precompute the network's range queries to max_dist + 1.
+
+    With the 'cache_precompute' setting on, the range table is saved to
+    a file next to the saved network and read back on later runs when the
+    network and distance are unchanged (see ranges.precompute_ranges).
+    Buffering and nearby zones then read ranges from the table, and
+    Pandana's own precompute, which cannot be saved, only runs if an
+    aggregation netbuffer does not batch needs it.
+    """
+
+    distance = settings.get('max_dist') + 1
+
+    if not settings.get('cache_precompute'):
+        network.precompute(distance)
+        return
+
+    # one directory of memory-mapped arrays per network and distance, so
+    # concurrent runs on the same network share the table in the page cache
+    table_path = os.path.join(
+        os.path.splitext(network_file_path(settings))[0] + '_ranges',
+        '%s_%s' % (buffer.network_fingerprint(network)[:16], '%g' % distance))
+    names = ['offsets', 'dest_pos', 'dist']
+
+    if all(os.path.exists(os.path.join(table_path, name + '.npy')) for name in names):
+        logger.info('Reading precomputed ranges from %s' % table_path)
+        arrays = [np.load(os.path.join(table_path, name + '.npy'), mmap_mode='r')
+                  for name in names]
+        ranges.precompute_ranges(network, distance, table=ranges.RangeTable(distance, *arrays))
+        ranges.defer_precompute(network, distance)
+        return
+
+    table = ranges.precompute_ranges(network, distance)
+    logger.info('Saving %s precomputed range pairs to %s' % (len(table.dist), table_path))
+    save_arrays(table_path, {name: getattr(table, name) for name in names})
+    ranges.defer_precompute(network, distance)
+
+
+def save_arrays(path, arrays):
+    """
+    Save a dict of arrays as .npy files in the directory `path`, each
+    written under a temporary name first so concurrent readers never map
+    a partly written file.
+    """
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    for name, values in arrays.items():
+        temp_path = os.path.join(path, '%s.%s.tmp.npy' % (name, os.getpid()))
+        np.save(temp_path, np.ascontiguousarray(values))
+        os.replace(temp_path, os.path.join(path, name + '.npy'))
+
+
+def save_network_arrays(network, path):
+    """
+    Save a Pandana network as a directory of NumPy arrays, which
+    read_network_arrays memory-maps. Node ids must be numeric, edge ids
+    are only kept if they are.
+    """
+
+    nodes, edges = network.nodes_df, network.edges_df
+    arrays = {
+        'node_ids': nodes.index.values,
+        'x': nodes['x'].values,
+        'y': nodes['y'].values,
+        'from': edges['from'].values,
+        'to': edges['to'].values,
+    }
+    if edges.index.dtype.kind in 'iuf':
+        arrays['edge_ids'] = edges.index.values
+    for i, name in enumerate(network.impedance_names):
+        arrays['impedance_%s' % i] = edges[name].values
+
+    save_arrays(path, arrays)
+    with open(os.path.join(path, 'network.json'), 'w') as f:
+        json.dump({'impedance_names': network.impedance_names,
+                   'two_way': bool(network._twoway),
+                   'node_index_name': nodes.index.name,
+                   'edge_index_name': edges.index.name}, f)
+
+
+def read_network_arrays(path):
+    """
+    Read a network saved by save_network_arrays.
+
+    The arrays are memory-mapped rather than read, so there is no HDF5
+    decoding. pandana.Network copies them into its own tables and
+    contraction hierarchy though, so each process still holds its own
+    copy of the network: memory use per run is the same as reading the
+    HDF5 file, only the reading is faster.
+    """
+
+    with open(os.path.join(path, 'network.json')) as f:
+        meta = json.load(f)
+
+    def array(name):
+        return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+    node_ids = pd.Index(array('node_ids'), name=meta.get('node_index_name'))
+    edge_ids = None
+    if os.path.exists(os.path.join(path, 'edge_ids.npy')):
+        edge_ids = pd.Index(array('edge_ids'), name=meta.get('edge_index_name'))
+    weights = pd.DataFrame({name: array('impedance_%s' % i)
+                            for i, name in enumerate(meta['impedance_names'])},
+                           index=edge_ids)
+
+    return pdna.Network(pd.Series(array('x'), index=node_ids),
+                        pd.Series(array('y'), index=node_ids),
+                        pd.Series(array('from'), index=edge_ids),
+                        pd.Series(array('to'), index=edge_ids),
+                        weights,
+                        twoway=meta['two_way'])
+
+
+def save_network(network, settings):
+    """
+    Save a downloaded or built network to the output folder, in the
+    'network_format' setting's format.
+    """
+
+    network_fpath = network_file_path(settings)
+    logger.info('Saving network to %s' % network_fpath)
+    if settings.get('network_format') == 'npy':
+        save_network_arrays(network, network_fpath)
+    else:
+        network.save_hdf5(network_fpath)
+
+
 def read_network_file(settings):
     """
-    Read network from saved HDF5 file
+    Read network from saved HDF5 file, or from a directory of arrays saved
+    by save_network_arrays.
+
+    With the 'network_format: npy' setting, an HDF5 network is converted to
+    arrays the first time it is read, and the arrays are read from then
+    on. They are written to the output folder (see network_arrays_path),
+    so the data folder can be read-only.
     """
 
     network_fname = settings['saved_network']
@@ -58,36 +420,129 @@ def read_network_file(settings):
         logger.error("Please specify 'saved_network' file in settings")
         return
 
-    network_fpath = config.data_file_path(network_fname, mandatory=False) or \
-        config.output_file_path(network_fname)
+    network_fpath = network_file_path(settings)
 
     if not os.path.exists(network_fpath):
         logger.error('No network file %s found' % network_fname)
         return
 
+    if os.path.isdir(network_fpath):
+        logger.info('Reading network arrays from %s' % network_fpath)
+        return read_network_arrays(network_fpath)
+
+    arrays_fpath = network_arrays_path(network_fpath)
+    if settings.get('network_format') == 'npy' and os.path.isdir(arrays_fpath):
+        logger.info('Reading network arrays from %s' % arrays_fpath)
+        return read_network_arrays(arrays_fpath)
+
     logger.info('Reading network from %s' % network_fpath)
     network = pdna.Network.from_hdf5(network_fpath)
 
+    if settings.get('network_format') == 'npy':
+        logger.info('Saving network arrays to %s' % arrays_fpath)
+        save_network_arrays(network, arrays_fpath)
+
     return network
 
 
+def network_arrays_path(network_fpath):
+    """
+    Path of the directory in the output folder that an HDF5 network file
+    is converted to with 'network_format: npy', named like the file.
+    """
+
+    return config.output_file_path(os.path.splitext(os.path.basename(network_fpath))[0])
+
+
+def network_file_path(settings):
+    """
+    Path of the saved network HDF5 file, which is either read from the data
+    or output folder or written to the output folder by download and build.
+    """
+
+    if settings['network'] == 'read':
+        network_fname = settings['saved_network']
+        return config.data_file_path(network_fname, mandatory=False) or \
+            config.output_file_path(network_fname)
+
+    if settings.get('network_format') == 'npy':
+        return config.output_file_path('pandana_network')
+
+    return config.output_file_path('pandana_network.h5')
+
+
+def snapping_store_path(settings, cache_pois=False):
+    """
+    Path of the HDF5 file next to the saved network in which zones and POIs
+    snapped to the network are kept when the 'cache_snapping' setting is on,
+    None otherwise.
+
+    cache_pois is the buffer_zones step's setting of the same name. It keeps
+    only POIs in the store, so it has no effect with 'cache_snapping' on.
+    """
+
+    if not (settings.get('cache_snapping') or cache_pois):
+        return None
+
+    return os.path.splitext(network_file_path(settings))[0] + '_snapping.h5'
+
+
+def snap_zones(zones_df, network, settings):
+    """
+    Nearest network node of each zone and the geodesic distance from the
+    zone to it, in the 'distance_units' setting.
+
+    Both the nearby_zones and buffer_zones steps snap zones through here, so
+    with 'cache_snapping' on, zones already snapped to the same network by
+    either step, in this run or an earlier one, are read back from the
+    snapping store instead.
+
+    Returns
+    -------
+    snapped : pandas.DataFrame
+        net_node_id and net_node_dist columns, indexed like zones_df
+    """
+
+    units = settings.get('distance_units', 'meters')
+    assert units in ['meters', 'miles'], "'distance_units' setting must be 'meters' or 'miles'"
+
+    lon = zones_df[settings['zones_lon']]
+    lat = zones_df[settings['zones_lat']]
+
+    def snap():
+        import pyproj
+
+        node_id = buffer.snap_points(network, lon, lat)['node_id'].values
+        positions = ranges.node_positions(network, node_id)
+
+        # Use pyproj's latlong projection
+        geod = pyproj.Geod(ellps='WGS84')
+        _, _, net_node_dist = geod.inv(np.asarray(lon), np.asarray(lat),
+                                       network.nodes_df.x.values[positions],
+                                       network.nodes_df.y.values[positions])
+        if units == 'miles':
+            net_node_dist = net_node_dist / 1609.34
+
+        return pd.DataFrame({'net_node_id': node_id, 'net_node_dist': net_node_dist},
+                            index=zones_df.index)
+
+    store = snapping_store_path(settings)
+    if store is None:
+        return snap()
+
+    key = 'zones_%s_%s_%s' % (buffer.network_fingerprint(network)[:16],
+                              buffer.data_fingerprint(lon, lat, index=True)[:16], units)
+    return buffer.stored_frame(store, key, snap)
+
+
 def get_osm_network(zone_data, settings):
     """
     Retrieve Pandana network from Open Street Maps
     """
 
     logger.info('getting osm network')
-    zones_df = zone_data.to_frame()
-
+    ymin, xmin, ymax, xmax = zones_bbox(zone_data, settings)
     miles = settings.get('distance_units') == 'miles'
-    # distance to degrees: 111 km = 69 miles = 1 degree of long (y), 3mi = 0.043
-    conversion = 69 if miles else 111 * 1000
-    buffer = settings.get('max_dist') / conversion
-    xmin = min(zones_df[settings['zones_lon']]) - buffer
-    xmax = max(zones_df[settings['zones_lon']]) + buffer
-    ymin = min(zones_df[settings['zones_lat']]) - buffer
-    ymax = max(zones_df[settings['zones_lat']]) + buffer
-    logger.debug('bounding box: %s, %s, %s, %s' % (str(ymin), str(xmin), str(ymax), str(xmax)))
 
     # default type=walk, which excludes freeways
     nodes, edges = osm.network_from_bbox(lat_min=ymin,
@@ -107,16 +562,71 @@ def get_osm_network(zone_data, settings):
                            edges['to'],
                            edges[['distance']])
 
-    print(edges.head())
-    print(edges[['distance']])
-    network.save_hdf5(config.output_file_path('pandana_network.h5'))
+    logger.debug('osm network edges:\n%s' % edges.head())
+    save_network(network, settings)
+
+    return network
+
+
+def get_osm_extract_network(zone_data, settings):
+    """
+    Build the walk network from a local OSM extract, without Overpass access
+    """
+
+    extract_path = config.data_file_path(settings['osm_extract'])
+    logger.info('reading osm network from %s' % extract_path)
+    ymin, xmin, ymax, xmax = zones_bbox(zone_data, settings)
+
+    t0 = time.time()
+    nodes, edges = osm_extract.read_osm_extract(extract_path, ymin, xmin, ymax, xmax)
+    t0 = log_stage('read %s nodes and %s edges' % (len(nodes), len(edges)), t0)
+
+    if settings.get('distance_units') == 'miles':
+        edges['distance'] /= 1609.34
+
+    network = pdna.Network(nodes['x'],
+                           nodes['y'],
+                           edges['from'],
+                           edges['to'],
+                           edges[['distance']])
+    t0 = log_stage('built network', t0)
+
+    save_network(network, settings)
 
     return network
 
 
+def zones_bbox(zone_data, settings):
+    """
+    Bounding box around the zones, extended by max_dist, as
+    (lat_min, lng_min, lat_max, lng_max).
+    """
+
+    zones_df = zone_data.to_frame()
+
+    miles = settings.get('distance_units') == 'miles'
+    # distance to degrees: 111 km = 69 miles = 1 degree of long (y), 3mi = 0.043
+    conversion = 69 if miles else 111 * 1000
+    buffer = settings.get('max_dist') / conversion
+    xmin = min(zones_df[settings['zones_lon']]) - buffer
+    xmax = max(zones_df[settings['zones_lon']]) + buffer
+    ymin = min(zones_df[settings['zones_lat']]) - buffer
+    ymax = max(zones_df[settings['zones_lat']]) + buffer
+    logger.debug('bounding box: %s, %s, %s, %s' % (str(ymin), str(xmin), str(ymax), str(xmax)))
+
+    return ymin, xmin, ymax, xmax
+
+
 def build_network(settings):
     """
     Build a Pandana network from CSV files
+
+    Only the configured columns are read, with compact dtypes, optionally
+    'chunksize' rows at a time or with another pandas CSV 'engine' (e.g.
+    pyarrow) set in the network settings file. Self-loops, duplicate links
+    (keeping the lowest impedance) and nodes no link touches are dropped
+    before the network is built. Time and memory use are logged for each
+    stage.
     """
 
     logger.info('building pandana network')
@@ -128,18 +638,141 @@ def build_network(settings):
     network_settings = config.read_model_settings(network_settings_file)
     logger.debug('using settings %s' % network_settings)
 
-    nodes = pd.read_csv(config.data_file_path(network_settings['nodes']))
-    links = pd.read_csv(config.data_file_path(network_settings['links']))
+    node_id, x, y = [network_settings[k] for k in ['nodes-id', 'nodes-x', 'nodes-y']]
+    link_a, link_b, impedance = [network_settings[k]
+                                 for k in ['links-a', 'links-b', 'links-impedance']]
+    twoway = network_settings['twoway']
+    read_options = {k: network_settings.get(k) for k in ['chunksize', 'engine']}
+
+    t0 = time.time()
+    nodes = read_csv_columns(config.data_file_path(network_settings['nodes']),
+                             {node_id: np.int64, x: np.float64, y: np.float64},
+                             **read_options)
+    t0 = log_stage('read %s nodes' % len(nodes), t0)
+
+    # pandana's contraction hierarchy keeps impedances in single precision
+    links = read_csv_columns(config.data_file_path(network_settings['links']),
+                             {link_a: np.int64, link_b: np.int64, impedance: np.float32},
+                             chunk_filter=lambda df: df[df[link_a] != df[link_b]],
+                             **read_options)
+    t0 = log_stage('read %s links' % len(links), t0)
+
+    nodes, links = clean_network(nodes, links, node_id, link_a, link_b, impedance, twoway)
+    t0 = log_stage('cleaned network to %s nodes and %s links' % (len(nodes), len(links)), t0)
+
+    nodes.index = nodes[node_id]
+
+    network = pdna.Network(nodes[x],
+                           nodes[y],
+                           links[link_a],
+                           links[link_b],
+                           links[[impedance]],
+                           twoway=twoway)
+    t0 = log_stage('built network', t0)
+
+    save_network(network, settings)
+    log_stage('saved network', t0)
+
+    return network
+
 
-    nodes.index = nodes[network_settings['nodes-id']]
+def read_csv_columns(path, columns, chunksize=None, engine=None, chunk_filter=None):
+    """
+    Read only some columns of a CSV file, with the given dtypes.
+
+    Parameters
+    ----------
+    path : str
+    columns : dict
+        column name: dtype
+    chunksize : int, optional
+        read this many rows at a time, applying chunk_filter to each chunk
+        so rows it drops are never all held at once
+    engine : str, optional
+        pandas.read_csv engine, e.g. pyarrow
+    chunk_filter : callable, optional
+        takes and returns a DataFrame, e.g. to drop unwanted rows
+
+    Returns
+    -------
+    df : pandas.DataFrame
+    """
 
-    network = pdna.Network(nodes[network_settings['nodes-x']],
-                           nodes[network_settings['nodes-y']],
-                           links[network_settings['links-a']],
-                           links[network_settings['links-b']],
-                           links[[network_settings['links-impedance']]],
-                           twoway=network_settings['twoway'])
+    kwargs = {'usecols': list(columns), 'dtype': columns}
+    if engine:
+        kwargs['engine'] = engine
+    chunk_filter = chunk_filter or (lambda df: df)
 
-    network.save_hdf5(config.output_file_path('pandana_network.h5'))
+    if not chunksize:
+        return chunk_filter(pd.read_csv(path, **kwargs))
 
-    return network
+    return pd.concat([chunk_filter(chunk) for chunk in
+                      pd.read_csv(path, chunksize=chunksize, **kwargs)], ignore_index=True)
+
+
+def clean_network(nodes, links, node_id, link_a, link_b, impedance, twoway):
+    """
+    Drop the links and nodes that add nothing to the network's shortest
+    paths:
+
+    - self-loops
+    - duplicate links between the same nodes, except the one with the
+      lowest impedance (with twoway, a to b and b to a are the same link)
+    - links to nodes that are not in the nodes table
+    - duplicate nodes, and nodes no link touches
+
+    Zero impedance links between two different nodes are kept, they still
+    connect them.
+
+    Returns
+    -------
+    nodes, links : pandas.DataFrame
+    """
+
+    node_ids = nodes[node_id].values
+    a, b, cost = links[link_a].values, links[link_b].values, links[impedance].values
+
+    keep = np.flatnonzero(a != b)
+    lo, hi = a[keep], b[keep]
+    if twoway:
+        lo, hi = np.minimum(lo, hi), np.maximum(lo, hi)
+    order = np.lexsort((cost[keep], hi, lo))
+    lo, hi = lo[order], hi[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (lo[1:] != lo[:-1]) | (hi[1:] != hi[:-1])
+    keep = np.sort(keep[order[first]])
+    if len(keep) < len(links):
+        logger.info('dropped %s self-loop and duplicate links' % (len(links) - len(keep)))
+
+    known = np.isin(a[keep], node_ids) & np.isin(b[keep], node_ids)
+    if not known.all():
+        logger.warn('dropped %s links to nodes missing from the nodes table' % (~known).sum())
+        keep = keep[known]
+    links = links.iloc[keep]
+
+    used = np.isin(node_ids, np.concatenate([links[link_a].values, links[link_b].values]))
+    used &= ~nodes[node_id].duplicated().values
+    if not used.all():
+        logger.info('dropped %s duplicate and unlinked nodes' % (~used).sum())
+    nodes = nodes[used]
+
+    return nodes, links
+
+
+def log_stage(stage, t0):
+    """
+    Log the time since t0 and the process's memory use (if psutil is
+    installed) at the end of a network stage, returning the time now.
+    """
+
+    t = time.time()
+    try:
+        import psutil
+    except ImportError:
+        # memory use is only logged with psutil installed
+        logger.info('%s in %.1f seconds' % (stage, t - t0))
+        return t
+
+    logger.info('%s in %.1f seconds, %.0f MB in use'
+                % (stage, t - t0, psutil.Process().memory_info().rss / 1e6))
+    return t
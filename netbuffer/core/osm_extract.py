@@ -0,0 +1,184 @@
+import array
+import logging
+import re
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+# the OSMnet way filter used by walk network downloads, tag: pattern a way
+# is excluded for matching
+WAY_FILTERS = {
+    'walk': {
+        'area': 'yes',
+        'highway': 'motor|proposed|construction|abandoned|platform|raceway',
+        'foot': 'no',
+        'pedestrians': 'no',
+    },
+}
+
+# earth radius OSMnet computes great circle distances with, in meters
+EARTH_RADIUS = 6372795
+
+
+def keep_way(tags, network_type='walk'):
+    """
+    Whether a way with these tags is part of a network_type network.
+    """
+
+    if 'highway' not in tags:
+        return False
+
+    return not any(re.search(pattern, tags[tag])
+                   for tag, pattern in WAY_FILTERS[network_type].items() if tag in tags)
+
+
+def iter_osm_xml(path):
+    """
+    Stream the nodes and ways of an OSM XML file.
+
+    Yields
+    ------
+    ('node', id, lon, lat) and ('way', id, node_refs, tags) tuples
+    """
+
+    context = ET.iterparse(path, events=('start', 'end'))
+    _, root = next(context)
+    refs, tags = [], {}
+    for event, elem in context:
+        if event == 'start':
+            if elem.tag == 'way':
+                refs, tags = [], {}
+            continue
+        if elem.tag == 'node':
+            yield 'node', int(elem.get('id')), float(elem.get('lon')), float(elem.get('lat'))
+        elif elem.tag == 'nd':
+            refs.append(int(elem.get('ref')))
+        elif elem.tag == 'tag':
+            tags[elem.get('k')] = elem.get('v')
+        elif elem.tag == 'way':
+            yield 'way', int(elem.get('id')), refs, tags
+        # parsed elements are not needed again
+        if elem.tag in ('node', 'way', 'relation'):
+            root.clear()
+
+
+def iter_osm_pbf(path):
+    """
+    Stream the nodes and ways of an OSM PBF file, which requires pyosmium.
+
+    Yields
+    ------
+    ('node', id, lon, lat) and ('way', id, node_refs, tags) tuples
+    """
+
+    try:
+        import osmium
+    except ImportError:
+        raise ImportError("reading OSM PBF extracts requires pyosmium, "
+                          "or convert the extract to OSM XML")
+
+    for obj in osmium.FileProcessor(path, osmium.osm.NODE | osmium.osm.WAY):
+        if obj.is_node():
+            yield 'node', obj.id, obj.location.lon, obj.location.lat
+        elif obj.is_way():
+            yield ('way', obj.id, [node.ref for node in obj.nodes],
+                   {tag.k: tag.v for tag in obj.tags})
+
+
+def great_circle_distance(lat1, lon1, lat2, lon2):
+    """
+    Haversine distance in meters between arrays of points, as OSMnet
+    computes it.
+    """
+
+    lat1, lon1, lat2, lon2 = [np.radians(a) for a in (lat1, lon1, lat2, lon2)]
+    a = np.sin((lat2 - lat1) / 2) ** 2
+    b = np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a + b))
+
+
+def read_osm_extract(path, lat_min, lng_min, lat_max, lng_max, network_type='walk'):
+    """
+    Read the network_type network within a bounding box from a local OSM
+    PBF or XML extract, instead of downloading it from the Overpass API.
+
+    The extract is streamed: only the coordinates of nodes inside the box
+    and the node references of ways passing the network_type filter are
+    kept, in compact arrays, and the network is built from them with
+    numpy. Ways are cut where they leave the box.
+
+    As with an OSMnet download, the network's nodes are the nodes shared
+    by more than one way, and each edge joins consecutive shared nodes of
+    a way with their great circle distance in meters.
+
+    Parameters
+    ----------
+    path : str
+        .pbf file, or OSM XML file (.osm, .xml)
+    lat_min, lng_min, lat_max, lng_max : float
+    network_type : str, optional
+        a WAY_FILTERS key
+
+    Returns
+    -------
+    nodes : pandas.DataFrame
+        x and y columns, indexed by OSM node id
+    edges : pandas.DataFrame
+        from, to and distance columns
+    """
+
+    elements = iter_osm_pbf(path) if path.endswith('.pbf') else iter_osm_xml(path)
+
+    node_ids, lons, lats = array.array('q'), array.array('d'), array.array('d')
+    way_refs, way_index = array.array('q'), array.array('q')
+    n_ways = 0
+    for element in elements:
+        if element[0] == 'node':
+            _, node_id, lon, lat = element
+            if lng_min <= lon <= lng_max and lat_min <= lat <= lat_max:
+                node_ids.append(node_id)
+                lons.append(lon)
+                lats.append(lat)
+        elif keep_way(element[3], network_type):
+            way_refs.extend(element[2])
+            way_index.extend([n_ways] * len(element[2]))
+            n_ways += 1
+
+    node_ids, lons, lats = np.frombuffer(node_ids, dtype=np.int64), \
+        np.frombuffer(lons), np.frombuffer(lats)
+    refs, way = np.frombuffer(way_refs, dtype=np.int64), np.frombuffer(way_index, dtype=np.int64)
+    logger.info("read %s nodes in the bounding box and %s %s ways from %s"
+                % (len(node_ids), n_ways, network_type, path))
+
+    order = np.argsort(node_ids, kind='stable')
+    node_ids, lons, lats = node_ids[order], lons[order], lats[order]
+    positions = np.searchsorted(node_ids, refs).clip(max=max(len(node_ids) - 1, 0))
+    inside = (node_ids[positions] == refs) if len(node_ids) else np.zeros(len(refs), bool)
+
+    # a way is cut into a new segment after every stretch outside the box
+    new_segment = np.ones(len(refs), dtype=bool)
+    new_segment[1:] = (way[1:] != way[:-1]) | ~inside[:-1]
+    segment = np.cumsum(new_segment)[inside]
+    refs, positions = refs[inside], positions[inside]
+
+    # only nodes shared by more than one way become network nodes
+    _, inverse, counts = np.unique(refs, return_inverse=True, return_counts=True)
+    shared = counts[inverse] > 1
+    segment, refs, positions = segment[shared], refs[shared], positions[shared]
+
+    pair = (segment[1:] == segment[:-1]) & (refs[1:] != refs[:-1])
+    a, b = positions[:-1][pair], positions[1:][pair]
+
+    edges = pd.DataFrame({'from': node_ids[a],
+                          'to': node_ids[b],
+                          'distance': great_circle_distance(lats[a], lons[a],
+                                                            lats[b], lons[b]).round(6)})
+    used = np.unique(np.concatenate([a, b]))
+    nodes = pd.DataFrame({'x': lons[used], 'y': lats[used]},
+                         index=pd.Index(node_ids[used], name='id'))
+
+    return nodes, edges
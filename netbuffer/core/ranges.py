@@ -0,0 +1,629 @@
+import itertools
+import logging
+import mmap
+import weakref
+
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+# number of origin nodes whose range queries are held in memory at once
+DEFAULT_CHUNK_SIZE = 10000
+
+# dtype of internal node indices, positions in network.node_ids
+NODE_INDEX_DTYPE = np.int32
+
+# precomputed range tables by network and impedance, see precompute_ranges
+range_tables = weakref.WeakKeyDictionary()
+
+# Pandana precompute distances put off until a Pandana aggregation needs them
+deferred_precomputes = weakref.WeakKeyDictionary()
+
+
+def node_positions(network, node_ids):
+    """
+    Translate network node ids to their integer position in the network.
+
+    Parameters
+    ----------
+    network : pandana.Network
+    node_ids : array-like of network node ids
+
+    Returns
+    -------
+    positions : numpy.ndarray of NODE_INDEX_DTYPE
+        position of each node id in network.node_ids, -1 if not found
+    """
+
+    return network.node_ids.get_indexer(np.asanyarray(node_ids)).astype(NODE_INDEX_DTYPE)
+
+
+def as_impedance(distance):
+    """
+    Round distances to the single precision Pandana uses for impedances, so
+    that comparisons against range query results match Pandana's own
+    aggregations for nodes lying exactly on a distance threshold.
+    """
+
+    return np.asanyarray(distance, dtype=np.float32).astype(np.float64)
+
+
+def iter_range_pairs(network, radius, origins=None, imp_name=None, chunk_size=None):
+    """
+    Generate all (origin, destination, distance) node pairs within `radius`.
+
+    Origins are processed `chunk_size` nodes at a time using Pandana's
+    range query, so each origin's reachable node set is computed exactly
+    once per call and memory is bounded by the size of a chunk. If a range
+    table at least `radius` deep was precomputed for the network (see
+    precompute_ranges), the pairs are read from it instead.
+
+    Parameters
+    ----------
+    network : pandana.Network
+    radius : float
+        maximum network distance
+    origins : array-like of node ids, optional
+        origin nodes, defaults to every node in the network
+    imp_name : str, optional
+        impedance name, see pandana.Network.aggregate
+    chunk_size : int, optional
+        number of origins per chunk, defaults to DEFAULT_CHUNK_SIZE
+
+    Yields
+    ------
+    origin_pos : numpy.ndarray of int
+        position of each origin in the chunk within `origins`, sorted
+    dest_pos : numpy.ndarray of int
+        position of the destination node in the network
+    dist : numpy.ndarray of float
+        network distance from origin to destination
+    """
+
+    node_ids = network.node_ids.values.astype(np.int64)
+    origins = node_ids if origins is None else np.asanyarray(origins).astype(np.int64)
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    imp_num = network._imp_name_to_num(imp_name)
+    radius = as_impedance(radius)
+
+    table = range_tables.get(network, {}).get(imp_num)
+    if table is not None and radius <= table.radius:
+        for start in range(0, len(origins), chunk_size):
+            yield table.pairs(node_positions(network, origins[start:start + chunk_size]),
+                              radius, start)
+        return
+
+    for start in range(0, len(origins), chunk_size):
+        chunk = origins[start:start + chunk_size]
+        raw = network.net.nodes_in_range(chunk, radius, imp_num, node_ids)
+
+        counts = np.fromiter((len(r) for r in raw), dtype=np.int64, count=len(raw))
+        pairs = np.fromiter(itertools.chain.from_iterable(itertools.chain.from_iterable(raw)),
+                            dtype=np.float64, count=2 * counts.sum()).reshape(-1, 2)
+
+        origin_pos = np.repeat(np.arange(start, start + len(chunk)), counts)
+        dest_pos = node_positions(network, pairs[:, 0].astype(np.int64))
+        dist = pairs[:, 1]
+
+        # the range query can overshoot the radius and repeat destinations
+        keep = dist <= radius
+        origin_pos, dest_pos, dist = origin_pos[keep], dest_pos[keep], dist[keep]
+        _, first = np.unique(origin_pos * len(node_ids) + dest_pos, return_index=True)
+
+        yield origin_pos[first], dest_pos[first], dist[first]
+
+
+class RangeTable(object):
+    """
+    Every network node's destinations within a radius, the range query
+    results Pandana's precompute keeps in memory, held as compressed
+    sparse rows so they can be saved and loaded.
+
+    Parameters
+    ----------
+    radius : float
+        distance the table was computed to
+    offsets : numpy.ndarray of int
+        destinations of the node at position i are rows offsets[i] to
+        offsets[i + 1], sorted by destination position
+    dest_pos : numpy.ndarray of NODE_INDEX_DTYPE
+        destination node positions
+    dist : numpy.ndarray of float32
+        network distances, single precision as Pandana computes them
+    """
+
+    def __init__(self, radius, offsets, dest_pos, dist):
+        self.radius = as_impedance(radius)
+        self.offsets = np.asanyarray(offsets, dtype=np.int64)
+        self.dest_pos = np.asanyarray(dest_pos, dtype=NODE_INDEX_DTYPE)
+        self.dist = np.asanyarray(dist, dtype=np.float32)
+
+    def pairs(self, positions, radius, start=0):
+        """
+        Destinations within `radius` of the nodes at `positions`, as
+        iter_range_pairs yields them for a chunk starting at `start`.
+        """
+
+        starts = self.offsets[positions]
+        counts = self.offsets[positions + 1] - starts
+        # row numbers of each origin's destinations, in origin order
+        rows = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+        origin_pos = np.repeat(np.arange(start, start + len(positions)), counts)
+        dest_pos = self.dest_pos[rows]
+        dist = self.dist[rows].astype(np.float64)
+
+        keep = dist <= radius
+        return origin_pos[keep], dest_pos[keep], dist[keep]
+
+    def __getstate__(self):
+        # arrays memory-mapped from .npy files are sent to other processes
+        # as their file names, so they map the file rather than copy it
+        state = self.__dict__.copy()
+        for name, array in state.items():
+            if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap):
+                state[name] = MappedArray(array.filename)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            if isinstance(value, MappedArray):
+                state[name] = np.load(value.filename, mmap_mode='r')
+        self.__dict__.update(state)
+
+
+class MappedArray(object):
+    """
+    Placeholder for a read only memory-mapped .npy file in a pickled
+    RangeTable.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+
+def precompute_ranges(network, radius, imp_name=None, chunk_size=None, table=None):
+    """
+    Compute, or install, the range table iter_range_pairs answers queries
+    up to `radius` from instead of running Pandana range queries.
+
+    Parameters
+    ----------
+    network : pandana.Network
+    radius : float
+    imp_name : str, optional
+    chunk_size : int, optional
+    table : RangeTable, optional
+        a table saved from an earlier run on the same network, installed
+        as is
+
+    Returns
+    -------
+    table : RangeTable
+    """
+
+    imp_num = network._imp_name_to_num(imp_name)
+    if table is None:
+        origin_pos, dest_pos, dist = [
+            np.concatenate(arrays) for arrays in zip(*iter_range_pairs(
+                network, radius, imp_name=imp_name, chunk_size=chunk_size))]
+        counts = np.bincount(origin_pos, minlength=len(network.node_ids))
+        table = RangeTable(radius, np.concatenate([[0], np.cumsum(counts)]), dest_pos, dist)
+
+    range_tables.setdefault(network, {})[imp_num] = table
+    return table
+
+
+def defer_precompute(network, distance):
+    """
+    Put off Pandana's own range precompute until a Pandana aggregation
+    runs, see run_deferred_precompute. Queries netbuffer batches read
+    the range table instead.
+    """
+
+    deferred_precomputes[network] = distance
+
+
+def run_deferred_precompute(network):
+    """
+    Run a Pandana precompute put off by defer_precompute, if any.
+    """
+
+    distance = deferred_precomputes.pop(network, None)
+    if distance is not None:
+        logger.info("running deferred precompute to %s" % distance)
+        network.precompute(distance)
+
+
+def accumulate(out, positions, values):
+    """
+    Add rows of values into out at positions, which must be sorted.
+
+    Parameters
+    ----------
+    out : numpy.ndarray
+        1 or 2 dimensional array, updated in place
+    positions : numpy.ndarray of int
+        sorted row position in out of each row of values
+    values : numpy.ndarray
+        same number of dimensions as out
+    """
+
+    if len(positions) == 0:
+        return
+    rows, starts = np.unique(positions, return_index=True)
+    out[rows] += np.add.reduceat(values, starts, axis=0)
+
+
+def node_totals(network, node_ids, variable=None):
+    """
+    Sum a variable to the network nodes it is attached to, the same way
+    pandana.Network.set does.
+
+    Parameters
+    ----------
+    network : pandana.Network
+    node_ids : pandas.Series of node ids
+    variable : pandas.Series, optional
+        values at each location, defaults to ones
+
+    Returns
+    -------
+    totals : numpy.ndarray of float
+        variable total at each network node position
+    """
+
+    positions = node_positions(network, node_ids)
+    if variable is None:
+        values = np.ones(len(positions))
+    else:
+        values = np.asanyarray(variable, dtype=np.float64)
+
+    keep = (positions >= 0) & ~np.isnan(values)
+    return np.bincount(positions[keep], weights=values[keep], minlength=len(network.node_ids))
+
+
+def band_weights(edges, weights=None):
+    """
+    Validate ring edges and resolve the weight of each ring.
+
+    Parameters
+    ----------
+    edges : array-like of float
+        increasing outer distance of each ring
+    weights : array-like of float, callable or None
+        weight of each ring, a function of the ring outer edges,
+        or None to weight every ring equally
+
+    Returns
+    -------
+    edges, weights : numpy.ndarray of float
+    """
+
+    edges = np.asanyarray(edges, dtype=np.float64)
+    if edges.ndim != 1 or len(edges) == 0 or (np.diff(edges) <= 0).any():
+        raise RuntimeError("band edges must be a non-empty increasing list of distances")
+
+    if weights is None:
+        weights = np.ones(len(edges))
+    elif callable(weights):
+        weights = weights(edges)
+    weights = np.asanyarray(weights, dtype=np.float64)
+
+    if weights.shape != edges.shape:
+        raise RuntimeError("expected %s band weights but got %s" % (len(edges), len(weights)))
+
+    return edges, weights
+
+
+def decay_weights(distance, decay):
+    """
+    Weight function for a Pandana style aggregate within `distance`.
+
+    Parameters
+    ----------
+    distance : float
+        aggregation radius
+    decay : str
+        'flat', 'linear' or 'exp', see pandana.Network.aggregate
+
+    Returns
+    -------
+    weight_fn : callable
+        maps an array of node distances to their weights
+    """
+
+    if decay == 'flat':
+        return lambda dist: np.ones(len(dist))
+    if decay == 'linear':
+        return lambda dist: 1 - dist / distance
+    if decay == 'exp':
+        return lambda dist: np.exp(-dist / distance)
+
+    raise RuntimeError("unsupported decay '%s'" % decay)
+
+
+def ring_weights(edges, weights=None):
+    """
+    Weight function for distance bands (rings).
+
+    Ring k holds the nodes whose distance d from the origin satisfies
+    edges[k-1] < d <= edges[k] (the first ring starts at distance 0), and
+    every node in ring k gets weights[k].
+
+    Parameters
+    ----------
+    edges : array-like of float
+        increasing outer distance of each ring
+    weights : array-like of float, callable or None
+        see band_weights
+
+    Returns
+    -------
+    weight_fn : callable
+        maps an array of node distances to their weights
+    """
+
+    edges, weights = band_weights(edges, weights)
+    thresholds = as_impedance(edges)
+
+    return lambda dist: weights[np.searchsorted(thresholds, dist, side='left')]
+
+
+def range_sums(network, totals, queries, origins=None, imp_name=None, chunk_size=None):
+    """
+    Distance weighted sums of node variables for several queries at once.
+
+    The range query for each origin is run once, at the largest radius of
+    all queries, and every query is accumulated from the same node pairs.
+    Each query can sum several variables (columns of `totals`) that share
+    the same radius and weights.
+
+    Parameters
+    ----------
+    network : pandana.Network
+    totals : numpy.ndarray of float
+        (number of network nodes x number of variables) variable totals at
+        each network node position, see node_totals
+    queries : list of (radius, weight_fn, columns)
+        maximum distance, weight function (see decay_weights and
+        ring_weights) and the list of `totals` columns to sum
+    origins : array-like of node ids, optional
+        origin nodes, defaults to every node in the network
+    imp_name : str, optional
+    chunk_size : int, optional
+
+    Returns
+    -------
+    sums : list of numpy.ndarray
+        (number of origins x number of columns) sums for each query
+    """
+
+    origins = network.node_ids if origins is None else pd.Index(origins)
+    radius = max(query[0] for query in queries)
+
+    blocks = [totals[:, columns] for _, _, columns in queries]
+    sums = [np.zeros((len(origins), len(columns))) for _, _, columns in queries]
+
+    for origin_pos, dest_pos, dist in iter_range_pairs(network, radius, origins,
+                                                       imp_name, chunk_size):
+        for (query_radius, weight_fn, _), block, out in zip(queries, blocks, sums):
+            keep = dist <= as_impedance(query_radius)
+            weights = weight_fn(dist[keep])
+            accumulate(out, origin_pos[keep], block[dest_pos[keep]] * weights[:, None])
+
+    return sums
+
+
+def band_sums(network, totals, edges, weights=None, origins=None,
+              imp_name=None, chunk_size=None):
+    """
+    Weighted sum of a node variable over distance bands (rings).
+
+    Ring k holds the nodes whose distance d from the origin satisfies
+    edges[k-1] < d <= edges[k] (the first ring starts at distance 0), so
+    the result equals::
+
+        sum_k weights[k] * (aggregate(edges[k]) - aggregate(edges[k-1]))
+
+    for a flat sum aggregate, but every ring is computed from a single
+    range query per origin.
+
+    Parameters
+    ----------
+    network : pandana.Network
+    totals : numpy.ndarray of float
+        variable total at each network node position, see node_totals
+    edges : array-like of float
+        increasing outer distance of each ring
+    weights : array-like of float, callable or None
+        see band_weights
+    origins : array-like of node ids, optional
+        origin nodes, defaults to every node in the network
+    imp_name : str, optional
+    chunk_size : int, optional
+
+    Returns
+    -------
+    sums : pandas.Series
+        weighted sum for each origin, indexed by origin node id
+    """
+
+    edges, weights = band_weights(edges, weights)
+    if origins is None:
+        origins = network.node_ids
+    elif not isinstance(origins, pd.Index):
+        origins = pd.Index(origins)
+
+    sums, = range_sums(network, totals[:, None], [(edges[-1], ring_weights(edges, weights), [0])],
+                       origins, imp_name, chunk_size)
+
+    return pd.Series(sums[:, 0], index=origins)
+
+
+def nearest_distances(network, labels, radius, origins=None, imp_name=None, chunk_size=None):
+    """
+    Distance from each origin to the nearest node of several categories.
+
+    All categories are searched in the same range query per origin.
+
+    Parameters
+    ----------
+    network : pandana.Network
+    labels : numpy.ndarray of bool
+        (number of network nodes x number of categories) whether a node
+        position holds (a POI of) each category
+    radius : float
+        maximum network distance to search
+    origins : array-like of node ids, optional
+        origin nodes, defaults to every node in the network
+    imp_name : str, optional
+    chunk_size : int, optional
+
+    Returns
+    -------
+    distances : numpy.ndarray of float
+        (number of origins x number of categories) distance to the nearest
+        node of each category, inf where there is none within radius
+    """
+
+    origins = network.node_ids if origins is None else pd.Index(origins)
+    labels = np.asanyarray(labels, dtype=bool)
+    nearest = np.full((len(origins), labels.shape[1]), np.inf)
+
+    for origin_pos, dest_pos, dist in iter_range_pairs(network, radius, origins,
+                                                       imp_name, chunk_size):
+        if len(origin_pos) == 0:
+            continue
+        candidates = np.where(labels[dest_pos], dist[:, None], np.inf)
+        rows, starts = np.unique(origin_pos, return_index=True)
+        nearest[rows] = np.minimum(nearest[rows],
+                                   np.minimum.reduceat(candidates, starts, axis=0))
+
+    return nearest
+
+
+def node_labels(network, node_ids):
+    """
+    Mark the network nodes belonging to each of several sets of nodes.
+
+    Parameters
+    ----------
+    network : pandana.Network
+    node_ids : list of array-like of node ids
+
+    Returns
+    -------
+    labels : numpy.ndarray of bool
+        (number of network nodes x len(node_ids)) whether each node
+        position is in each set
+    """
+
+    labels = np.zeros((len(network.node_ids), len(node_ids)), dtype=bool)
+    for column, ids in enumerate(node_ids):
+        positions = node_positions(network, ids)
+        labels[positions[positions >= 0], column] = True
+
+    return labels
+
+
+def iter_zone_pairs(network, zone_nodes, radius, imp_name=None, chunk_size=None):
+    """
+    Generate all pairs of zones whose network nodes are within `radius`.
+
+    Only the nodes zones are attached to are used as origins, and pairs are
+    emitted in sparse (COO) form a chunk of origin nodes at a time, so
+    memory scales with the number of pairs in a chunk rather than with
+    the number of network nodes times the most zones near any node.
+
+    Parameters
+    ----------
+    network : pandana.Network
+    zone_nodes : pandas.Series
+        network node id of each zone, indexed by zone id
+    radius : float
+        maximum network distance
+    imp_name : str, optional
+    chunk_size : int, optional
+
+    Yields
+    ------
+    a_node_idx : numpy.ndarray of NODE_INDEX_DTYPE
+        origin network node position, in increasing order of node id
+    b_zone_id : numpy.ndarray
+        destination zone id
+    dist : numpy.ndarray of float
+        network distance between the nodes, increasing for each origin
+    """
+
+    positions = node_positions(network, zone_nodes.values)
+    mapped = positions >= 0
+
+    # zones at each node position, CSR style
+    order = np.argsort(positions[mapped], kind='stable')
+    zone_ids = zone_nodes.index.values[mapped][order]
+    counts = np.bincount(positions[mapped], minlength=len(network.node_ids))
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    origins = network.node_ids[counts > 0].sort_values()
+    origin_nodes = node_positions(network, origins)
+
+    for origin_pos, dest_pos, dist in iter_range_pairs(network, radius, origins,
+                                                       imp_name, chunk_size):
+        n = counts[dest_pos]
+        first = np.repeat(offsets[dest_pos] - (np.cumsum(n) - n), n)
+        b_zone_id = zone_ids[first + np.arange(n.sum())]
+        origin_pos, dist = np.repeat(origin_pos, n), np.repeat(dist, n)
+
+        order = np.lexsort((b_zone_id, dist, origin_pos))
+        yield origin_nodes[origin_pos[order]], b_zone_id[order], dist[order]
+
+
+def nodes_reaching(network, node_ids, radius, origins=None, imp_name=None, chunk_size=None):
+    """
+    Find the nodes from which any of a set of nodes is within `radius`,
+    the origins whose range queries can see them.
+
+    On two-way networks distances are the same both ways, so these are
+    the nodes within range of node_ids. Otherwise every origin is
+    searched for them.
+
+    Parameters
+    ----------
+    network : pandana.Network
+    node_ids : array-like of node ids
+    radius : float
+    origins : array-like of node ids, optional
+        candidate origins of one-way networks, defaults to every node
+    imp_name : str, optional
+    chunk_size : int, optional
+
+    Returns
+    -------
+    node_ids : numpy.ndarray
+        sorted node ids
+    """
+
+    node_ids = np.unique(np.asanyarray(node_ids))
+    node_ids = node_ids[node_positions(network, node_ids) >= 0]
+    if len(node_ids) == 0:
+        return node_ids
+
+    if network._twoway:
+        found = [dest_pos for _, dest_pos, _ in iter_range_pairs(network, radius, node_ids,
+                                                                 imp_name, chunk_size)]
+        positions = np.unique(np.concatenate(found))
+        return network.node_ids.values[positions]
+
+    origins = network.node_ids.values if origins is None else np.unique(origins)
+    targets = np.zeros(len(network.node_ids), dtype=bool)
+    targets[node_positions(network, node_ids)] = True
+
+    reaching = np.zeros(len(origins), dtype=bool)
+    for origin_pos, dest_pos, _ in iter_range_pairs(network, radius, origins,
+                                                    imp_name, chunk_size):
+        reaching[origin_pos[targets[dest_pos]]] = True
+
+    return origins[reaching]
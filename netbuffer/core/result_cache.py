@@ -0,0 +1,132 @@
+import logging
+import os
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+# default size bound of a result cache, in bytes
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+SUFFIX = '.npy'
+
+
+class ResultCache(object):
+    """
+    Arrays kept on local disk under content hash keys, one .npy file per
+    key, evicting the least recently used when the files grow past
+    max_size bytes.
+
+    Files are written under a temporary name and renamed into place, so
+    runs sharing a cache directory never read a partly written result.
+    Reading a result marks it as recently used by touching its file.
+
+    Parameters
+    ----------
+    path : str
+        directory of the cache, created if it does not exist
+    max_size : int, optional
+        size bound in bytes, defaults to DEFAULT_MAX_SIZE
+    """
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = DEFAULT_MAX_SIZE if max_size is None else max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    def file_path(self, key):
+        return os.path.join(self.path, key + SUFFIX)
+
+    def get(self, key):
+        """
+        The array stored under key, or None if there is none.
+        """
+
+        path = self.file_path(key)
+        try:
+            with open(path, 'rb') as f:
+                values = np.load(f, allow_pickle=False)
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, ValueError) as err:
+            logger.warn("result cache: dropping unreadable %s: %s" % (path, err))
+            self.remove(path)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return values
+
+    def put(self, key, values):
+        """
+        Store an array under key and evict the least recently used arrays
+        past max_size. Object arrays can't be stored and are left out.
+
+        Returns
+        -------
+        stored : bool
+        """
+
+        values = np.asarray(values)
+        if values.dtype.hasobject:
+            logger.debug("result cache: not storing %s array %s" % (values.dtype, key))
+            return False
+
+        path = self.file_path(key)
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, values, allow_pickle=False)
+        os.replace(tmp_path, path)
+
+        self.evict()
+        return True
+
+    def entries(self):
+        """
+        (last used time, size, path) of the cached files, least recently
+        used first.
+        """
+
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(SUFFIX):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """
+        Remove least recently used files until the cache fits max_size.
+        """
+
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            logger.debug("result cache: evicting %s" % path)
+            self.remove(path)
+            total -= size
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def log_stats(self):
+        logger.info("result cache: %s hits, %s misses" % (self.hits, self.misses))
@@ -1,5 +1,6 @@
 
 import os.path
+import pickle
 import numpy.testing as npt
 import numpy as np
 import pandas as pd
@@ -9,6 +10,8 @@ import pytest
 
 
 from .. import buffer
+from .. import ranges
+from .. import result_cache
 from activitysim.core import tracing
 
 
@@ -121,3 +124,659 @@ def test_buffer_variables(capsys, spec_name, net_name, zone_name):
     # assert locals_d['_shadow'] == 99
 
     out, err = capsys.readouterr()
+
+
+def test_cached_network(net_name, zone_name):
+
+    network = pdna.Network.from_hdf5(net_name)
+    network.precompute(2641)
+    zone_data_df = pd.read_csv(zone_name, index_col='zoneid')
+    node_ids = network.get_node_ids(zone_data_df['xcoord_p'], zone_data_df['ycoord_p'])
+
+    cached = buffer.CachedNetwork(network)
+    cached.set(node_ids, variable=zone_data_df['emptot_p'], name='emptot_p')
+    first = cached.aggregate(2640, type='sum', decay='flat', name='emptot_p')
+    second = cached.aggregate(2640, type='sum', decay='flat', name='emptot_p')
+    assert (cached.hits, cached.misses) == (1, 1)
+    pdt.assert_series_equal(first, second)
+
+    # re-setting the same data keeps the cached results
+    cached.set(node_ids, variable=zone_data_df['emptot_p'], name='emptot_p')
+    cached.aggregate(2640, type='sum', decay='flat', name='emptot_p')
+    assert (cached.hits, cached.misses) == (2, 1)
+
+    # new data under the same name invalidates them
+    cached.set(node_ids, variable=zone_data_df['emptot_p'] * 2, name='emptot_p')
+    doubled = cached.aggregate(2640, type='sum', decay='flat', name='emptot_p')
+    assert (cached.hits, cached.misses) == (2, 2)
+    npt.assert_allclose(doubled.values, first.values * 2)
+
+    # the network only loaded the variable when the data changed
+    assert (cached.sets, cached.loads) == (3, 2)
+
+    # a POI category of the same name is cached separately
+    cached.set_pois(category='emptot_p', maxdist=2640, maxitems=1,
+                    x_col=zone_data_df['xcoord_p'], y_col=zone_data_df['ycoord_p'])
+    cached.nearest_pois(2640, 'emptot_p')
+    cached.set(node_ids, variable=zone_data_df['emptot_p'] * 3, name='emptot_p')
+    cached.nearest_pois(2640, 'emptot_p')
+    cached.aggregate(2640, type='sum', decay='flat', name='emptot_p')
+    assert (cached.hits, cached.misses) == (3, 4)
+
+
+def test_bands(net_name, zone_name):
+
+    network = pdna.Network.from_hdf5(net_name)
+    zone_data_df = pd.read_csv(zone_name, index_col='zoneid')
+    node_ids = network.get_node_ids(zone_data_df['xcoord_p'], zone_data_df['ycoord_p'])
+
+    cached = buffer.CachedNetwork(network)
+    cached.set(node_ids, variable=zone_data_df['emptot_p'], name='emptot_p')
+    network.set(node_ids, variable=zone_data_df['emptot_p'], name='emptot_p')
+
+    edges = [500, 1000, 1500, 2640]
+    weights = [1, 0.75, 0.5, 0.25]
+    bands = cached.bands(name='emptot_p', edges=edges, weights=weights)
+
+    expected = network.aggregate(edges[0], type='sum', decay='flat', name='emptot_p') * weights[0]
+    for inner, outer, weight in zip(edges[:-1], edges[1:], weights[1:]):
+        expected += (network.aggregate(outer, type='sum', decay='flat', name='emptot_p') -
+                     network.aggregate(inner, type='sum', decay='flat', name='emptot_p')) * weight
+
+    assert bands.index.equals(expected.index)
+    npt.assert_allclose(bands.values, expected.values)
+    assert bands.loc[node_ids].sum() > 0
+
+    # weights can be a function of the band edges
+    linear = cached.bands(name='emptot_p', edges=edges, weights=lambda d: 1 - d / 2640.)
+    npt.assert_allclose(linear.values, cached.bands(
+        name='emptot_p', edges=edges, weights=[1 - d / 2640. for d in edges]).values)
+
+    with pytest.raises(RuntimeError):
+        cached.bands(name='emptot_p', edges=[1000, 500])
+
+
+def test_prefetch(net_name, zone_name):
+
+    network = pdna.Network.from_hdf5(net_name)
+    zone_data_df = pd.read_csv(zone_name, index_col='zoneid')
+    node_ids = network.get_node_ids(zone_data_df['xcoord_p'], zone_data_df['ycoord_p'])
+    origins = node_ids.unique()
+
+    cached = buffer.CachedNetwork(network, origins=origins)
+    queries = []
+    for name in ['emptot_p', 'empedu_p']:
+        version = buffer.data_fingerprint(node_ids, zone_data_df[name])
+        for distance in [1000, 2640]:
+            for decay in ['flat', 'exp', 'linear']:
+                params = dict(distance=distance, type='sum', decay=decay, imp_name=None, name=name)
+                queries.append(('aggregate', params, version, node_ids, zone_data_df[name]))
+        params = dict(name=name, edges=[1000, 2640], weights=[1, 0.5], imp_name=None)
+        queries.append(('bands', params, version, node_ids, zone_data_df[name]))
+
+    cached.prefetch(queries)
+    assert cached.batched == 14
+
+    for name in ['emptot_p', 'empedu_p']:
+        cached.set(node_ids, variable=zone_data_df[name], name=name)
+        network.set(node_ids, variable=zone_data_df[name], name=name)
+        for distance in [1000, 2640]:
+            for decay in ['flat', 'exp', 'linear']:
+                batched = cached.aggregate(distance, type='sum', decay=decay, name=name)
+                expected = network.aggregate(distance, type='sum', decay=decay, name=name)
+                npt.assert_allclose(batched.values, expected.loc[origins].values)
+    assert cached.misses == 0
+
+    # unsupported aggregations fall back to pandana
+    cached.aggregate(2640, type='max', decay='flat', name='empedu_p')
+    assert cached.misses == 1
+    assert cached.batched == 14
+
+
+def test_origin_chunks(net_name, zone_name):
+
+    network = pdna.Network.from_hdf5(net_name)
+    zone_data_df = pd.read_csv(zone_name, index_col='zoneid')
+    node_ids = network.get_node_ids(zone_data_df['xcoord_p'], zone_data_df['ycoord_p'])
+    origins = network.node_ids[::50]
+
+    cached = buffer.CachedNetwork(network, origins=origins, chunk_size=7)
+    cached.set(node_ids, variable=zone_data_df['emptot_p'], name='emptot_p')
+    network.set(node_ids, variable=zone_data_df['emptot_p'], name='emptot_p')
+
+    for type in ['sum', 'count', 'mean']:
+        for decay in ['flat', 'exp']:
+            values = cached.aggregate(2640, type=type, decay=decay, name='emptot_p')
+            expected = network.aggregate(2640, type=type, decay=decay, name='emptot_p')
+            assert values.index.equals(origins)
+            npt.assert_allclose(values.values, expected.loc[origins].values, rtol=1e-6)
+    assert cached.batched == 6
+
+
+def test_precompute_ranges(net_name, zone_name):
+
+    network = pdna.Network.from_hdf5(net_name)
+    zone_data_df = pd.read_csv(zone_name, index_col='zoneid')
+    node_ids = network.get_node_ids(zone_data_df['xcoord_p'], zone_data_df['ycoord_p'])
+    origins = network.node_ids[::50]
+
+    expected = [np.concatenate(arrays) for arrays in
+                zip(*ranges.iter_range_pairs(network, 2000, origins, chunk_size=7))]
+    table = ranges.precompute_ranges(network, 2641)
+    saved = ranges.RangeTable(table.radius, table.offsets, table.dest_pos, table.dist)
+    ranges.precompute_ranges(network, 2641, table=saved)
+    ranges.defer_precompute(network, 2641)
+    pairs = [np.concatenate(arrays) for arrays in
+             zip(*ranges.iter_range_pairs(network, 2000, origins, chunk_size=7))]
+    for a, b in zip(expected, pairs):
+        npt.assert_array_equal(a, b)
+
+    # aggregations left to pandana run its precompute first
+    cached = buffer.CachedNetwork(network, origins=origins)
+    cached.set(node_ids, variable=zone_data_df['emptot_p'], name='emptot_p')
+    cached.aggregate(2640, type='max', name='emptot_p')
+    assert network not in ranges.deferred_precomputes
+
+
+def test_compile_buffer_spec():
+
+    spec = pd.DataFrame({
+        'description': '',
+        'target': ['_SCALE', '_unused', '_tmp', 'a', 'b', 'c'],
+        'variable': None,
+        'target_df': 'zones_df',
+        'expression': ['2',
+                       "zones_df['x'] + 1",
+                       "zones_df['x'] * _SCALE",
+                       "zones_df['_tmp'] + 1",
+                       "zones_df['_tmp'] + 1",
+                       'a + b'],
+    })
+
+    plan = buffer.compile_buffer_spec(spec)
+
+    assert [node.kind for node in plan.nodes] == ['local'] + ['assign'] * 5
+    assert plan.nodes[2].deps == {0}
+    assert plan.nodes[5].deps == {3, 4}
+    assert plan.nodes[4].duplicate_of == 3
+
+    order = [node.target for node in plan.schedule()]
+    assert '_unused' not in order
+    assert order.index('_tmp') < order.index('a') < order.index('c')
+
+    assert len(plan.schedule(keep_temps=True)) == len(spec)
+
+    zones = pd.DataFrame({'x': [1., 2., 3.]})
+    result, _, _ = buffer.buffer_variables(plan, 'zones_df', {'zones_df': zones, 'network': None})
+    npt.assert_array_equal(result.c.values, [6., 10., 14.])
+    assert list(result.columns) == ['a', 'b', 'c']
+
+    # targets are assigned to a copy of the caller's dataframe
+    assert list(zones.columns) == ['x']
+
+
+def test_assign_index():
+
+    def assign(expressions):
+        spec = pd.DataFrame({
+            'description': '',
+            'target': ['t%s' % i for i in range(len(expressions))],
+            'variable': None,
+            'target_df': 'zones_df',
+            'expression': expressions,
+        })
+        zones = pd.DataFrame({'x': [1., 2., 3.]}, index=[10, 20, 30])
+        result, _, _ = buffer.buffer_variables(spec, 'zones_df',
+                                               {'zones_df': zones, 'network': None})
+        return result
+
+    # series are aligned by label, other results by position
+    result = assign(["zones_df['x'].iloc[::-1]", "zones_df['x'].values[::-1]"])
+    npt.assert_array_equal(result.t0.values, [1., 2., 3.])
+    npt.assert_array_equal(result.t1.values, [3., 2., 1.])
+
+    with pytest.raises(RuntimeError):
+        assign(["zones_df['x'].reset_index(drop=True)"])
+    with pytest.raises(RuntimeError):
+        assign(["zones_df['x'].iloc[:2]"])
+
+
+def test_buffer_variables_parallel(spec_name, net_name, zone_name):
+
+    spec = buffer.read_buffer_spec(spec_name)
+
+    network = pdna.Network.from_hdf5(net_name)
+    zone_data_df = pd.read_csv(zone_name, index_col='zoneid')
+    zone_data_df['node_id'] = network.get_node_ids(zone_data_df['xcoord_p'],
+                                                   zone_data_df['ycoord_p'])
+
+    locals_d = {
+        'network': network,
+        'zones_df': zone_data_df,
+        'node_id': 'node_id'
+    }
+    trace_zone_rows = zone_data_df.index.isin([735313])
+
+    serial = buffer.buffer_variables(spec, 'zones_df', locals_d.copy(),
+                                     trace_rows=trace_zone_rows)
+    parallel = buffer.buffer_variables(spec, 'zones_df', locals_d.copy(),
+                                       trace_rows=trace_zone_rows, num_processes=2)
+
+    pdt.assert_frame_equal(serial[0], parallel[0])
+    pdt.assert_frame_equal(serial[1], parallel[1])
+
+
+def test_network_arrays(tmpdir, net_name, zone_name):
+
+    network = pdna.Network.from_hdf5(net_name)
+    zone_data_df = pd.read_csv(zone_name, index_col='zoneid')
+    node_ids = network.get_node_ids(zone_data_df['xcoord_p'], zone_data_df['ycoord_p'])
+
+    table = ranges.precompute_ranges(network, 2641)
+    arrays = []
+    for name in ['offsets', 'dest_pos', 'dist']:
+        path = os.path.join(str(tmpdir), name + '.npy')
+        np.save(path, getattr(table, name))
+        arrays.append(np.load(path, mmap_mode='r'))
+    ranges.precompute_ranges(network, 2641, table=ranges.RangeTable(2641, *arrays))
+    ranges.defer_precompute(network, 2641)
+
+    # workers are sent the file names of memory-mapped tables, not copies
+    rebuilt = pickle.loads(pickle.dumps(buffer.NetworkArrays(network))).build()
+    rebuilt_table = ranges.range_tables[rebuilt][0]
+    assert isinstance(rebuilt_table.dist, np.memmap)
+    npt.assert_array_equal(rebuilt_table.dist, table.dist)
+    assert ranges.deferred_precomputes[rebuilt] == 2641
+
+    rebuilt.set(node_ids, variable=zone_data_df['emptot_p'], name='emptot_p')
+    network.set(node_ids, variable=zone_data_df['emptot_p'], name='emptot_p')
+    pdt.assert_series_equal(rebuilt.aggregate(2640, name='emptot_p'),
+                            network.aggregate(2640, name='emptot_p'))
+
+    # compiled spec rows are sent as is
+    plan = buffer.compile_buffer_spec(pd.DataFrame({
+        'target': ['a'], 'variable': ['x'], 'target_df': ['zones_df'],
+        'expression': ["zones_df.x * 2"]}))
+    node = pickle.loads(pickle.dumps(plan)).nodes[0]
+    assert eval(node.code, {}, {'zones_df': pd.DataFrame({'x': [1]})}).tolist() == [2]
+
+
+def test_plan_compiled_once(monkeypatch, tmpdir, spec_name, net_name, zone_name):
+
+    plan = buffer.compile_buffer_spec(buffer.read_buffer_spec(spec_name))
+
+    network = pdna.Network.from_hdf5(net_name)
+    zone_data_df = pd.read_csv(zone_name, index_col='zoneid')
+    zone_data_df['node_id'] = network.get_node_ids(zone_data_df['xcoord_p'],
+                                                   zone_data_df['ycoord_p'])
+    locals_d = {
+        'network': network,
+        'zones_df': zone_data_df,
+        'node_id': 'node_id',
+        'max_dist': 2640,
+    }
+    expected, _, _ = buffer.buffer_variables(plan, 'zones_df', dict(locals_d))
+
+    # workers, the result cache and rebuffering run subsets of the plan
+    # without compiling spec rows again
+    def compile_row(*args):
+        raise AssertionError("spec row compiled again")
+
+    monkeypatch.setattr(buffer.SpecNode, '__init__', compile_row)
+
+    parallel, _, _ = buffer.buffer_variables(plan, 'zones_df', dict(locals_d), num_processes=2)
+    pdt.assert_frame_equal(parallel, expected)
+
+    cache = result_cache.ResultCache(str(tmpdir))
+    cached, _, _ = buffer.buffer_variables(plan, 'zones_df', dict(locals_d), result_cache=cache)
+    pdt.assert_frame_equal(cached, expected)
+
+    changed_df = zone_data_df.copy()
+    changed_df.iloc[::40, changed_df.columns.get_loc('emptot_p')] += 100
+    previous = pd.concat([zone_data_df, expected], axis=1)
+    rebuffered = buffer.rebuffer_variables(plan, 'zones_df', dict(locals_d, zones_df=changed_df),
+                                           previous)
+    assert list(rebuffered.columns) == list(expected.columns)
+
+    subset = plan.subset([0, 2])
+    assert [node.index for node in subset.nodes] == [0, 1]
+    assert subset.nodes[1].code is plan.nodes[2].code
+
+
+def test_set_pois(tmpdir, net_name, zone_name):
+
+    network = pdna.Network.from_hdf5(net_name)
+    network.precompute(2641)
+    zone_data_df = pd.read_csv(zone_name, index_col='zoneid')
+
+    network.set_pois(category='zones', maxdist=2640, maxitems=1,
+                     x_col=zone_data_df['xcoord_p'], y_col=zone_data_df['ycoord_p'])
+    expected = network.nearest_pois(2640, 'zones', num_pois=1, include_poi_ids=True)
+
+    poi_store = str(tmpdir.join('pois.h5'))
+    for run in range(2):
+        cached = buffer.CachedNetwork(network, poi_store=poi_store)
+        for i in range(2):
+            cached.set_pois(category='cached', maxdist=2640, maxitems=1,
+                            x_col=zone_data_df['xcoord_p'], y_col=zone_data_df['ycoord_p'])
+        pdt.assert_frame_equal(
+            cached.nearest_pois(2640, 'cached', num_pois=1, include_poi_ids=True), expected)
+        assert (cached.poi_sets, cached.poi_loads) == (2, 1)
+
+
+def test_snap_points(tmpdir, net_name, zone_name):
+
+    network = pdna.Network.from_hdf5(net_name)
+    zone_data_df = pd.read_csv(zone_name, index_col='zoneid')
+    x, y = zone_data_df['xcoord_p'], zone_data_df['ycoord_p']
+    expected = network.get_node_ids(x, y)
+
+    store = str(tmpdir.join('snapping.h5'))
+    for run in range(2):
+        snapped = buffer.snap_points(network, x, y, store=store, prefix='zones')
+        pdt.assert_series_equal(snapped['node_id'], expected)
+    with pd.HDFStore(store) as s:
+        assert len(s.keys()) == 1
+
+    # other points get their own entry
+    buffer.snap_points(network, x[:2], y[:2], store=store, prefix='zones')
+    with pd.HDFStore(store) as s:
+        assert len(s.keys()) == 2
+
+
+def test_nearest_pois(monkeypatch, net_name, zone_name):
+
+    network = pdna.Network.from_hdf5(net_name)
+    network.precompute(2641)
+    zone_data_df = pd.read_csv(zone_name, index_col='zoneid')
+    origins = network.node_ids[::10]
+
+    cached = buffer.CachedNetwork(network, origins=origins)
+    for i, category in enumerate(['first', 'last']):
+        pois = zone_data_df.iloc[[i - 1]]
+        network.set_pois(category=category, maxdist=2640, maxitems=1,
+                         x_col=pois['xcoord_p'], y_col=pois['ycoord_p'])
+        cached.set_pois(category=category, maxdist=2640, maxitems=1,
+                        x_col=pois['xcoord_p'], y_col=pois['ycoord_p'])
+
+    cached.prefetch_pois([dict(distance=distance, category=category, num_pois=1,
+                               max_distance=999, imp_name=None, include_poi_ids=False)
+                          for category in ['first', 'last'] for distance in [1000, 2640]])
+    assert cached.batched == 4
+
+    for category in ['first', 'last']:
+        for distance in [1000, 2640]:
+            nearest = cached.nearest_pois(distance, category, max_distance=999)
+            expected = network.nearest_pois(distance, category, max_distance=999)
+            npt.assert_array_equal(nearest[1].values, expected.loc[origins, 1].values)
+    assert (cached.misses, cached.poi_loads) == (0, 0)
+
+    # the nearest_pois rows of a spec are found in one pass
+    zone_data_df['node_id'] = network.get_node_ids(zone_data_df['xcoord_p'],
+                                                   zone_data_df['ycoord_p'])
+    poi_df = zone_data_df.assign(first=[1, 0, 0], last=[0, 0, 1])
+    spec = pd.DataFrame({
+        'description': '',
+        'target': ['dist_first', 'dist_last'],
+        'variable': ['first', 'last'],
+        'target_df': 'poi_df',
+        'expression': ["network.nearest_pois(2640, '%s', num_pois=1, max_distance=999)" % c
+                       for c in ['first', 'last']],
+    })
+    locals_d = {
+        'network': network,
+        'zones_df': zone_data_df,
+        'poi_df': poi_df,
+        'node_id': 'node_id',
+        'poi_x': 'xcoord_p',
+        'poi_y': 'ycoord_p',
+        'max_dist': 2640,
+        'max_pois': 1,
+    }
+
+    sweeps = []
+    nearest_distances = ranges.nearest_distances
+
+    def counted_nearest_distances(*args, **kwargs):
+        sweeps.append(args)
+        return nearest_distances(*args, **kwargs)
+
+    monkeypatch.setattr(ranges, 'nearest_distances', counted_nearest_distances)
+    distances, _, _ = buffer.buffer_variables(spec, 'zones_df', locals_d)
+    assert len(sweeps) == 1
+    for category in ['first', 'last']:
+        expected = network.nearest_pois(2640, category, max_distance=999)
+        npt.assert_array_equal(distances['dist_' + category].values,
+                               expected.loc[zone_data_df.node_id, 1].values)
+
+
+def test_zone_pairs(net_name, zone_name):
+
+    network = pdna.Network.from_hdf5(net_name)
+    network.precompute(2641)
+    zone_data_df = pd.read_csv(zone_name, index_col='zoneid')
+    zone_nodes = network.get_node_ids(zone_data_df['xcoord_p'], zone_data_df['ycoord_p'])
+
+    a_node_idx, b_zone_id, dist = [np.concatenate(arrays) for arrays in zip(
+        *ranges.iter_zone_pairs(network, zone_nodes, 2640, chunk_size=1))]
+    a_node_id = network.node_ids.values[a_node_idx]
+    assert (np.diff(a_node_id) >= 0).all()
+
+    network.set_pois(category='zones', maxdist=2640, maxitems=3,
+                     x_col=zone_data_df['xcoord_p'], y_col=zone_data_df['ycoord_p'])
+    nearest = network.nearest_pois(2640, 'zones', num_pois=3, include_poi_ids=True)
+    for node, zone, d in zip(a_node_id, b_zone_id, dist):
+        assert zone in nearest.loc[node, 'poi1':'poi3'].values
+        npt.assert_allclose(d, nearest.loc[node, 1:3].values[
+            list(nearest.loc[node, 'poi1':'poi3'].values).index(zone)])
+    expected = (nearest.loc[zone_nodes.unique(), 1:3] < 2640).values.sum()
+    assert len(a_node_id) == expected > 0
+
+
+def test_node_idx(net_name):
+
+    # a batched sum, indexed by the zone nodes, and a max left to pandana,
+    # indexed by every network node and looked up by node_idx
+    spec = pd.DataFrame({
+        'description': ['', ''],
+        'target': ['emp_sum', 'emp_max'],
+        'variable': ['emptot_p', 'emptot_p'],
+        'target_df': ['zones_df'] * 2,
+        'expression': [
+            "network.aggregate(distance=1000, type='sum', decay='flat', name='emptot_p')",
+            "network.aggregate(distance=1000, type='max', decay='flat', name='emptot_p')",
+        ],
+    })
+
+    network = pdna.Network.from_hdf5(net_name)
+    node_ids = network.node_ids.values[::5]
+    zone_data_df = pd.DataFrame({'node_id': node_ids,
+                                 'emptot_p': np.arange(len(node_ids)) % 17 * 10})
+    zone_data_df['node_idx'] = ranges.node_positions(network, zone_data_df['node_id'])
+    assert zone_data_df['node_idx'].dtype == np.int32
+    assert (network.node_ids[zone_data_df['node_idx']] == zone_data_df['node_id']).all()
+
+    locals_d = {
+        'network': network,
+        'zones_df': zone_data_df,
+        'node_id': 'node_id'
+    }
+
+    by_id, _, _ = buffer.buffer_variables(spec, 'zones_df', locals_d.copy())
+    by_idx, _, _ = buffer.buffer_variables(spec, 'zones_df',
+                                           dict(locals_d, node_idx='node_idx'))
+
+    pdt.assert_frame_equal(by_id, by_idx)
+
+    # pandana results are read at the node_idx positions, not the node ids
+    wrong = zone_data_df.assign(node_idx=np.roll(zone_data_df['node_idx'].values, 1))
+    by_wrong_idx, _, _ = buffer.buffer_variables(spec, 'zones_df',
+                                                 dict(locals_d, zones_df=wrong,
+                                                      node_idx='node_idx'))
+    pdt.assert_series_equal(by_wrong_idx['emp_sum'], by_id['emp_sum'])
+    npt.assert_array_equal(by_wrong_idx['emp_max'].values, np.roll(by_id['emp_max'].values, 1))
+
+
+def test_rebuffer_variables(spec_name, net_name, zone_name):
+
+    spec = buffer.read_buffer_spec(spec_name)
+
+    network = pdna.Network.from_hdf5(net_name)
+    zone_data_df = pd.read_csv(zone_name, index_col='zoneid')
+    zone_data_df['node_id'] = network.get_node_ids(zone_data_df['xcoord_p'],
+                                                   zone_data_df['ycoord_p'])
+    locals_d = {
+        'network': network,
+        'zones_df': zone_data_df,
+        'node_id': 'node_id',
+        'max_dist': 2640,
+    }
+
+    results, _, _ = buffer.buffer_variables(spec, 'zones_df', dict(locals_d))
+    previous = pd.concat([zone_data_df, results], axis=1)
+
+    changed_df = zone_data_df.copy()
+    changed_df.iloc[::40, changed_df.columns.get_loc('emptot_p')] += 100
+    changed_locals = dict(locals_d, zones_df=changed_df)
+
+    expected, _, _ = buffer.buffer_variables(spec, 'zones_df', dict(changed_locals))
+    rebuffered = buffer.rebuffer_variables(spec, 'zones_df', dict(changed_locals), previous)
+    pdt.assert_frame_equal(rebuffered, expected[rebuffered.columns], check_dtype=False)
+
+    # nothing the spec reads changed
+    changed_df = zone_data_df.copy()
+    changed_df['hh_p'] += 1
+    unchanged = buffer.rebuffer_variables(spec, 'zones_df', dict(locals_d, zones_df=changed_df),
+                                          previous)
+    pdt.assert_frame_equal(unchanged, results[unchanged.columns], check_dtype=False)
+
+
+def test_rebuffer_chained_queries(net_name):
+
+    # a2 aggregates the results of a1, which it reads at zones up to 1000
+    # feet beyond the zones its results change at
+    spec = pd.DataFrame({
+        'description': ['', '', ''],
+        'target': ['a1', 'a2', 'a3'],
+        'variable': ['emptot_p', 'a1', 'None'],
+        'target_df': ['zones_df'] * 3,
+        'expression': [
+            "network.aggregate(distance=1000, type='sum', decay='flat', name='emptot_p')",
+            "network.aggregate(distance=1000, type='sum', decay='flat', name='a1')",
+            "zones_df['a1'] + zones_df['a2']",
+        ],
+    })
+
+    # a zone at every fifth network node
+    network = pdna.Network.from_hdf5(net_name)
+    node_ids = network.node_ids.values[::5]
+    zone_data_df = pd.DataFrame({'node_id': node_ids,
+                                 'emptot_p': np.arange(len(node_ids)) % 17 * 10},
+                                index=pd.Index(np.arange(len(node_ids)) + 1, name='zoneid'))
+    locals_d = {
+        'network': network,
+        'zones_df': zone_data_df,
+        'node_id': 'node_id',
+        'max_dist': 1000,
+    }
+
+    results, _, _ = buffer.buffer_variables(spec, 'zones_df', dict(locals_d))
+    previous = pd.concat([zone_data_df, results], axis=1)
+
+    changed_df = zone_data_df.copy()
+    changed_df.iloc[::97, changed_df.columns.get_loc('emptot_p')] += 1000
+    changed_locals = dict(locals_d, zones_df=changed_df)
+
+    expected, _, _ = buffer.buffer_variables(spec, 'zones_df', dict(changed_locals))
+    rebuffered = buffer.rebuffer_variables(spec, 'zones_df', dict(changed_locals), previous)
+    assert (expected['a2'] != results['a2']).sum() > (expected['a1'] != results['a1']).sum()
+    pdt.assert_frame_equal(rebuffered, expected[rebuffered.columns], check_dtype=False)
+
+
+def test_rebuffer_without_nodes(monkeypatch, net_name):
+
+    spec = pd.DataFrame({
+        'description': ['', ''],
+        'target': ['a1', 'b1'],
+        'variable': ['emptot_p', 'hh_p'],
+        'target_df': ['zones_df'] * 2,
+        'expression': [
+            "network.aggregate(distance=1000, type='sum', decay='flat', name='emptot_p')",
+            "network.aggregate(distance=1000, type='sum', decay='flat', name='hh_p')",
+        ],
+    })
+
+    network = pdna.Network.from_hdf5(net_name)
+    node_ids = network.node_ids.values[::5]
+    zone_data_df = pd.DataFrame({'node_id': node_ids,
+                                 'emptot_p': np.arange(len(node_ids)) % 17 * 10,
+                                 'hh_p': np.arange(len(node_ids)) % 7},
+                                index=pd.Index(np.arange(len(node_ids)) + 1, name='zoneid'))
+    locals_d = {
+        'network': network,
+        'zones_df': zone_data_df,
+        'node_id': 'node_id',
+        'max_dist': 1000,
+    }
+
+    # buffered outputs, like the daysim one, don't keep the zone nodes
+    results, _, _ = buffer.buffer_variables(spec, 'zones_df', dict(locals_d))
+    previous = pd.concat([zone_data_df.drop(columns='node_id'), results], axis=1)
+
+    changed_df = zone_data_df.copy()
+    changed_df.iloc[0, changed_df.columns.get_loc('emptot_p')] += 1000
+    changed_locals = dict(locals_d, zones_df=changed_df)
+    expected, _, _ = buffer.buffer_variables(spec, 'zones_df', dict(changed_locals))
+
+    calls = []
+    buffer_variables = buffer.buffer_variables
+
+    def recording_buffer_variables(plan, *args, **kwargs):
+        calls.append(([node.target for node in plan.nodes], kwargs['zone_rows']))
+        return buffer_variables(plan, *args, **kwargs)
+
+    monkeypatch.setattr(buffer, 'buffer_variables', recording_buffer_variables)
+    rebuffered = buffer.rebuffer_variables(spec, 'zones_df', dict(changed_locals), previous)
+    pdt.assert_frame_equal(rebuffered, expected[rebuffered.columns], check_dtype=False)
+
+    [(targets, zone_rows)] = calls
+    assert targets == ['a1']
+    assert 1 < zone_rows.sum() < len(zone_rows) / 2
+
+
+def test_result_cache(tmpdir, spec_name, net_name, zone_name):
+
+    spec = buffer.read_buffer_spec(spec_name)
+
+    network = pdna.Network.from_hdf5(net_name)
+    zone_data_df = pd.read_csv(zone_name, index_col='zoneid')
+    zone_data_df['node_id'] = network.get_node_ids(zone_data_df['xcoord_p'],
+                                                   zone_data_df['ycoord_p'])
+    locals_d = {
+        'network': network,
+        'zones_df': zone_data_df,
+        'node_id': 'node_id',
+    }
+
+    cache = result_cache.ResultCache(str(tmpdir))
+    expected, _, _ = buffer.buffer_variables(spec, 'zones_df', dict(locals_d))
+    first, _, _ = buffer.buffer_variables(spec, 'zones_df', dict(locals_d), result_cache=cache)
+    second, _, _ = buffer.buffer_variables(spec, 'zones_df', dict(locals_d), result_cache=cache)
+    pdt.assert_frame_equal(first, expected)
+    pdt.assert_frame_equal(second, expected)
+    assert (cache.hits, cache.misses) == (3, 3)
+
+    # only target1 and target3 read emptot_p
+    changed_df = zone_data_df.copy()
+    changed_df['emptot_p'] += 1
+    changed_df['hh_p'] += 1
+    changed_locals = dict(locals_d, zones_df=changed_df)
+    expected, _, _ = buffer.buffer_variables(spec, 'zones_df', dict(changed_locals))
+    changed, _, _ = buffer.buffer_variables(spec, 'zones_df', dict(changed_locals),
+                                            result_cache=cache)
+    pdt.assert_frame_equal(changed, expected)
+    assert (cache.hits, cache.misses) == (4, 5)
+
+    fingerprints = buffer.result_fingerprints(buffer.compile_buffer_spec(spec),
+                                              dict(locals_d, network=network), 'zones_df')
+    assert len(set(fingerprints.values())) == len(spec)
@@ -0,0 +1,257 @@
+import os.path
+
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pandana as pdna
+import pytest
+
+from .. import ranges
+
+try:
+    from .. import network
+except ImportError as err:
+    # network.py needs activitysim's config, and with it a full activitysim install
+    pytest.skip('netbuffer.core.network unavailable: %s' % err, allow_module_level=True)
+
+
+@pytest.fixture(scope='module')
+def net_name():
+    return os.path.join(os.path.dirname(__file__), 'data', 'test_net.h5')
+
+
+NODES_CSV = """id,x,y,name
+1,0.0,0.0,a
+2,1.0,0.0,b
+3,2.0,0.0,c
+4,3.0,0.0,d
+2,1.0,0.0,b
+5,9.0,9.0,unlinked
+"""
+
+LINKS_CSV = """a,b,cost,name
+1,2,5.0,x
+2,1,3.0,x
+1,2,4.0,y
+2,2,1.0,loop
+2,3,0.0,zero
+3,4,2.0,z
+4,6,1.0,missing
+"""
+
+
+def test_read_csv_columns(tmpdir):
+
+    path = str(tmpdir.join('links.csv'))
+    with open(path, 'w') as f:
+        f.write(LINKS_CSV)
+
+    columns = {'a': np.int64, 'b': np.int64, 'cost': np.float32}
+    whole = network.read_csv_columns(path, columns)
+    assert list(whole.columns) == ['a', 'b', 'cost']
+    assert whole.dtypes['cost'] == np.float32 and len(whole) == 7
+
+    # filtered a chunk at a time, the same rows as filtering the whole file
+    def drop_loops(df):
+        return df[df.a != df.b]
+
+    chunked = network.read_csv_columns(path, columns, chunksize=2, chunk_filter=drop_loops)
+    pd.testing.assert_frame_equal(chunked, drop_loops(whole).reset_index(drop=True))
+
+
+def test_clean_network(tmpdir):
+
+    nodes_path, links_path = str(tmpdir.join('nodes.csv')), str(tmpdir.join('links.csv'))
+    with open(nodes_path, 'w') as f:
+        f.write(NODES_CSV)
+    with open(links_path, 'w') as f:
+        f.write(LINKS_CSV)
+
+    nodes = network.read_csv_columns(nodes_path, {'id': np.int64, 'x': np.float64,
+                                                  'y': np.float64})
+    links = network.read_csv_columns(links_path, {'a': np.int64, 'b': np.int64,
+                                                  'cost': np.float32})
+
+    # two way: 2-1 is the cheapest of the 1-2 links, the self-loop and the
+    # link to a missing node are dropped, the zero impedance link is kept
+    clean_nodes, clean_links = network.clean_network(nodes, links, 'id', 'a', 'b', 'cost', True)
+    assert list(zip(clean_links.a, clean_links.b, clean_links.cost)) == \
+        [(2, 1, 3.0), (2, 3, 0.0), (3, 4, 2.0)]
+    # the duplicate node 2 and unlinked node 5 are dropped
+    assert list(clean_nodes.id) == [1, 2, 3, 4]
+
+    # one way: 1-2 and 2-1 are different links
+    _, clean_links = network.clean_network(nodes, links, 'id', 'a', 'b', 'cost', False)
+    assert list(zip(clean_links.a, clean_links.b, clean_links.cost)) == \
+        [(2, 1, 3.0), (1, 2, 4.0), (2, 3, 0.0), (3, 4, 2.0)]
+
+
+class ZoneData(object):
+    """
+    Stands in for the zone_data table, which prune_network reads with
+    to_frame.
+    """
+
+    def __init__(self, df):
+        self.df = df
+
+    def to_frame(self):
+        return self.df
+
+
+def prune_settings(max_dist, **options):
+    return {'prune_network': options, 'zones_lon': 'x', 'zones_lat': 'y', 'max_dist': max_dist}
+
+
+def test_contract_chains(net_name):
+
+    net = pdna.Network.from_hdf5(net_name)
+    a = ranges.node_positions(net, net.edges_df['from'].values)
+    b = ranges.node_positions(net, net.edges_df['to'].values)
+    weights = net.edges_df[net.impedance_names].values.astype(np.float64)
+    protected = np.zeros(len(net.node_ids), dtype=bool)
+    protected[::7] = True
+
+    ca, cb, cweights, contracted = network.contract_chains(a, b, weights, protected)
+    assert contracted.sum() > 0 and not (contracted & protected).any()
+    assert len(ca) == len(a) - contracted.sum()
+
+    node_ids = net.node_ids.values
+    kept = ~contracted
+    contracted_net = pdna.Network(net.nodes_df.x[kept], net.nodes_df.y[kept],
+                                  pd.Series(node_ids[ca]), pd.Series(node_ids[cb]),
+                                  pd.DataFrame(cweights, columns=net.impedance_names))
+
+    # distances between the remaining nodes are exactly the same
+    rng = np.random.RandomState(0)
+    origins = rng.choice(node_ids[protected], 200)
+    destinations = rng.choice(node_ids[kept], 200)
+    npt.assert_array_equal(contracted_net.shortest_path_lengths(origins, destinations),
+                           net.shortest_path_lengths(origins, destinations))
+
+
+def test_prune_components(net_name):
+
+    net = pdna.Network.from_hdf5(net_name)
+    nodes, edges = net.nodes_df, net.edges_df
+
+    # a far away component of three nodes, with a zone on it
+    island = pd.DataFrame({'x': [0., 10., 20.], 'y': [0., 0., 0.]}, index=[1, 2, 3])
+    island_net = pdna.Network(pd.concat([nodes.x, island.x]), pd.concat([nodes.y, island.y]),
+                              pd.concat([edges['from'], pd.Series([1, 2])], ignore_index=True),
+                              pd.concat([edges['to'], pd.Series([2, 3])], ignore_index=True),
+                              pd.concat([edges[['distance']],
+                                         pd.DataFrame({'distance': [10., 10.]})],
+                                        ignore_index=True))
+
+    zones = pd.concat([nodes.iloc[[0]], island.iloc[[0]]])
+    pruned = network.prune_network(island_net, ZoneData(zones),
+                                   prune_settings(1e9, min_component_size=4))
+
+    # the island is dropped, and its zone snaps to the rest of the network
+    assert not pruned.node_ids.isin([1, 2, 3]).any()
+    expected = network.prune_network(net, ZoneData(zones.iloc[[0]]),
+                                     prune_settings(1e9, min_component_size=4))
+    assert pruned.node_ids.equals(expected.node_ids)
+    assert len(pruned.edges_df) == len(expected.edges_df)
+
+
+def test_prune_chain_pois(net_name):
+
+    net = pdna.Network.from_hdf5(net_name)
+    nodes, edges = net.nodes_df, net.edges_df
+    zones = nodes.iloc[::50]
+
+    # POIs on chain nodes near the zones
+    degree = pd.concat([edges['from'], edges['to']]).value_counts()
+    chain_nodes = degree.index[degree == 2]
+    lengths = np.array(net.shortest_path_lengths([zones.index[0]] * len(chain_nodes),
+                                                 chain_nodes))
+    pois = nodes.loc[chain_nodes[lengths < 1000]]
+    assert len(pois) > 1
+    points = [(pois.x.values, pois.y.values)]
+
+    def results(pruned):
+        pruned.precompute(2000)
+        poi_nodes = pruned.get_node_ids(pois.x, pois.y)
+        pruned.set(poi_nodes, variable=pd.Series(1., index=pois.index), name='pois')
+        pruned.set_pois('pois', 2000, 3, pois.x, pois.y)
+        return (poi_nodes.values,
+                pruned.aggregate(2000, type='sum', name='pois').loc[zones.index],
+                pruned.nearest_pois(2000, 'pois', num_pois=3).loc[zones.index])
+
+    settings = prune_settings(2000, contract_chains=True)
+    contracted = network.prune_network(net, ZoneData(zones), settings)
+    assert not contracted.node_ids.isin(pois.index).any()
+
+    expected = results(network.prune_network(net, ZoneData(zones), prune_settings(2000)))
+    actual = results(network.prune_network(net, ZoneData(zones), settings, points=points))
+    npt.assert_array_equal(actual[0], expected[0])
+    pd.testing.assert_series_equal(actual[1], expected[1])
+    pd.testing.assert_frame_equal(actual[2], expected[2])
+
+
+def test_prune_far_edges(net_name):
+
+    net = pdna.Network.from_hdf5(net_name)
+    nodes, edges = net.nodes_df, net.edges_df
+
+    zone_node = nodes.index[0]
+    pruned = network.prune_network(net, ZoneData(nodes.loc[[zone_node]]), prune_settings(2000))
+
+    # edges of nodes further than max_dist + 1 from the zone are dropped,
+    # but the nodes are kept
+    lengths = np.array(net.shortest_path_lengths([zone_node] * len(nodes), nodes.index))
+    near = nodes.index[lengths <= 2001]
+    assert 1 < len(near) < len(nodes)
+    expected = edges['from'].isin(near) | edges['to'].isin(near)
+    assert len(pruned.edges_df) == expected.sum()
+    assert (pruned.edges_df['from'].isin(near) | pruned.edges_df['to'].isin(near)).all()
+    assert len(pruned.node_ids) == len(nodes)
+
+
+def test_network_arrays(tmpdir, net_name):
+
+    net = pdna.Network.from_hdf5(net_name)
+    path = str(tmpdir.join('pandana_network'))
+    network.save_network_arrays(net, path)
+    read = network.read_network_arrays(path)
+
+    pd.testing.assert_frame_equal(read.nodes_df, net.nodes_df)
+    pd.testing.assert_frame_equal(read.edges_df, net.edges_df)
+    assert read.impedance_names == net.impedance_names
+    assert read._twoway == net._twoway
+
+    # the same shortest paths
+    origins, destinations = net.node_ids.values[:50], net.node_ids.values[-50:]
+    npt.assert_array_equal(read.shortest_path_lengths(origins, destinations),
+                           net.shortest_path_lengths(origins, destinations))
+
+
+def test_read_network_file_npy(tmpdir, monkeypatch, net_name):
+
+    data_dir, output_dir = tmpdir.mkdir('data'), tmpdir.mkdir('output')
+    data_dir.join('net.h5').write_binary(open(net_name, 'rb').read())
+    monkeypatch.setattr(network.config, 'data_file_path',
+                        lambda fname, mandatory=True: str(data_dir.join(fname)))
+    monkeypatch.setattr(network.config, 'output_file_path',
+                        lambda fname: str(output_dir.join(fname)))
+    settings = {'network': 'read', 'saved_network': 'net.h5', 'network_format': 'npy'}
+
+    # the arrays are written to the output folder, never next to the input
+    converted = network.read_network_file(settings)
+    assert data_dir.listdir() == [data_dir.join('net.h5')]
+    assert output_dir.join('net').isdir()
+
+    read = network.read_network_file(settings)
+    pd.testing.assert_frame_equal(read.edges_df, converted.edges_df)
+
+
+def test_snapping_store_path(monkeypatch):
+    monkeypatch.setattr(network, 'network_file_path', lambda settings: 'output/net.h5')
+
+    assert network.snapping_store_path({}) is None
+    assert network.snapping_store_path({}, cache_pois=True) == 'output/net_snapping.h5'
+    assert network.snapping_store_path({'cache_snapping': True}) == 'output/net_snapping.h5'
+    assert network.snapping_store_path({'cache_snapping': True}, cache_pois=True) == \
+        'output/net_snapping.h5'
@@ -0,0 +1,75 @@
+import numpy.testing as npt
+
+from .. import osm_extract
+
+
+OSM_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="1" lat="47.600" lon="-122.330"/>
+  <node id="2" lat="47.601" lon="-122.330"/>
+  <node id="3" lat="47.602" lon="-122.330">
+    <tag k="highway" v="crossing"/>
+  </node>
+  <node id="4" lat="47.601" lon="-122.331"/>
+  <node id="5" lat="47.601" lon="-122.329"/>
+  <node id="6" lat="47.700" lon="-122.329"/>
+  <node id="7" lat="47.603" lon="-122.330"/>
+  <way id="10">
+    <nd ref="1"/><nd ref="2"/><nd ref="3"/><nd ref="7"/>
+    <tag k="highway" v="footway"/>
+  </way>
+  <way id="11">
+    <nd ref="4"/><nd ref="2"/><nd ref="5"/>
+    <tag k="highway" v="residential"/>
+  </way>
+  <way id="12">
+    <nd ref="3"/><nd ref="5"/>
+    <tag k="highway" v="motorway"/>
+  </way>
+  <way id="13">
+    <nd ref="1"/><nd ref="5"/>
+    <tag k="highway" v="residential"/>
+    <tag k="foot" v="no"/>
+  </way>
+  <way id="14">
+    <nd ref="3"/><nd ref="6"/><nd ref="5"/>
+    <tag k="highway" v="path"/>
+  </way>
+  <way id="15">
+    <nd ref="1"/><nd ref="4"/>
+    <tag k="building" v="yes"/>
+  </way>
+  <relation id="20">
+    <member type="way" ref="10" role=""/>
+    <tag k="type" v="route"/>
+  </relation>
+</osm>
+"""
+
+
+def test_read_osm_extract(tmpdir):
+
+    path = str(tmpdir.join('extract.osm'))
+    with open(path, 'w') as f:
+        f.write(OSM_XML)
+
+    nodes, edges = osm_extract.read_osm_extract(path, 47.59, -122.34, 47.61, -122.32)
+
+    # motorway, foot=no and non-highway ways are left out, node 6 is outside
+    # the box so way 14 is cut there, and only nodes shared by ways remain
+    assert list(nodes.index) == [2, 3, 5]
+    assert list(zip(edges['from'], edges['to'])) == [(2, 3), (2, 5)]
+    npt.assert_allclose(nodes.loc[[2, 3, 5], 'y'].values, [47.601, 47.602, 47.601])
+
+    # 0.001 degrees of latitude
+    npt.assert_allclose(edges['distance'].iloc[0], 111.2, atol=0.1)
+    assert edges['distance'].iloc[1] < edges['distance'].iloc[0]
+
+
+def test_keep_way():
+
+    assert osm_extract.keep_way({'highway': 'footway'})
+    assert osm_extract.keep_way({'highway': 'residential', 'foot': 'yes'})
+    assert not osm_extract.keep_way({'highway': 'motorway_link'})
+    assert not osm_extract.keep_way({'highway': 'footway', 'area': 'yes'})
+    assert not osm_extract.keep_way({'building': 'yes'})
@@ -0,0 +1,48 @@
+import os
+
+import numpy as np
+import numpy.testing as npt
+
+from .. import result_cache
+
+
+def test_result_cache(tmpdir):
+
+    cache = result_cache.ResultCache(str(tmpdir.join('results')), max_size=3000)
+    assert cache.get('a') is None
+
+    values = np.arange(200, dtype=np.float64)
+    assert cache.put('a', values)
+    npt.assert_array_equal(cache.get('a'), values)
+    assert cache.get('a').dtype == np.float64
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    # object arrays are not stored
+    assert not cache.put('b', np.array(['x', None], dtype=object))
+    assert cache.get('b') is None
+
+
+def test_result_cache_eviction(tmpdir):
+
+    # each entry is a little over 1600 bytes, two fit
+    cache = result_cache.ResultCache(str(tmpdir), max_size=3500)
+    for i, key in enumerate(['a', 'b']):
+        cache.put(key, np.arange(200))
+        os.utime(cache.file_path(key), ns=(i, i))
+
+    # reading a marks it as used, so b is the least recently used
+    assert cache.get('a') is not None
+    cache.put('c', np.arange(200))
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    assert cache.size() <= 3500
+
+
+def test_result_cache_unreadable(tmpdir):
+
+    cache = result_cache.ResultCache(str(tmpdir))
+    with open(cache.file_path('a'), 'wb') as f:
+        f.write(b'not an array')
+
+    assert cache.get('a') is None
+    assert not os.path.exists(cache.file_path('a'))
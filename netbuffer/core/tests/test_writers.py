@@ -0,0 +1,95 @@
+import gzip
+
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+
+from .. import writers
+
+
+@pytest.fixture
+def table():
+    rng = np.random.default_rng(0)
+    n = 1000
+    df = pd.DataFrame({
+        'onode': rng.integers(-50, 400000, n),
+        'dnode': rng.integers(0, 10, n).astype(np.int32),
+        'feet': rng.normal(size=n) * 1000,
+        'share': rng.random(n).astype(np.float32),
+    })
+    df.loc[0, 'onode'] = 0
+    df.loc[1, 'feet'] = np.nan
+    return df
+
+
+@pytest.mark.parametrize('delimiter', [' ', ',', '\t'])
+def test_text_writer(tmpdir, table, delimiter):
+
+    text_path, csv_path = str(tmpdir.join('text.dat')), str(tmpdir.join('csv.dat'))
+
+    # written in blocks, each formatted in chunks
+    with writers.open_writer(text_path, 'text', delimiter=delimiter, chunk_size=300) as writer:
+        writer.write(table.iloc[:600])
+        writer.write(table.iloc[600:])
+    table.to_csv(csv_path, sep=delimiter, index=False)
+
+    with open(text_path, 'rb') as text, open(csv_path, 'rb') as csv:
+        assert text.read() == csv.read()
+
+
+@pytest.mark.parametrize('format', ['csv', 'text'])
+def test_threaded_compressed_writer(tmpdir, table, format):
+
+    path, csv_path = str(tmpdir.join('text.dat.gz')), str(tmpdir.join('csv.dat'))
+
+    # chunks compressed on their own, as gzip members, by three threads
+    with writers.open_writer(path, format, chunk_size=70, threads=3, compression='gzip') as writer:
+        writer.write(table.iloc[:600])
+        writer.write(table.iloc[600:])
+    table.to_csv(csv_path, sep=' ', index=False)
+
+    with gzip.open(path, 'rb') as text, open(csv_path, 'rb') as csv:
+        assert text.read() == csv.read()
+
+
+def test_format_text():
+
+    df = pd.DataFrame({'a': [-12, 0, 345], 'b': ['x', None, 'é']})
+    assert writers.format_text(df, ',') == '-12,x\n0,\n345,é\n'.encode('utf-8')
+
+
+def test_binary_writer(tmpdir, table):
+
+    path = str(tmpdir.join('table.bin'))
+    with writers.open_writer(path, 'binary') as writer:
+        writer.write(table.iloc[:600])
+        writer.write(table.iloc[600:])
+
+    pdt.assert_frame_equal(writers.read_binary_table(path), table)
+
+    # plain little-endian records
+    records = np.fromfile(path, dtype='<i8,<i4,<f8,<f4')
+    assert records[0][0] == 0 and len(records) == len(table)
+
+    with writers.open_writer(path, 'binary', compression='gzip') as writer:
+        writer.write(table)
+    pdt.assert_frame_equal(writers.read_binary_table(path), table)
+
+
+def test_open_writer_format(tmpdir):
+
+    with pytest.raises(RuntimeError):
+        writers.open_writer(str(tmpdir.join('table.xyz')), 'xyz')
+
+
+def test_threaded_writer_error(tmpdir, table):
+
+    path = str(tmpdir.join('text.dat'))
+    writer = writers.open_writer(path, 'text', chunk_size=10, threads=2)
+    writer.write(table.iloc[:100])
+    # a chunk that fails to format is raised on close, which still closes the file
+    writer.pending.append(writer.pool.submit(writers.format_text, table, 'too long'))
+    with pytest.raises(TypeError):
+        writer.close()
+    assert writer.file.closed and not writer.pending
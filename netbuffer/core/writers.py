@@ -0,0 +1,436 @@
+import collections
+import functools
+import gzip
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+# number of rows the text writer formats at once
+DEFAULT_CHUNK_SIZE = 1000000
+
+NEWLINE = ord('\n')
+
+# default compression levels, favouring speed
+GZIP_LEVEL = 3
+ZSTD_LEVEL = 3
+
+
+def int_column_bytes(values):
+    """
+    Format an integer column as decimal digits with numpy arithmetic.
+
+    Returns
+    -------
+    chars : numpy.ndarray of uint8, rows by width
+        each value right aligned in a fixed width field
+    mask : numpy.ndarray of bool, same shape
+        which of chars belong to the value, the leading padding is masked
+    """
+
+    values = np.asarray(values, dtype=np.int64)
+    n = len(values)
+    negative = values < 0
+    magnitude = np.abs(values)
+
+    width = len(str(magnitude.max())) if n else 1
+    digits = np.ones(n, dtype=np.int8)
+    power = 10
+    for _ in range(1, width):
+        digits += magnitude >= power
+        power *= 10
+
+    sign = int(negative.any())
+    chars = np.empty((n, width + sign), dtype=np.uint8)
+    for k in range(width + sign - 1, sign - 1, -1):
+        chars[:, k] = magnitude % 10 + ord('0')
+        magnitude //= 10
+
+    start = (width + sign - digits)[:, None]
+    mask = np.arange(width + sign)[None, :] >= start
+    if sign:
+        # the minus sign goes just before the first digit
+        chars[np.nonzero(negative)[0], start[negative, 0] - 1] = ord('-')
+        mask[np.nonzero(negative)[0], start[negative, 0] - 1] = True
+
+    return chars, mask
+
+
+def str_column_bytes(values):
+    """
+    Format a column as the utf-8 bytes of its strings, NaN as empty fields.
+
+    Floats keep numpy's shortest round trip repr, as pandas writes them.
+
+    Returns
+    -------
+    chars, mask : see int_column_bytes
+    """
+
+    values = pd.Series(values)
+    if values.dtype.kind == 'f':
+        missing = values.isna().values
+        chars = values.values.astype('S')
+        chars[missing] = b''
+    else:
+        chars = np.char.encode(values.fillna('').astype(str).values.astype('U'), 'utf-8')
+
+    chars = chars.view(np.uint8).reshape(len(values), -1)
+    return chars, chars != 0
+
+
+def format_text(df, delimiter=' '):
+    """
+    Format a table as delimited text with numpy, instead of pandas.to_csv.
+
+    Every column is turned into a matrix of characters and a mask of the
+    characters used, integer columns with vectorized digit arithmetic and
+    other columns from their fixed width byte strings. Joined with the
+    delimiter and newline columns, the masked characters are the text of
+    the table in row order.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+    delimiter : str
+        single character field separator
+
+    Returns
+    -------
+    bytes
+    """
+
+    n = len(df)
+    if n == 0 or len(df.columns) == 0:
+        return b''
+
+    separator = np.full((n, 1), ord(delimiter), dtype=np.uint8)
+    newline = np.full((n, 1), NEWLINE, dtype=np.uint8)
+    always = np.ones((n, 1), dtype=bool)
+
+    chars, masks = [], []
+    for i, col in enumerate(df.columns):
+        values = df[col]
+        if values.dtype.kind in 'iu':
+            c, m = int_column_bytes(values.values)
+        else:
+            c, m = str_column_bytes(values)
+        chars += [c, separator if i < len(df.columns) - 1 else newline]
+        masks += [m, always]
+
+    return np.hstack(chars)[np.hstack(masks)].tobytes()
+
+
+def chunk_compressor(compression=None, level=None):
+    """
+    A function compressing a chunk of output on its own, as a gzip member
+    or zstd frame (which requires the zstandard package). Files of such
+    chunks one after another are valid gzip or zstd files, and the chunks
+    can be compressed in parallel.
+
+    Parameters
+    ----------
+    compression : str, optional
+        'gzip' or 'zstd', None for no compression
+    level : int, optional
+        compression level, defaults to GZIP_LEVEL or ZSTD_LEVEL
+
+    Returns
+    -------
+    function of bytes returning bytes
+    """
+
+    if not compression:
+        return bytes
+
+    if compression == 'gzip':
+        return functools.partial(gzip.compress, compresslevel=level or GZIP_LEVEL)
+
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("zstd compression requires the zstandard package")
+        # a compressor object is not thread safe
+        return lambda data: zstandard.ZstdCompressor(level=level or ZSTD_LEVEL).compress(data)
+
+    raise RuntimeError("unsupported compression '%s', expected gzip or zstd" % compression)
+
+
+class TableWriter(object):
+    """
+    Writes a table to one output file a block of rows at a time.
+
+    Parameters
+    ----------
+    path : str
+    delimiter : str
+        field separator of text formats
+    header : bool
+        whether text formats start with a row of column names
+    compression : str, optional
+        'gzip' or 'zstd', see chunk_compressor, or a codec of the format
+    compression_level : int, optional
+    """
+
+    def __init__(self, path, delimiter=' ', header=True, compression=None,
+                 compression_level=None):
+        self.path = path
+        self.delimiter = delimiter
+        self.header = header
+        self.compression = compression
+        self.compression_level = compression_level
+        self.rows = 0
+
+    def write(self, df):
+        self.write_block(df)
+        self.rows += len(df)
+
+    def write_block(self, df):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TextWriter(TableWriter):
+    """
+    Delimited text formatted with numpy a chunk of rows at a time, see
+    format_text. The same text as CsvWriter for integer and float columns,
+    several times faster for the large integer tables DaySim reads.
+
+    With more than one thread, chunks are formatted and compressed by a
+    pool of threads while earlier chunks are written, in order. At most
+    2 * threads chunks are waiting to be written at a time, so blocks
+    must not be modified after they are written.
+
+    Parameters
+    ----------
+    chunk_size : int, optional
+        rows formatted and compressed at a time, defaults to DEFAULT_CHUNK_SIZE
+    threads : int, optional
+        formatting threads, by default chunks are formatted as they are written
+    """
+
+    def __init__(self, path, delimiter=' ', header=True, chunk_size=None, threads=None,
+                 **kwargs):
+        super(TextWriter, self).__init__(path, delimiter, header, **kwargs)
+        self.chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+        self.compress = chunk_compressor(self.compression, self.compression_level)
+        self.file = open(path, 'wb')
+        self.first = True
+
+        self.pool = ThreadPoolExecutor(threads) if threads and threads > 1 else None
+        self.max_pending = 2 * (threads or 1)
+        self.pending = collections.deque()
+
+    def format_chunk(self, df):
+        return format_text(df, self.delimiter)
+
+    def encode_chunk(self, df):
+        return self.compress(self.format_chunk(df))
+
+    def write_block(self, df):
+        if self.first and self.header:
+            header = self.delimiter.join(map(str, df.columns)) + '\n'
+            self.file.write(self.compress(header.encode('utf-8')))
+        self.first = False
+
+        for start in range(0, len(df), self.chunk_size):
+            chunk = df.iloc[start:start + self.chunk_size]
+            if self.pool is None:
+                self.file.write(self.encode_chunk(chunk))
+                continue
+
+            self.pending.append(self.pool.submit(self.encode_chunk, chunk))
+            while len(self.pending) >= self.max_pending:
+                self.file.write(self.pending.popleft().result())
+
+    def close(self):
+        try:
+            while self.pending:
+                self.file.write(self.pending.popleft().result())
+        finally:
+            if self.pool is not None:
+                # after an error, chunks not yet formatted are dropped
+                for future in self.pending:
+                    future.cancel()
+                self.pending.clear()
+                self.pool.shutdown()
+            self.file.close()
+
+
+class CsvWriter(TextWriter):
+    """
+    Delimited text written by pandas.DataFrame.to_csv.
+    """
+
+    def format_chunk(self, df):
+        return df.to_csv(sep=self.delimiter, header=False, index=False).encode('utf-8')
+
+
+class BinaryWriter(TableWriter):
+    """
+    Raw little-endian records, one fixed size record of the columns per
+    row, with a json description of the record layout next to the file.
+
+    See read_binary_table.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(BinaryWriter, self).__init__(*args, **kwargs)
+        self.compress = chunk_compressor(self.compression, self.compression_level)
+        self.file = open(self.path, 'wb')
+        self.dtype = None
+
+    def write_block(self, df):
+        if self.dtype is None:
+            fields = []
+            for col in df.columns:
+                dtype = df[col].dtype
+                if dtype.kind not in 'biuf':
+                    raise RuntimeError("binary format can't write %s column %s" % (dtype, col))
+                fields.append((str(col), dtype.newbyteorder('<')))
+            self.dtype = np.dtype(fields)
+
+        records = np.empty(len(df), dtype=self.dtype)
+        for col in df.columns:
+            records[str(col)] = df[col].values
+        self.file.write(self.compress(records.tobytes()))
+
+    def close(self):
+        self.file.close()
+        layout = {
+            'rows': self.rows,
+            'columns': [[name, self.dtype[name].str] for name in self.dtype.names]
+            if self.dtype is not None else [],
+            'compression': self.compression,
+        }
+        with open(self.path + '.json', 'w') as f:
+            json.dump(layout, f, indent=2)
+
+
+def read_binary_table(path):
+    """
+    Read a table written by BinaryWriter.
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+
+    with open(path + '.json') as f:
+        layout = json.load(f)
+
+    dtype = np.dtype([(name, str_type) for name, str_type in layout['columns']])
+    if layout.get('compression') == 'gzip':
+        with gzip.open(path, 'rb') as f:
+            records = np.frombuffer(f.read(), dtype=dtype, count=layout['rows'])
+    elif layout.get('compression'):
+        raise RuntimeError("can't read %s compressed %s" % (layout['compression'], path))
+    else:
+        records = np.fromfile(path, dtype=dtype, count=layout['rows'])
+    return pd.DataFrame({name: records[name] for name in dtype.names})
+
+
+def import_pyarrow(format):
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("writing %s files requires pyarrow" % format)
+    return pyarrow
+
+
+class ParquetWriter(TableWriter):
+    """
+    A Parquet file with a row group per block, requires pyarrow. The file
+    is compressed by Parquet, with snappy unless compression is set.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ParquetWriter, self).__init__(*args, **kwargs)
+        self.pa = import_pyarrow('parquet')
+        import pyarrow.parquet  # noqa: F401
+        self.writer = None
+
+    def write_block(self, df):
+        table = self.pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            self.writer = self.pa.parquet.ParquetWriter(
+                self.path, table.schema, compression=self.compression or 'snappy',
+                compression_level=self.compression_level)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class FeatherWriter(TableWriter):
+    """
+    A Feather (Arrow IPC) file with a record batch per block, requires
+    pyarrow. Its record batches can be zstd (but not gzip) compressed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(FeatherWriter, self).__init__(*args, **kwargs)
+        self.pa = import_pyarrow('feather')
+        import pyarrow.ipc  # noqa: F401
+        self.writer = None
+
+    def write_block(self, df):
+        table = self.pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            options = self.pa.ipc.IpcWriteOptions(compression=self.compression)
+            self.writer = self.pa.ipc.new_file(self.path, table.schema, options=options)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+WRITERS = {
+    'csv': CsvWriter,
+    'text': TextWriter,
+    'binary': BinaryWriter,
+    'parquet': ParquetWriter,
+    'feather': FeatherWriter,
+}
+
+
+def open_writer(path, format='csv', **kwargs):
+    """
+    Open a TableWriter for one of the WRITERS formats.
+
+    Parameters
+    ----------
+    path : str
+    format : str
+        csv (pandas), text (numpy formatted), binary (raw little-endian
+        records), parquet or feather
+    **kwargs
+        TableWriter options, chunk_size and threads of text formats
+
+    Returns
+    -------
+    TableWriter
+    """
+
+    if format not in WRITERS:
+        raise RuntimeError("unsupported output format '%s', expected one of %s"
+                           % (format, ', '.join(WRITERS)))
+
+    logger.debug("writing %s as %s" % (path, format))
+    return WRITERS[format](path, **kwargs)